@@ -0,0 +1,629 @@
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Event-loop HTTP front end for the devserver's WSGI application.
+
+A single thread polls all connections: it accepts them, reads and parses
+requests, writes responses and sends static payloads with non-blocking
+sendfile. Only complete requests are handed to a pool of worker threads,
+which run the (blocking) application. Idle and slow keep-alive connections
+thus hold a socket, but no thread.
+"""
+
+import collections
+import errno
+import fcntl
+import os
+import Queue
+import select
+import socket
+import StringIO
+import sys
+import threading
+import time
+import traceback
+import urllib
+
+import log_util
+import static_server
+
+
+# Module-local log function.
+def _Log(message, *args):
+  return log_util.LogWithTag('ASYNC', message, *args)
+
+
+# Requests with larger heads or bodies are refused.
+MAX_HEAD_SIZE = 64 * 1024
+MAX_BODY_SIZE = 16 * 1024 * 1024
+
+# Workers streaming a response wait while this many bytes are still buffered
+# for its connection.
+_MAX_BUFFERED = 1024 * 1024
+
+_RECV_SIZE = 64 * 1024
+
+# Seconds to wait for each busy worker when stopping.
+_STOP_TIMEOUT = 5
+
+_POLLIN = select.POLLIN
+_POLLOUT = select.POLLOUT
+_POLLERR = select.POLLERR | select.POLLHUP | select.POLLNVAL
+
+_AGAIN = (errno.EAGAIN, errno.EWOULDBLOCK)
+
+_STATUS_LINES = {
+    400: '400 Bad Request',
+    411: '411 Length Required',
+    413: '413 Request Entity Too Large',
+    431: '431 Request Header Fields Too Large',
+    500: '500 Internal Server Error',
+    501: '501 Not Implemented',
+}
+
+
+class _ConnectionClosed(Exception):
+  """Raised in workers writing to a connection that was closed."""
+
+
+class _Poller(object):
+  """Wraps epoll where available, and poll elsewhere."""
+
+  def __init__(self):
+    if hasattr(select, 'epoll'):
+      self._epoll = select.epoll()
+      self.register = self._epoll.register
+      self.modify = self._epoll.modify
+      self.unregister = self._epoll.unregister
+    else:
+      self._epoll = None
+      self._poll = select.poll()
+      self.register = self._poll.register
+      self.modify = self._poll.modify
+      self.unregister = self._poll.unregister
+
+  def Poll(self, timeout):
+    """Returns (fd, event mask) pairs, waiting up to timeout seconds."""
+    if self._epoll:
+      return self._epoll.poll(timeout)
+    return self._poll.poll(timeout * 1000)
+
+  def Close(self):
+    if self._epoll:
+      self._epoll.close()
+
+
+class _Connection(object):
+  """State of a client connection.
+
+  The input buffer and request state are only used by the event loop. The
+  output, shared with the worker handling the current request, is guarded
+  by cond.
+  """
+
+  def __init__(self, sock, addr):
+    self.sock = sock
+    self.fd = sock.fileno()
+    self.addr = addr
+    self.inbuf = ''
+    self.sent_continue = False
+    # A request is being handled, and its response not completely sent.
+    self.busy = False
+    self.keep_alive = False
+    self.last_active = time.time()
+    self.mask = 0
+
+    self.cond = threading.Condition()
+    self.out = collections.deque()
+    self.out_size = 0
+    # FileBody to send once out is empty.
+    self.file_body = None
+    # The worker is done with the response.
+    self.finished = False
+    self.closed = False
+
+
+class AsyncServer(object):
+  """Serves a WSGI application from an event loop.
+
+  Requests are run by a pool of worker threads. Responses whose body is a
+  static_server.FileBody are sent by the event loop itself, with sendfile
+  where available.
+
+  Members:
+    host:        address the server listens on.
+    port:        port the server listens on.
+    num_workers: number of threads running the application.
+  """
+
+  def __init__(self, app, host, port, num_workers=10, socket_timeout=60,
+               request_queue_size=128, listener=None):
+    self.host = host
+    self.port = port
+    self.num_workers = num_workers
+    self._app = app
+    self._socket_timeout = socket_timeout
+    self._request_queue_size = request_queue_size
+    # Listening socket, created on start unless one is given, e.g. shared
+    # with other processes.
+    self._listener = listener
+    self._poller = None
+    self._conns = {}
+    self._requests = Queue.Queue()
+    self._threads = []
+    self._running = False
+    # Connections whose output changed, and the pipe waking the event loop
+    # to handle them.
+    self._pending_lock = threading.Lock()
+    self._pending = set()
+    self._wake_r = self._wake_w = None
+
+  def Start(self):
+    """Binds the listening socket and starts the loop and workers."""
+    if not self._listener:
+      self._listener = BindSocket(self.host, self.port,
+                                  self._request_queue_size)
+    self._listener.setblocking(False)
+    self.port = self._listener.getsockname()[1]
+
+    self._wake_r, self._wake_w = os.pipe()
+    for fd in (self._wake_r, self._wake_w):
+      _SetNonBlocking(fd)
+    self._poller = _Poller()
+    self._poller.register(self._listener.fileno(), _POLLIN)
+    self._poller.register(self._wake_r, _POLLIN)
+
+    self._running = True
+    self._threads = [threading.Thread(target=self._Loop, name='async_loop')]
+    self._threads.extend(
+        threading.Thread(target=self._Work, name='async_worker_%d' % i)
+        for i in range(self.num_workers))
+    for thread in self._threads:
+      thread.daemon = True
+      thread.start()
+    _Log('Serving on %s:%d with %d workers', self.host, self.port,
+         self.num_workers)
+
+  def Stop(self):
+    """Stops the loop and workers, closing all connections."""
+    if not self._running:
+      return
+    self._running = False
+    os.write(self._wake_w, 'x')
+    self._threads[0].join()
+    # Closing connections wakes up workers waiting to send output.
+    for conn in self._conns.values():
+      self._Close(conn)
+    for _ in range(self.num_workers):
+      self._requests.put(None)
+    # Like CherryPy's thread pool, do not wait forever on busy workers.
+    for thread in self._threads[1:]:
+      thread.join(_STOP_TIMEOUT)
+    self._threads = []
+    self._poller.Close()
+    self._listener.close()
+    os.close(self._wake_r)
+    os.close(self._wake_w)
+
+  def Stats(self):
+    """Returns a dictionary of statistics about the server."""
+    return {'connections': len(self._conns),
+            'queued_requests': self._requests.qsize()}
+
+  # Event loop.
+
+  def _Loop(self):
+    listen_fd = self._listener.fileno()
+    last_sweep = time.time()
+    while self._running:
+      try:
+        events = self._poller.Poll(1.0)
+      except (IOError, select.error) as e:
+        if e.args[0] == errno.EINTR:
+          continue
+        raise
+
+      for fd, event in events:
+        if fd == listen_fd:
+          self._Accept()
+        elif fd == self._wake_r:
+          self._HandlePending()
+        else:
+          conn = self._conns.get(fd)
+          if not conn:
+            continue
+          if event & (_POLLIN | _POLLERR):
+            self._Read(conn)
+          if event & _POLLOUT and not conn.closed:
+            self._Write(conn)
+
+      now = time.time()
+      if now - last_sweep >= 1:
+        last_sweep = now
+        self._CloseIdle(now)
+
+  def _Accept(self):
+    while True:
+      try:
+        sock, addr = self._listener.accept()
+      except socket.error as e:
+        if e.args[0] not in _AGAIN + (errno.EINTR, errno.ECONNABORTED):
+          _Log('Failed to accept a connection: %s', e)
+        return
+      sock.setblocking(False)
+      sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+      conn = _Connection(sock, addr)
+      self._conns[conn.fd] = conn
+      conn.mask = _POLLIN
+      self._poller.register(conn.fd, conn.mask)
+
+  def _HandlePending(self):
+    try:
+      while os.read(self._wake_r, 4096):
+        pass
+    except OSError as e:
+      if e.errno not in _AGAIN:
+        raise
+    with self._pending_lock:
+      pending = self._pending
+      self._pending = set()
+    for conn in pending:
+      if not conn.closed:
+        self._Write(conn)
+
+  def _Read(self, conn):
+    try:
+      data = conn.sock.recv(_RECV_SIZE)
+    except socket.error as e:
+      if e.args[0] in _AGAIN + (errno.EINTR,):
+        return
+      data = ''
+    if not data:
+      self._Close(conn)
+      return
+    conn.inbuf += data
+    conn.last_active = time.time()
+    if not conn.busy:
+      self._ParseRequest(conn)
+
+  def _Write(self, conn):
+    """Sends as much pending output as possible, and moves on when done."""
+    failed = False
+    with conn.cond:
+      try:
+        while conn.out or conn.file_body:
+          if conn.out:
+            data = conn.out[0]
+            sent = conn.sock.send(data)
+            conn.out_size -= sent
+            if sent < len(data):
+              conn.out[0] = data[sent:]
+              break
+            conn.out.popleft()
+          elif not conn.file_body.remaining:
+            conn.file_body.close()
+            conn.file_body = None
+          elif static_server.sendfile:
+            conn.file_body.Send(conn.fd)
+          else:
+            data = conn.file_body.next()
+            conn.out.append(data)
+            conn.out_size += len(data)
+      except (socket.error, OSError, IOError) as e:
+        failed = e.args[0] not in _AGAIN
+      conn.last_active = time.time()
+      conn.cond.notify_all()
+      done = conn.finished and not conn.out and not conn.file_body
+
+    if failed:
+      self._Close(conn)
+      return
+    if done:
+      if not conn.keep_alive:
+        self._Close(conn)
+        return
+      conn.busy = False
+      self._ParseRequest(conn)
+    if not conn.closed:
+      self._UpdateMask(conn)
+
+  def _UpdateMask(self, conn):
+    mask = 0 if conn.busy else _POLLIN
+    if conn.out or conn.file_body:
+      mask |= _POLLOUT
+    if mask != conn.mask:
+      conn.mask = mask
+      self._poller.modify(conn.fd, mask)
+
+  def _Close(self, conn):
+    if conn.closed:
+      return
+    with conn.cond:
+      conn.closed = True
+      conn.out.clear()
+      if conn.file_body:
+        conn.file_body.close()
+        conn.file_body = None
+      conn.cond.notify_all()
+    del self._conns[conn.fd]
+    try:
+      self._poller.unregister(conn.fd)
+    except (IOError, OSError):
+      pass
+    conn.sock.close()
+
+  def _CloseIdle(self, now):
+    """Closes connections that made no progress for the socket timeout."""
+    for conn in self._conns.values():
+      if now - conn.last_active < self._socket_timeout:
+        continue
+      # Responses being generated may take much longer.
+      if conn.busy and not conn.finished and not conn.out:
+        continue
+      self._Close(conn)
+
+  def _ParseRequest(self, conn):
+    """Hands the next complete request in the input buffer to the workers."""
+    head_end = conn.inbuf.find('\r\n\r\n')
+    if head_end < 0:
+      if len(conn.inbuf) > MAX_HEAD_SIZE:
+        self._SendError(conn, 431)
+      elif not conn.inbuf.strip():
+        # Ignore empty lines between requests.
+        conn.inbuf = ''
+      return
+    lines = conn.inbuf[:head_end].lstrip('\r\n').split('\r\n')
+    request_line = lines[0].split()
+    if len(request_line) != 3 or not request_line[2].startswith('HTTP/'):
+      self._SendError(conn, 400)
+      return
+    method, target, version = request_line
+
+    headers = []
+    for line in lines[1:]:
+      if line[:1] in (' ', '\t') and headers:
+        headers[-1][1] += ' ' + line.strip()
+        continue
+      name, sep, value = line.partition(':')
+      if not sep or not name:
+        self._SendError(conn, 400)
+        return
+      headers.append([name.strip().upper(), value.strip()])
+    header_dict = {}
+    for name, value in headers:
+      if name in header_dict:
+        header_dict[name] += ', ' + value
+      else:
+        header_dict[name] = value
+
+    if 'TRANSFER-ENCODING' in header_dict:
+      # Update clients always send a Content-Length.
+      self._SendError(conn, 411)
+      return
+    try:
+      length = int(header_dict.get('CONTENT-LENGTH', 0))
+    except ValueError:
+      length = -1
+    if length < 0:
+      self._SendError(conn, 400)
+      return
+    if length > MAX_BODY_SIZE:
+      self._SendError(conn, 413)
+      return
+
+    body_start = head_end + 4
+    if len(conn.inbuf) < body_start + length:
+      if (not conn.sent_continue and
+          header_dict.get('EXPECT', '').lower() == '100-continue'):
+        conn.sent_continue = True
+        self._Output(conn, ['%s 100 Continue\r\n\r\n' % version])
+      return
+    body = conn.inbuf[body_start:body_start + length]
+    conn.inbuf = conn.inbuf[body_start + length:]
+    conn.sent_continue = False
+
+    connection = header_dict.get('CONNECTION', '').lower()
+    conn.keep_alive = version == 'HTTP/1.1' and 'close' not in connection
+    conn.busy = True
+    conn.finished = False
+    self._UpdateMask(conn)
+    self._requests.put((conn, self._GetEnviron(conn, method, target, version,
+                                               header_dict, body)))
+
+  def _GetEnviron(self, conn, method, target, version, header_dict, body):
+    if '://' in target:
+      # Absolute URIs, as sent to proxies.
+      target = '/' + target.split('://', 1)[1].partition('/')[2]
+    path, _, query = target.partition('?')
+    environ = {
+        'REQUEST_METHOD': method,
+        'SCRIPT_NAME': '',
+        'PATH_INFO': urllib.unquote(path),
+        'QUERY_STRING': query,
+        'SERVER_NAME': self.host,
+        'SERVER_PORT': str(self.port),
+        'SERVER_PROTOCOL': version,
+        'ACTUAL_SERVER_PROTOCOL': 'HTTP/1.1',
+        'REMOTE_ADDR': conn.addr[0],
+        'REMOTE_PORT': str(conn.addr[1]),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': 'http',
+        'wsgi.input': StringIO.StringIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    for name, value in header_dict.iteritems():
+      key = name.replace('-', '_')
+      if key in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+        environ[key] = value
+      else:
+        environ['HTTP_' + key] = value
+    return environ
+
+  def _SendError(self, conn, code):
+    """Answers a request that cannot be parsed, and closes the connection."""
+    conn.keep_alive = False
+    conn.busy = True
+    conn.finished = True
+    conn.inbuf = ''
+    self._Output(conn, [_ErrorResponse(code)])
+
+  def _Output(self, conn, data):
+    """Queues output from the event loop."""
+    with conn.cond:
+      for chunk in data:
+        conn.out.append(chunk)
+        conn.out_size += len(chunk)
+    self._Write(conn)
+
+  # Workers.
+
+  def _Work(self):
+    while True:
+      request = self._requests.get()
+      if request is None:
+        return
+      conn, environ = request
+      if conn.closed:
+        continue
+      try:
+        self._Respond(conn, environ)
+      except _ConnectionClosed:
+        pass
+
+  def _Respond(self, conn, environ):
+    """Runs the application for a request, and queues its response."""
+    response = {'head': None, 'chunked': False}
+
+    def _StartResponse(status, headers, exc_info=None):
+      if exc_info and response['head'] == 'sent':
+        raise exc_info[0], exc_info[1], exc_info[2]
+      response['status'] = status
+      response['headers'] = headers
+      response['head'] = 'ready'
+      return _WriteBody
+
+    def _SendHead():
+      status = response['status']
+      headers = response['headers']
+      code = int(status[:3])
+      has_body = not (environ['REQUEST_METHOD'] == 'HEAD' or
+                      code in (204, 304) or code < 200)
+      names = set(name.lower() for name, _ in headers)
+      lines = ['HTTP/1.1 %s\r\n' % status]
+      lines.extend('%s: %s\r\n' % header for header in headers)
+      if has_body and 'content-length' not in names:
+        if environ['SERVER_PROTOCOL'] == 'HTTP/1.1':
+          response['chunked'] = True
+          lines.append('Transfer-Encoding: chunked\r\n')
+        else:
+          conn.keep_alive = False
+      if not conn.keep_alive:
+        lines.append('Connection: close\r\n')
+      lines.append('\r\n')
+      response['head'] = 'sent'
+      self._Push(conn, ''.join(lines))
+
+    def _WriteBody(data):
+      if response['head'] != 'sent':
+        _SendHead()
+      if not data:
+        return
+      if response['chunked']:
+        data = '%x\r\n%s\r\n' % (len(data), data)
+      self._Push(conn, data)
+
+    try:
+      result = self._app(environ, _StartResponse)
+      try:
+        file_body = static_server.GetFileBody(result)
+        if file_body and environ['REQUEST_METHOD'] != 'HEAD':
+          _SendHead()
+          self._Finish(conn, file_body.Detach())
+          return
+        for chunk in result:
+          _WriteBody(chunk)
+      finally:
+        if hasattr(result, 'close'):
+          result.close()
+      if response['head'] != 'sent':
+        _SendHead()
+      if response['chunked']:
+        self._Push(conn, '0\r\n\r\n')
+    except _ConnectionClosed:
+      raise
+    except Exception:
+      _Log('Failed to serve %s %s:\n%s', environ['REQUEST_METHOD'],
+           environ['PATH_INFO'], traceback.format_exc())
+      conn.keep_alive = False
+      if response['head'] != 'sent':
+        self._Push(conn, _ErrorResponse(500))
+    self._Finish(conn)
+
+  def _Push(self, conn, data):
+    """Queues output from a worker, waiting if much is already queued."""
+    with conn.cond:
+      while conn.out_size > _MAX_BUFFERED and not conn.closed:
+        conn.cond.wait()
+      if conn.closed:
+        raise _ConnectionClosed()
+      conn.out.append(data)
+      conn.out_size += len(data)
+    self._Wake(conn)
+
+  def _Finish(self, conn, file_body=None):
+    """Marks the response of a worker complete."""
+    with conn.cond:
+      if conn.closed:
+        if file_body:
+          file_body.close()
+        return
+      conn.file_body = file_body
+      conn.finished = True
+    self._Wake(conn)
+
+  def _Wake(self, conn):
+    with self._pending_lock:
+      wake = not self._pending
+      self._pending.add(conn)
+    if wake:
+      try:
+        os.write(self._wake_w, 'x')
+      except OSError as e:
+        if e.errno not in _AGAIN:
+          raise
+
+
+def BindSocket(host, port, request_queue_size=128):
+  """Returns a socket listening on host and port.
+
+  IPv6 sockets also accept IPv4 connections, like CherryPy's do.
+  """
+  family, socktype, proto, _, addr = socket.getaddrinfo(
+      host, port, socket.AF_UNSPEC, socket.SOCK_STREAM, 0,
+      socket.AI_PASSIVE)[0]
+  sock = socket.socket(family, socktype, proto)
+  sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+  if family == socket.AF_INET6:
+    try:
+      sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 0)
+    except (AttributeError, socket.error):
+      pass
+  sock.bind(addr)
+  sock.listen(request_queue_size)
+  return sock
+
+
+def _ErrorResponse(code):
+  """Returns a complete response for an error, closing the connection."""
+  status = _STATUS_LINES[code]
+  return ('HTTP/1.1 %s\r\nContent-Length: %d\r\nContent-Type: text/plain\r\n'
+          'Connection: close\r\n\r\n%s' % (status, len(status), status))
+
+
+def _SetNonBlocking(fd):
+  flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+  fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
@@ -0,0 +1,152 @@
+#!/usr/bin/python
+
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unit tests for async_server module."""
+
+import httplib
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+
+import async_server
+import static_server
+
+
+_PAYLOAD = ''.join(chr(i % 251) for i in range(3 * 1024 * 1024 + 17))
+
+
+class AsyncServerTest(unittest.TestCase):
+
+  def setUp(self):
+    self._root = tempfile.mkdtemp('async_server_unittest')
+    self._payload_path = os.path.join(self._root, 'update.gz')
+    with open(self._payload_path, 'wb') as f:
+      f.write(_PAYLOAD)
+    self._file_cache = static_server.FileCache()
+    self._release = threading.Event()
+    self._server = async_server.AsyncServer(self._App, '127.0.0.1', 0,
+                                            num_workers=2)
+    self._server.Start()
+
+  def tearDown(self):
+    self._release.set()
+    self._server.Stop()
+    shutil.rmtree(self._root)
+
+  def _App(self, environ, start_response):
+    """Serves test responses depending on the path."""
+    path = environ['PATH_INFO']
+    if path == '/echo':
+      body = environ['wsgi.input'].read()
+      start_response('200 OK', [('Content-Length', str(len(body)))])
+      return [body]
+    if path == '/stream':
+      start_response('200 OK', [('Content-Type', 'text/plain')])
+      return ('line %d\n' % i for i in range(3))
+    if path == '/static':
+      st = os.stat(self._payload_path)
+      start_response('200 OK', [('Content-Length', str(st.st_size))])
+      return static_server.FileBody(
+          self._file_cache, self._file_cache.Acquire(self._payload_path, st),
+          0, st.st_size)
+    if path == '/wait':
+      self._release.wait()
+      start_response('200 OK', [('Content-Length', '4')])
+      return ['done']
+    if path == '/error':
+      raise ValueError('failed')
+    body = '%s %s %s' % (environ['REQUEST_METHOD'], path,
+                         environ['QUERY_STRING'])
+    start_response('200 OK', [('Content-Length', str(len(body)))])
+    return [body]
+
+  def _Connect(self):
+    return httplib.HTTPConnection('127.0.0.1', self._server.port)
+
+  def _Request(self, conn, method, path, body=None):
+    conn.request(method, path, body)
+    response = conn.getresponse()
+    return response, response.read()
+
+  def testKeepAlive(self):
+    conn = self._Connect()
+    for i in range(3):
+      response, body = self._Request(conn, 'GET', '/path%%20%d?a=b' % i)
+      self.assertEqual(response.status, 200)
+      self.assertEqual(body, 'GET /path %d a=b' % i)
+    self.assertEqual(self._server.Stats()['connections'], 1)
+    conn.close()
+
+  def testPost(self):
+    conn = self._Connect()
+    body = '<request>%s</request>' % ('x' * 100000)
+    self.assertEqual(self._Request(conn, 'POST', '/echo', body)[1], body)
+
+  def testChunkedResponse(self):
+    response, body = self._Request(self._Connect(), 'GET', '/stream')
+    self.assertEqual(response.getheader('Transfer-Encoding'), 'chunked')
+    self.assertEqual(body, 'line 0\nline 1\nline 2\n')
+
+  def testFileBody(self):
+    conn = self._Connect()
+    for _ in range(2):
+      response, body = self._Request(conn, 'GET', '/static')
+      self.assertEqual(response.status, 200)
+      self.assertEqual(body, _PAYLOAD)
+    self.assertEqual(self._file_cache.Stats()['hits'], 1)
+
+  def testFileBodyWithoutSendfile(self):
+    sendfile = static_server.sendfile
+    static_server.sendfile = None
+    try:
+      body = self._Request(self._Connect(), 'GET', '/static')[1]
+    finally:
+      static_server.sendfile = sendfile
+    self.assertEqual(body, _PAYLOAD)
+
+  def testPipelinedRequests(self):
+    sock = socket.create_connection(('127.0.0.1', self._server.port))
+    sock.sendall('GET /a HTTP/1.1\r\nHost: x\r\n\r\n'
+                 'GET /b HTTP/1.1\r\nHost: x\r\nConnection: close\r\n\r\n')
+    data = ''
+    while True:
+      chunk = sock.recv(4096)
+      if not chunk:
+        break
+      data += chunk
+    sock.close()
+    self.assertEqual(data.count('HTTP/1.1 200 OK'), 2)
+    self.assertTrue(data.index('GET /a') < data.index('GET /b'))
+
+  def testErrors(self):
+    response, _ = self._Request(self._Connect(), 'GET', '/error')
+    self.assertEqual(response.status, 500)
+
+    sock = socket.create_connection(('127.0.0.1', self._server.port))
+    sock.sendall('garbage\r\n\r\n')
+    self.assertTrue(sock.recv(4096).startswith('HTTP/1.1 400'))
+    sock.close()
+
+  def testIdleConnectionsHoldNoWorkers(self):
+    # More connections than workers, two of them busy.
+    idle = [socket.create_connection(('127.0.0.1', self._server.port))
+            for _ in range(50)]
+    waiting = [self._Connect() for _ in range(2)]
+    for conn in waiting:
+      conn.request('GET', '/wait')
+    self._release.set()
+    for conn in waiting:
+      self.assertEqual(conn.getresponse().read(), 'done')
+    self.assertEqual(self._Request(self._Connect(), 'GET', '/')[1], 'GET / ')
+    for sock in idle:
+      sock.close()
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -2,20 +2,28 @@
 # Use of this source code is governed by a BSD-style license that can be
 # found in the LICENSE file.
 
+import contextlib
 import json
 import os
 import errno
+import itertools
 import re
 import subprocess
-import time
-import urllib2
+import threading
 import urlparse
 
 import cherrypy
 
 import autoupdate_lib
 import common_util
+import hash_cache
+import host_info
+import latest_image
 import log_util
+import metrics
+import payload_cache
+import payload_store
+import remote_metadata
 
 
 # Module-local log function.
@@ -23,11 +31,19 @@ def _Log(message, *args):
   return log_util.LogWithTag('UPDATE', message, *args)
 
 
+def _LogDebug(message, *args):
+  return log_util.LogWithTag('UPDATE', message, *args, level=log_util.DEBUG)
+
+
 UPDATE_FILE = 'update.gz'
 KERNEL_UPDATE_FILE = 'kernel_update.gz'
 METADATA_FILE = 'update.meta'
 KERNEL_METADATA_FILE = 'kernel_update.meta'
 CACHE_DIR = 'cache'
+# Directory of CACHE_DIR holding payload generation locks.
+LOCKS_DIR = 'locks'
+# Number of parsed versions, and of versions of image directories, cached.
+VERSIONS_CACHED = 1024
 
 
 class AutoupdateError(Exception):
@@ -55,55 +71,38 @@ def _NonePathJoin(*args):
   return os.path.join(*filter(None, args))
 
 
-class HostInfo(object):
-  """Records information about an individual host.
-
-  Members:
-    attrs: Static attributes (legacy)
-    log: Complete log of recorded client entries
-  """
-
-  def __init__(self):
-    # A dictionary of current attributes pertaining to the host.
-    self.attrs = {}
-
-    # A list of pairs consisting of a timestamp and a dictionary of recorded
-    # attributes.
-    self.log = []
-
-  def __repr__(self):
-    return 'attrs=%s, log=%s' % (self.attrs, self.log)
-
-  def AddLogEntry(self, entry):
-    """Append a new log entry."""
-    # Append a timestamp.
-    assert not 'timestamp' in entry, 'Oops, timestamp field already in use'
-    entry['timestamp'] = time.strftime('%Y-%m-%d %H:%M:%S')
-    # Add entry to hosts' message log.
-    self.log.append(entry)
-
+class Version(tuple):
+  """The numeric tokens of a version string, ordered as versions are.
 
-class HostInfoTable(object):
-  """Records information about a set of hosts who engage in update activity.
-
-  Members:
-    table: Table of information on hosts.
+  E.g. 1098.0.2011_09_28_1635 is (1098, 0, 2011, 9, 28, 1635), which is lower
+  than 1100.0.2011_09_26_0000. Versions are obtained from Parse, which interns
+  them, so that the versions clients report in every update check are only
+  parsed once.
   """
+  __slots__ = ()
 
-  def __init__(self):
-    # A dictionary of host information. Keys are normally IP addresses.
-    self.table = {}
+  _TOKEN_RE = re.compile('[0-9]+')
+  # Parsed versions, keyed by version string. Lookups are lock-free, which
+  # matters more than keeping the most recently used versions: the cache is
+  # simply emptied once full, which a fleet reporting a few versions never
+  # fills.
+  _parsed = {}
 
-  def __repr__(self):
-    return '%s' % self.table
+  @classmethod
+  def Parse(cls, version):
+    """Returns the Version of a version string."""
+    parsed = cls._parsed.get(version)
+    if parsed is None:
+      parsed = cls(int(token) for token in cls._TOKEN_RE.findall(version))
+      if len(cls._parsed) >= VERSIONS_CACHED:
+        cls._parsed.clear()
+      cls._parsed[version] = parsed
+    return parsed
 
-  def GetInitHostInfo(self, host_id):
-    """Return a host's info object, or create a new one if none exists."""
-    return self.table.setdefault(host_id, HostInfo())
 
-  def GetHostInfo(self, host_id):
-    """Return an info object for given host, if such exists."""
-    return self.table.get(host_id)
+# (stat key, version) read from the version.txt of image directories, keyed
+# by path, and validated by the hash_cache.GetStatKey of the file.
+_image_versions = {}
 
 
 class UpdateMetadata(object):
@@ -116,6 +115,61 @@ class UpdateMetadata(object):
     self.is_delta_format = is_delta_format
 
 
+class PayloadMetadataIndex(object):
+  """In-memory index of update payload metadata.
+
+  Entries are keyed by payload path and are only valid while the mtime,
+  inode and size of the payload and of its metadata file match those
+  recorded along with them, so a payload or metadata file that is
+  regenerated or replaced is noticed by two stat calls. Metadata read while
+  the payload and its metadata file were being replaced one after the other
+  is thus read again once both are.
+
+  Members:
+    hits:     number of lookups answered from the index.
+    misses:   number of lookups that had to go to the metadata file.
+    rehashes: number of misses for which the payload had to be hashed.
+  """
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    # A dictionary of (stat keys, UpdateMetadata) pairs keyed by payload path,
+    # where the stat keys are those of the payload and its metadata file.
+    self._entries = {}
+    self.hits = 0
+    self.misses = 0
+    self.rehashes = 0
+
+  @staticmethod
+  def GetStatKey(path):
+    """Returns the (mtime, inode, size) of path; raises OSError if missing."""
+    st = os.stat(path)
+    return (st.st_mtime, st.st_ino, st.st_size)
+
+  def Lookup(self, path, stat_key):
+    """Returns the indexed metadata for path, or None if missing or stale."""
+    entry = self._entries.get(path)
+    with self._lock:
+      if entry and entry[0] == stat_key:
+        self.hits += 1
+        return entry[1]
+      self.misses += 1
+    return None
+
+  def Store(self, path, stat_key, metadata_obj, rehashed=False):
+    """Records the metadata of the payload at path."""
+    with self._lock:
+      self._entries[path] = (stat_key, metadata_obj)
+      if rehashed:
+        self.rehashes += 1
+
+  def Stats(self):
+    """Returns a dictionary of index counters."""
+    with self._lock:
+      return {'entries': len(self._entries), 'hits': self.hits,
+              'misses': self.misses, 'rehashes': self.rehashes}
+
+
 class Autoupdate(object):
   """Class that contains functionality that handles Chrome OS update pings.
 
@@ -137,6 +191,23 @@ class Autoupdate(object):
     remote_payload:   whether provisioned payload is remotely staged.
     max_updates:      maximum number of updates we'll try to provision.
     host_log:         record full history of host update events.
+    host_log_size:    number of events recorded per host.
+    host_idle_timeout: seconds after which hosts that made no requests are
+                       forgotten, or 0 to keep them forever.
+    host_journal:     opened host_journal.HostJournal persisting host info.
+    payload_wait_timeout: seconds a request waits on a payload being
+                          generated for another request before responding
+                          with no update (None waits indefinitely).
+    remote_payload_ttl:   seconds for which remote payload attributes are
+                          used without revalidating them.
+    remote_payload_max_stale: seconds for which remote payload attributes
+                              are used while the remote devserver fails.
+    process_locks:    also lock payload generation against other devserver
+                      processes sharing the static dir.
+    cache_max_size:   bytes of payloads kept in the cache, 0 for no limit.
+    cache_max_entries: payload directories kept in the cache, 0 for no limit.
+    delta_planner:    delta_planner.DeltaPlanner picking the image to
+                      generate a delta from for each client, if any.
   """
 
   _PAYLOAD_URL_PREFIX = '/static/'
@@ -152,8 +223,12 @@ class Autoupdate(object):
                proxy_port=None, src_image='', vm=False, board=None,
                copy_to_static_root=True, private_key=None,
                critical_update=False, remote_payload=False, max_updates= -1,
-               host_log=False, devserver_dir=None, scripts_dir=None,
-               static_dir=None):
+               host_log=False, host_log_size=host_info.DEFAULT_LOG_SIZE,
+               host_idle_timeout=0, host_journal=None, devserver_dir=None,
+               scripts_dir=None, static_dir=None, payload_wait_timeout=None,
+               remote_payload_ttl=10, remote_payload_max_stale=300,
+               process_locks=False, cache_max_size=0,
+               cache_max_entries=payload_cache.DEFAULT_MAX_ENTRIES):
     self.devserver_dir = devserver_dir,
     self.scripts_dir = scripts_dir
     self.static_dir = static_dir
@@ -176,6 +251,8 @@ class Autoupdate(object):
     self.remote_payload = remote_payload
     self.max_updates = max_updates
     self.host_log = host_log
+    self.payload_wait_timeout = payload_wait_timeout
+    self.process_locks = process_locks
 
     # Path to pre-generated file.
     self.pregenerated_path = None
@@ -184,23 +261,71 @@ class Autoupdate(object):
     # information about a given host.  A host is identified by its IP address.
     # The info stored for each host includes a complete log of events for this
     # host, as well as a dictionary of current attributes derived from events.
-    self.host_infos = HostInfoTable()
+    self.host_infos = host_info.HostInfoTable(log_size=host_log_size,
+                                              idle_timeout=host_idle_timeout,
+                                              journal=host_journal)
+
+    # Metadata of local payloads, so that update pings are answered without
+    # reading or hashing payload files.
+    self.payload_index = PayloadMetadataIndex()
+
+    # Coordinates payload generation, keyed by the cached payload path.
+    self._payload_flight = common_util.SingleFlight()
+
+    # Fingerprints of images and keys, persisted next to the payload cache
+    # unless we are only serving pre-built updates.
+    hash_cache_path = None
+    if static_dir and not serve_only:
+      hash_cache_path = os.path.join(static_dir, CACHE_DIR,
+                                     hash_cache.HASH_CACHE_FILE)
+    self.hash_cache = hash_cache.HashCache(hash_cache_path)
+
+    # Payloads generated in the cache of the static dir, evicted when over
+    # budget; Scan() must be called to pick up the existing ones. Payloads
+    # copied to the static dir are published from a content-addressed store
+    # in the cache.
+    self.payload_cache = None
+    self.payload_store = None
+    if static_dir and not serve_only:
+      self.payload_store = payload_store.PayloadStore(
+          os.path.join(static_dir, CACHE_DIR, payload_store.OBJECTS_DIR))
+      entry_lock = None
+      if process_locks:
+        entry_lock = lambda name: common_util.HoldLock(
+            static_dir, os.path.join(CACHE_DIR, LOCKS_DIR, name), timeout=0)
+      self.payload_cache = payload_cache.PayloadCache(
+          os.path.join(static_dir, CACHE_DIR), max_size=cache_max_size,
+          max_entries=cache_max_entries,
+          ignored=(LOCKS_DIR, payload_store.OBJECTS_DIR),
+          entry_lock=entry_lock, on_evict=self.payload_store.Prune)
+
+    # Attributes of payloads staged on remote devservers.
+    self.remote_metadata = remote_metadata.RemoteMetadataClient(
+        ttl=remote_payload_ttl, max_stale=remote_payload_max_stale)
+
+    # Set to plan delta payloads per client version.
+    self.delta_planner = None
+
+    # Latest image directories of boards, as get_latest_image.sh finds them.
+    self.latest_image = latest_image.LatestImageResolver(scripts_dir)
 
   @classmethod
-  def _ReadMetadataFromStream(cls, stream):
-    """Returns metadata obj from input json stream that implements .read()."""
-    file_attr_dict = {}
-    try:
-      file_attr_dict = json.loads(stream.read())
-    except IOError:
-      return None
-
+  def _MetadataFromDict(cls, file_attr_dict):
+    """Returns a metadata obj from a dictionary of file attributes."""
     sha1 = file_attr_dict.get(cls.SHA1_ATTR)
     sha256 = file_attr_dict.get(cls.SHA256_ATTR)
     size = file_attr_dict.get(cls.SIZE_ATTR)
     is_delta = file_attr_dict.get(cls.ISDELTA_ATTR)
     return UpdateMetadata(sha1, sha256, size, is_delta)
 
+  @classmethod
+  def _ReadMetadataFromStream(cls, stream):
+    """Returns metadata obj from input json stream that implements .read()."""
+    try:
+      return cls._MetadataFromDict(json.loads(stream.read()))
+    except IOError:
+      return None
+
   @staticmethod
   def _ReadMetadataFromFile(payload_dir, legacy_image):
     """Returns metadata object from the metadata_file in the payload_dir"""
@@ -227,29 +352,46 @@ class Autoupdate(object):
       json.dump(file_dict, file_handle)
 
   def _GetLatestImageDir(self, board):
-    """Returns the latest image dir based on shell script."""
-    cmd = '%s/get_latest_image.sh --board %s' % (self.scripts_dir, board)
-    return os.popen(cmd).read().strip()
+    """Returns the latest image dir, as get_latest_image.sh finds it."""
+    return self.latest_image.GetLatestImageDir(board)
 
   @staticmethod
   def _GetVersionFromDir(image_dir):
-    """Returns the version of the image based on version.txt."""
-    with open('%s/version.txt' % image_dir, 'r') as ver_file:
+    """Returns the version of the image based on version.txt.
+
+    The version is only read again once version.txt changes.
+    """
+    version_file = '%s/version.txt' % image_dir
+    try:
+      stat_key = hash_cache.GetStatKey(version_file)
+    except OSError:
+      # Let open raise the error.
+      stat_key = None
+    if stat_key:
+      cached = _image_versions.get(version_file)
+      if cached and cached[0] == stat_key:
+        return cached[1]
+
+    with open(version_file, 'r') as ver_file:
       for line in ver_file:
         key, _, value = line.partition('=')
         if key == 'FLATCAR_VERSION':
-          return value.strip('"\'\t ')
+          version = value.strip('"\'\t ')
+          if stat_key:
+            if len(_image_versions) >= VERSIONS_CACHED:
+              _image_versions.clear()
+            _image_versions[version_file] = (stat_key, version)
+          return version
     raise AutoupdateError('Failed to parse version.txt in %s' % image_dir)
 
   @staticmethod
   def _CanUpdate(client_version, latest_version):
     """Returns true if the latest_version is greater than the client_version.
     """
-    _Log('client version %s latest version %s', client_version, latest_version)
+    _LogDebug('client version %s latest version %s', client_version,
+              latest_version)
 
-    client_tokens = [int(i) for i in re.split('[^0-9]', client_version) if i]
-    latest_tokens = [int(i) for i in re.split('[^0-9]', latest_version) if i]
-    return latest_tokens > client_tokens
+    return Version.Parse(latest_version) > Version.Parse(client_version)
 
   def _GetImageName(self):
     """Returns the name of the image that should be used."""
@@ -324,29 +466,33 @@ class Autoupdate(object):
     """
     update_dir = ''
     if src_image:
-      update_dir += common_util.GetFileMd5(src_image) + '_'
+      update_dir += self.hash_cache.GetFileMd5(src_image) + '_'
 
-    update_dir += common_util.GetFileMd5(dest_image)
+    update_dir += self.hash_cache.GetFileMd5(dest_image)
     if self.private_key:
-      update_dir += '+' + common_util.GetFileMd5(self.private_key)
+      update_dir += '+' + self.hash_cache.GetFileMd5(self.private_key)
 
     if not self.vm:
       update_dir += '+patched_kernel'
 
     return os.path.join(CACHE_DIR, update_dir)
 
-  def GenerateUpdateImage(self, image_path, output_dir, legacy_image):
+  def GenerateUpdateImage(self, image_path, output_dir, legacy_image,
+                          src_image=None):
     """Force generates an update payload based on the given image_path.
 
     Args:
-      src_image: image we are updating from (Null/empty for non-delta)
       image_path: full path to the image.
       output_dir: the directory to write the update payloads to
+      src_image: image we are updating from (empty for non-delta); defaults
+        to self.src_image.
     Raises:
       AutoupdateError if it failed to generate either update or stateful
         payload.
     """
     _Log('Generating update for image %s', image_path)
+    if src_image is None:
+      src_image = self.src_image
 
     try:
       os.makedirs(output_dir)
@@ -355,49 +501,153 @@ class Autoupdate(object):
         pass
 
     try:
-      self.GenerateUpdateFile(self.src_image, image_path, output_dir,
+      self.GenerateUpdateFile(src_image, image_path, output_dir,
                               legacy_image)
     except subprocess.CalledProcessError:
       os.system('rm -rf "%s"' % output_dir)
       raise AutoupdateError('Failed to generate update in %s' % output_dir)
 
-  def GenerateUpdateImageWithCache(self, image_path, static_image_dir,
-                                   legacy_image):
-    """Force generates an update payload based on the given image_path.
+  def GenerateCachedUpdateImage(self, src_image, image_path,
+                                static_image_dir, legacy_image,
+                                wait_timeout=None):
+    """Generates an update payload in the cache, unless it is already there.
 
     Args:
+      src_image: image we are updating from (empty for non-delta).
       image_path: full path to the image.
-      static_image_dir: the directory to move images to after generating.
+      static_image_dir: the directory holding the cache directory.
+      wait_timeout: seconds to wait if the payload is being generated by
+        another caller; None waits until it is done.
     Returns:
-      update directory relative to static_image_dir. None if it should
-      serve from the static_image_dir.
+      cache directory of the payload relative to static_image_dir.
     Raises:
-      AutoupdateError if it we need to generate a payload and fail to do so.
+      AutoupdateError if it we need to generate a payload and fail to do so,
+      or if the payload is being generated by another caller which does not
+      finish within wait_timeout.
     """
-    _Log('Generating update for src %s image %s', self.src_image, image_path)
-
     # Which sub_dir of static_image_dir should hold our cached update image
-    cache_sub_dir = self.FindCachedUpdateImageSubDir(self.src_image, image_path)
+    cache_sub_dir = self.FindCachedUpdateImageSubDir(src_image, image_path)
+    # Keep the payload from being evicted while it is generated.
+    with self._UseCachedPayload(os.path.join(static_image_dir, cache_sub_dir)):
+      self._GenerateInCache(src_image, image_path, static_image_dir,
+                            cache_sub_dir, legacy_image, wait_timeout)
+    return cache_sub_dir
+
+  def _GenerateInCache(self, src_image, image_path, static_image_dir,
+                       cache_sub_dir, legacy_image, wait_timeout):
+    """Generates an update payload in cache_sub_dir, unless it is there.
+
+    The caller keeps the cache directory from being evicted meanwhile. See
+    GenerateCachedUpdateImage for the arguments.
+    """
+    _Log('Generating update for src %s image %s', src_image, image_path)
     _Log('Caching in sub_dir "%s"', cache_sub_dir)
 
     # The cached payloads exist in a cache dir
+    full_cache_dir = os.path.join(static_image_dir, cache_sub_dir)
     if legacy_image:
-      cache_update_payload = os.path.join(static_image_dir,
-                                          cache_sub_dir, UPDATE_FILE)
+      cache_update_payload = os.path.join(full_cache_dir, UPDATE_FILE)
+    else:
+      cache_update_payload = os.path.join(full_cache_dir, KERNEL_UPDATE_FILE)
+
+    def _GenerateCachedPayload():
+      # Check to see if this cache directory is valid.
+      if not os.path.exists(cache_update_payload):
+        self.GenerateUpdateImage(image_path, full_cache_dir, legacy_image,
+                                 src_image=src_image)
+
+      # Generate the cache file.
+      self.GetLocalPayloadAttrs(full_cache_dir, legacy_image)
+
+    def _GenerateCachedPayloadLocked():
+      # Locks live apart from the cache directory, which is removed if
+      # generation fails, so that cache cleanup counts them as one entry.
+      lock_tag = os.path.join(CACHE_DIR, LOCKS_DIR,
+                              os.path.basename(cache_sub_dir))
+      with common_util.HoldLock(static_image_dir, lock_tag,
+                                timeout=wait_timeout):
+        _GenerateCachedPayload()
+
+    def _GenerateCachedPayloadOnce():
+      # Only one request generates a given payload, others wait for it to be
+      # done rather than racing it in the same cache directory.
+      self._payload_flight.Do(
+          cache_update_payload,
+          (_GenerateCachedPayloadLocked if self.process_locks
+           else _GenerateCachedPayload),
+          timeout=wait_timeout)
+
+    try:
+      _GenerateCachedPayloadOnce()
+    except common_util.SingleFlightTimeout:
+      raise AutoupdateError('Payload %s is still being generated, try again '
+                            'later' % cache_update_payload)
+
+  @contextlib.contextmanager
+  def _UseCachedPayload(self, cache_dir):
+    """Keeps a cached payload directory from being evicted while in use."""
+    if self.payload_cache:
+      with self.payload_cache.Use(cache_dir):
+        yield
+    else:
+      yield
+
+  def _PublishPayload(self, src_path, dest_path, sha256=None, owned=True):
+    """Makes dest_path a copy of src_path, replacing it atomically.
+
+    Payloads are published from self.payload_store, which avoids copying
+    them whenever possible.
+
+    Args:
+      src_path: path to the payload or metadata file.
+      dest_path: path to publish it at.
+      sha256: base64 encoded SHA256 of the file, if known.
+      owned: whether the devserver generated the file, rather than e.g. the
+             user passing it as --payload.
+    """
+    if self.payload_store:
+      self.payload_store.Publish(src_path, dest_path, sha256, owned)
     else:
-      cache_update_payload = os.path.join(static_image_dir,
-                                          cache_sub_dir, KERNEL_UPDATE_FILE)
+      common_util.CopyFile(src_path, dest_path)
+
+  def GenerateUpdateImageWithCache(self, image_path, static_image_dir,
+                                   legacy_image):
+    """Force generates an update payload based on the given image_path.
 
+    Args:
+      image_path: full path to the image.
+      static_image_dir: the directory to move images to after generating.
+    Returns:
+      update directory relative to static_image_dir. None if it should
+      serve from the static_image_dir.
+    Raises:
+      AutoupdateError if it we need to generate a payload and fail to do so.
+    """
+    cache_sub_dir = self.FindCachedUpdateImageSubDir(self.src_image,
+                                                     image_path)
     full_cache_dir = os.path.join(static_image_dir, cache_sub_dir)
-    # Check to see if this cache directory is valid.
-    if not os.path.exists(cache_update_payload):
-      self.GenerateUpdateImage(image_path, full_cache_dir, legacy_image)
+    # Keep the payload from being evicted until it is published.
+    with self._UseCachedPayload(full_cache_dir):
+      self._GenerateInCache(
+          self.src_image, image_path, static_image_dir, cache_sub_dir,
+          legacy_image, self.payload_wait_timeout)
+      return self._PublishCachedPayload(static_image_dir, cache_sub_dir,
+                                        legacy_image)
+
+  def _PublishCachedPayload(self, static_image_dir, cache_sub_dir,
+                            legacy_image):
+    """Publishes a cached payload to the static root, if requested.
 
-    # Generate the cache file.
-    self.GetLocalPayloadAttrs(full_cache_dir, legacy_image)
+    Returns:
+      cache_sub_dir, or None if the payload was published to be served from
+      static_image_dir.
+    """
+    full_cache_dir = os.path.join(static_image_dir, cache_sub_dir)
     if legacy_image:
+      cache_update_payload = os.path.join(full_cache_dir, UPDATE_FILE)
       cache_metadata_file = os.path.join(full_cache_dir, METADATA_FILE)
     else:
+      cache_update_payload = os.path.join(full_cache_dir, KERNEL_UPDATE_FILE)
       cache_metadata_file = os.path.join(full_cache_dir, KERNEL_METADATA_FILE)
 
     # Generation complete, copy if requested.
@@ -412,12 +662,56 @@ class Autoupdate(object):
                                       KERNEL_UPDATE_FILE)
         metadata_file = os.path.join(static_image_dir, KERNEL_METADATA_FILE)
 
-      common_util.CopyFile(cache_update_payload, update_payload)
-      common_util.CopyFile(cache_metadata_file, metadata_file)
+      sha256 = self.GetLocalPayloadAttrs(full_cache_dir, legacy_image).sha256
+      self._PublishPayload(cache_update_payload, update_payload, sha256)
+      self._PublishPayload(
+          cache_metadata_file, metadata_file,
+          self.hash_cache.GetHashes(cache_metadata_file, ['sha256'])['sha256'])
       return None
     else:
       return cache_sub_dir
 
+  def _GeneratePlannedDelta(self, client_version, image_path,
+                            static_image_dir, legacy_image):
+    """Generates the delta self.delta_planner picks for a client, if any.
+
+    If a delta is picked but not generated yet, and the planner can schedule
+    its generation, it is scheduled and the client gets a full payload
+    meanwhile. Clients also get a full payload if generating the delta fails.
+
+    Args:
+      client_version: version the client runs.
+      image_path: full path to the image the client updates to.
+      static_image_dir: the directory holding the cache directory.
+    Returns:
+      cache directory of the delta relative to static_image_dir, or None if
+      the client should get a full payload.
+    """
+    if not self.delta_planner:
+      return None
+    src_image = self.delta_planner.GetSourceImage(client_version, image_path)
+    if not src_image:
+      return None
+
+    cache_sub_dir = self.FindCachedUpdateImageSubDir(src_image, image_path)
+    metadata_file = os.path.join(
+        static_image_dir, cache_sub_dir,
+        METADATA_FILE if legacy_image else KERNEL_METADATA_FILE)
+    # Scheduled payloads are generated in the cache of the static dir.
+    if (self.delta_planner.schedule and not os.path.exists(metadata_file) and
+        os.path.abspath(static_image_dir) == os.path.abspath(self.static_dir)):
+      self.delta_planner.schedule(image_path, src_image, legacy_image)
+      return None
+
+    try:
+      return self.GenerateCachedUpdateImage(
+          src_image, image_path, static_image_dir, legacy_image,
+          wait_timeout=self.payload_wait_timeout)
+    except AutoupdateError as e:
+      _Log('Serving a full payload instead of a delta from %s: %s',
+           src_image, e)
+      return None
+
   def GenerateLatestUpdateImage(self, board, client_version,
                                 static_image_dir, legacy_image):
     """Generates an update using the latest image that has been built.
@@ -446,6 +740,10 @@ class Autoupdate(object):
       raise AutoupdateError('Update check received but no update available '
                             'for client')
 
+    delta_dir = self._GeneratePlannedDelta(client_version, latest_image_path,
+                                           static_image_dir, legacy_image)
+    if delta_dir:
+      return delta_dir
     return self.GenerateUpdateImageWithCache(latest_image_path,
                                              static_image_dir=static_image_dir,
                                              legacy_image=legacy_image)
@@ -471,11 +769,18 @@ class Autoupdate(object):
       src_path = os.path.abspath(self.payload_path)
       # Only copy the files if the source directory is different from dest.
       if os.path.dirname(src_path) != os.path.abspath(static_image_dir):
-        common_util.CopyFile(src_path, dest_path)
+        self._PublishPayload(
+            src_path, dest_path,
+            self.hash_cache.GetHashes(src_path, ['sha256'])['sha256'],
+            owned=False)
 
       # Serve from the main directory so rel_path is None.
       return None
     elif self.forced_image:
+      delta_dir = self._GeneratePlannedDelta(client_version, self.forced_image,
+                                             static_image_dir, legacy_image)
+      if delta_dir:
+        return delta_dir
       return self.GenerateUpdateImageWithCache(
           self.forced_image,
           static_image_dir=static_image_dir,
@@ -500,7 +805,7 @@ class Autoupdate(object):
     _Log('Pre-generating the update payload')
     # Does not work with labels so just use static dir.
     pregenerated_update = self.GenerateUpdatePayload(self.board, '0.0.0.0',
-                                                     self.static_dir)
+                                                     self.static_dir, True)
     print 'PREGENERATED_UPDATE=%s' % _NonePathJoin(pregenerated_update,
                                                    UPDATE_FILE)
     return pregenerated_update
@@ -511,7 +816,9 @@ class Autoupdate(object):
     Obtain attributes of a payload file available on a remote devserver. This
     is based on the assumption that the payload URL uses the /static prefix. We
     need to make sure that both clients (requests) and remote devserver
-    (provisioning) preserve this invariant.
+    (provisioning) preserve this invariant. Attributes are cached and
+    revalidated by self.remote_metadata, so most update checks are answered
+    without a round trip to the remote devserver.
 
     Args:
       url: URL of statically staged remote file (http://host:port/static/...)
@@ -526,20 +833,17 @@ class Autoupdate(object):
 
     fileinfo_url = url.replace(self._PAYLOAD_URL_PREFIX,
                                self._FILEINFO_URL_PREFIX)
-    _Log('Retrieving file info for remote payload via %s', fileinfo_url)
     try:
-      conn = urllib2.urlopen(fileinfo_url)
-      metadata_obj = Autoupdate._ReadMetadataFromStream(conn)
-      # These fields are required for remote calls.
-      if not metadata_obj:
-        raise AutoupdateError('Failed to obtain remote payload info')
+      file_attr_dict = self.remote_metadata.GetFileInfo(fileinfo_url)
+    except remote_metadata.RemoteMetadataError as e:
+      raise AutoupdateError('Failed to obtain remote payload info: %s' % e)
 
-      if not metadata_obj.is_delta_format:
-        metadata_obj.is_delta_format = ('_mton' in url) or ('_nton' in url)
+    # The client caches the dictionary, so build a new object from it.
+    metadata_obj = Autoupdate._MetadataFromDict(file_attr_dict)
+    if not metadata_obj.is_delta_format:
+      metadata_obj.is_delta_format = ('_mton' in url) or ('_nton' in url)
 
-      return metadata_obj
-    except IOError as e:
-      raise AutoupdateError('Failed to obtain remote payload info: %s', e)
+    return metadata_obj
 
   def GetLocalPayloadAttrs(self, payload_dir, legacy_image):
     """Returns hashes, size and delta flag of a local update payload.
@@ -552,75 +856,119 @@ class Autoupdate(object):
     """
     if legacy_image:
       filename = os.path.join(payload_dir, UPDATE_FILE)
+      metadata_file = os.path.join(payload_dir, METADATA_FILE)
     else:
       filename = os.path.join(payload_dir, KERNEL_UPDATE_FILE)
-    if not os.path.exists(filename):
+      metadata_file = os.path.join(payload_dir, KERNEL_METADATA_FILE)
+
+    def _GetMetadataStatKey():
+      try:
+        return PayloadMetadataIndex.GetStatKey(metadata_file)
+      except OSError:
+        return None
+
+    try:
+      payload_key = PayloadMetadataIndex.GetStatKey(filename)
+    except OSError:
       raise AutoupdateError('%s not present in payload dir %s' %
                             (filename, payload_dir))
+    stat_key = (payload_key, _GetMetadataStatKey())
 
+    metadata_obj = self.payload_index.Lookup(filename, stat_key)
+    if metadata_obj:
+      return metadata_obj
+
+    rehashed = False
     metadata_obj = Autoupdate._ReadMetadataFromFile(payload_dir, legacy_image)
     if not metadata_obj or not (metadata_obj.sha1 and
                                 metadata_obj.sha256 and
                                 metadata_obj.size):
-      sha1 = common_util.GetFileSha1(filename)
-      sha256 = common_util.GetFileSha256(filename)
+      sha1, sha256 = common_util.GetFileSha1AndSha256(filename)
       size = common_util.GetFileSize(filename)
       is_delta_format = self._IsDeltaFormatFile(filename)
       metadata_obj = UpdateMetadata(sha1, sha256, size, is_delta_format)
       Autoupdate._StoreMetadataToFile(payload_dir, metadata_obj, legacy_image)
+      stat_key = (payload_key, _GetMetadataStatKey())
+      rehashed = True
 
+    self.payload_index.Store(filename, stat_key, metadata_obj, rehashed)
     return metadata_obj
 
+  def IndexLocalPayloads(self):
+    """Loads the metadata of payloads found in the static and cache dirs.
+
+    This warms up the payload index on startup, so that first pings for
+    already generated payloads do not have to read metadata files.
+    """
+    payload_dirs = [self.static_dir]
+    cache_dir = os.path.join(self.static_dir, CACHE_DIR)
+    if os.path.isdir(cache_dir):
+      payload_dirs.extend(os.path.join(cache_dir, entry)
+                          for entry in sorted(os.listdir(cache_dir)))
+
+    for payload_dir in payload_dirs:
+      for filename, legacy_image in ((UPDATE_FILE, True),
+                                     (KERNEL_UPDATE_FILE, False)):
+        if os.path.exists(os.path.join(payload_dir, filename)):
+          try:
+            self.GetLocalPayloadAttrs(payload_dir, legacy_image)
+          except (AutoupdateError, IOError, OSError) as e:
+            _Log('Failed to index payload in %s: %s', payload_dir, e)
+
+    _Log('Indexed local payloads: %s', self.payload_index.Stats())
+
   def _ProcessUpdateComponents(self, app, event):
     """Processes the app and event components of an update request.
 
+    Args:
+      app: attribute dictionary of the request's app element, or None.
+      event: attribute dictionary of the request's event element, or None.
     Returns tuple containing forced_update_label, client_version, board and
     app_id
     """
     # Initialize an empty dictionary for event attributes to log.
     log_message = {}
 
+    # Attributes to store to the legacy host info structure.
+    host_attrs = {}
+
     # Determine request IP, strip any IPv6 data for simplicity.
     client_ip = cherrypy.request.remote.ip.split(':')[-1]
-    # Obtain (or init) info object for this client.
-    curr_host_info = self.host_infos.GetInitHostInfo(client_ip)
 
     client_version = 'ForcedUpdate'
     board = None
     app_id = None
-    if app:
-      client_version = app.getAttribute('version')
-      channel = app.getAttribute('track')
-      board = (app.hasAttribute('board') and app.getAttribute('board')
-                  or self.board)
-      app_id = app.getAttribute('appid')
+    if app is not None:
+      client_version = app.get('version', '')
+      channel = app.get('track', '')
+      board = app.get('board') or self.board
+      app_id = app.get('appid', '')
       # Add attributes to log message
       log_message['version'] = client_version
       log_message['track'] = channel
       log_message['board'] = board
-      curr_host_info.attrs['last_known_version'] = client_version
-
-    if event:
-      event_result = int(event[0].getAttribute('eventresult'))
-      event_type = int(event[0].getAttribute('eventtype'))
-      client_previous_version = (event[0].getAttribute('previousversion')
-                                 if event[0].hasAttribute('previousversion')
-                                 else None)
+      host_attrs['last_known_version'] = client_version
+
+    if event is not None:
+      event_result = int(event.get('eventresult', ''))
+      event_type = int(event.get('eventtype', ''))
+      client_previous_version = event.get('previousversion')
       # Store attributes to legacy host info structure
-      curr_host_info.attrs['last_event_status'] = event_result
-      curr_host_info.attrs['last_event_type'] = event_type
+      host_attrs['last_event_status'] = event_result
+      host_attrs['last_event_type'] = event_type
       # Add attributes to log message
       log_message['event_result'] = event_result
       log_message['event_type'] = event_type
       if client_previous_version is not None:
         log_message['previous_version'] = client_previous_version
 
-    # Log host event, if so instructed.
-    if self.host_log:
-      curr_host_info.AddLogEntry(log_message)
+    # Record the request, logging the host event if so instructed, and pick
+    # up any label forced for this client.
+    forced_update_label = self.host_infos.RecordRequest(
+        client_ip, host_attrs, log_message if self.host_log else None,
+        pop_attr='forced_update_label')
 
-    return (curr_host_info.attrs.pop('forced_update_label', None),
-            client_version, board, app_id)
+    return (forced_update_label, client_version, board, app_id)
 
   def _GetStaticUrl(self):
     """Returns the static url base that should prefix all payload responses."""
@@ -642,8 +990,8 @@ class Autoupdate(object):
     if self.proxy_port:
       static_urlbase = _ChangeUrlPort(static_urlbase, self.proxy_port)
 
-    _Log('Using static url base %s', static_urlbase)
-    _Log('Handling update ping as %s', hostname)
+    _LogDebug('Using static url base %s', static_urlbase)
+    _LogDebug('Handling update ping as %s', hostname)
     return static_urlbase
 
   def HandleUpdatePing(self, data, label=None):
@@ -659,14 +1007,16 @@ class Autoupdate(object):
     # http://hostname:8080/static/update.gz.
     static_urlbase = self._GetStaticUrl()
 
-    _Log(data)
+    _LogDebug('%s', data)
     # Parse the XML we got into the components we care about.
-    protocol, app, event, update_check = autoupdate_lib.ParseUpdateRequest(data)
+    with metrics.TimePhase('xml_parse'):
+      request = autoupdate_lib.ParseUpdateRequest(data)
+    protocol = request.protocol
 
     # #########################################################################
     # Process attributes of the update check.
     forced_update_label, client_version, board, app_id = self._ProcessUpdateComponents(
-        app, event)
+        request.app, request.event)
 
     if app_id == '{e96281a6-d1af-4bde-9a0a-97b76e56dc57}':
       legacy_image = True
@@ -674,8 +1024,8 @@ class Autoupdate(object):
       legacy_image = False
 
     # We only process update_checks in the update rpc.
-    if not update_check:
-      _Log('Non-update check received.  Returning blank payload')
+    if request.update_check is None:
+      _LogDebug('Non-update check received.  Returning blank payload')
       # TODO(sosa): Generate correct non-updatecheck payload to better test
       # update clients.
       return autoupdate_lib.GetNoUpdateResponse(protocol)
@@ -687,8 +1037,8 @@ class Autoupdate(object):
       _Log('Request received but max number of updates handled')
       return autoupdate_lib.GetNoUpdateResponse(protocol)
 
-    _Log('Update Check Received. Client is using protocol version: %s',
-         protocol)
+    _LogDebug('Update Check Received. Client is using protocol version: %s',
+              protocol)
 
     if forced_update_label:
       if label:
@@ -714,7 +1064,8 @@ class Autoupdate(object):
         url = '/'.join(filter(None, [static_urlbase, label, UPDATE_FILE]))
 
         # Get remote payload attributes.
-        metadata_obj = self._GetRemotePayloadAttrs(url)
+        with metrics.TimePhase('metadata_lookup'):
+          metadata_obj = self._GetRemotePayloadAttrs(url)
       else:
         static_image_dir = _NonePathJoin(self.static_dir, label)
         rel_path = None
@@ -722,8 +1073,9 @@ class Autoupdate(object):
         # Serving files only, don't generate an update.
         if not self.serve_only:
           # Generate payload if necessary.
-          rel_path = self.GenerateUpdatePayload(board, client_version,
-                                                static_image_dir, legacy_image)
+          with metrics.TimePhase('payload_generation'):
+            rel_path = self.GenerateUpdatePayload(
+                board, client_version, static_image_dir, legacy_image)
 
         if legacy_image:
           filename = UPDATE_FILE
@@ -732,7 +1084,9 @@ class Autoupdate(object):
         url = '/'.join(filter(None, [static_urlbase, label, rel_path,
                                      filename]))
         local_payload_dir = _NonePathJoin(static_image_dir, rel_path)
-        metadata_obj = self.GetLocalPayloadAttrs(local_payload_dir, legacy_image)
+        with metrics.TimePhase('metadata_lookup'):
+          metadata_obj = self.GetLocalPayloadAttrs(local_payload_dir,
+                                                   legacy_image)
 
     except AutoupdateError as e:
       # Raised if we fail to generate an update payload.
@@ -740,33 +1094,67 @@ class Autoupdate(object):
       return autoupdate_lib.GetNoUpdateResponse(protocol)
 
     _Log('Responding to client to use url %s to get image', url)
-    return autoupdate_lib.GetUpdateResponse(
-        metadata_obj.sha1, metadata_obj.sha256, metadata_obj.size, url,
-        metadata_obj.is_delta_format, protocol, self.critical_update)
+    with metrics.TimePhase('response_rendering'):
+      return autoupdate_lib.GetUpdateResponse(
+          metadata_obj.sha1, metadata_obj.sha256, metadata_obj.size, url,
+          metadata_obj.is_delta_format, protocol, self.critical_update)
 
   def HandleHostInfoPing(self, ip):
     """Returns host info dictionary for the given IP in JSON format."""
     assert ip, 'No ip provided.'
-    if ip in self.host_infos.table:
-      return json.dumps(self.host_infos.GetHostInfo(ip).attrs)
-
-  def HandleHostLogPing(self, ip):
-    """Returns a complete log of events for host in JSON format."""
-    # If all events requested, return a dictionary of logs keyed by IP address.
-    if ip == 'all':
-      return json.dumps(
-          dict([(key, self.host_infos.table[key].log)
-                for key in self.host_infos.table]))
+    attrs = self.host_infos.GetAttrs(ip)
+    if attrs is not None:
+      return json.dumps(attrs)
 
-    # Otherwise we're looking for a specific IP address, so find its log.
-    if ip in self.host_infos.table:
-      return json.dumps(self.host_infos.GetHostInfo(ip).log)
+  def HandleHostLogPing(self, ip, log_format='json', limit=None, **filters):
+    """Returns a log of events for host in JSON format.
 
-    # If no events were logged for this IP, return an empty log.
-    return json.dumps([])
+    Args:
+      ip: address of the host whose events are requested, or 'all'.
+      log_format: 'json' to return a single JSON document, or 'ndjson' to
+                  return a generator of JSON encoded events, one per line.
+      limit: maximum number of events returned, if any.
+      filters: since, until, cursor, event_type and/or event_result filters,
+               as taken by host_info.HostInfoTable.QueryLog.
+    """
+    if log_format == 'ndjson':
+      return self._StreamHostLog(ip, limit, filters)
+
+    if limit is None and not filters:
+      # If all events requested, return a dictionary of logs keyed by IP
+      # address.
+      if ip == 'all':
+        return json.dumps(self.host_infos.GetAllLogs())
+
+      # Otherwise we're looking for a specific IP address, so find its log.
+      # If no events were logged for this IP, return an empty log.
+      return json.dumps(self.host_infos.GetLog(ip) or [])
+
+    entries = itertools.islice(
+        self.host_infos.QueryLog(None if ip == 'all' else ip, **filters),
+        limit)
+    if ip == 'all':
+      logs = {}
+      for host_id, entry in entries:
+        logs.setdefault(host_id, []).append(entry.ToDict())
+      return json.dumps(logs)
+    return json.dumps([entry.ToDict() for _, entry in entries])
+
+  def _StreamHostLog(self, ip, limit, filters):
+    """Yields matching host events as lines of JSON.
+
+    Besides the fields served by HandleHostLogPing, each event carries the
+    ip of its host, its numeric time and its seq number, which can be passed
+    back as a cursor to resume after it.
+    """
+    entries = self.host_infos.QueryLog(None if ip == 'all' else ip, **filters)
+    for host_id, entry in itertools.islice(entries, limit):
+      event = entry.ToDict()
+      event.update(ip=host_id, seq=entry.seq, time=entry.timestamp)
+      yield json.dumps(event) + '\n'
 
   def HandleSetUpdatePing(self, ip, label):
     """Sets forced_update_label for a given host."""
     assert ip, 'No ip provided.'
     assert label, 'No label provided.'
-    self.host_infos.GetInitHostInfo(ip).attrs['forced_update_label'] = label
+    self.host_infos.SetAttr(ip, 'forced_update_label', label)
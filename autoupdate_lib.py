@@ -7,11 +7,24 @@
 import datetime
 import os
 import time
-from xml.dom import minidom
+from xml.parsers import expat
 
 
 APP_ID = 'e96281a6-d1af-4bde-9a0a-97b76e56dc57'
 
+# Update requests are a few hundred bytes; anything much larger than this is
+# not a well-behaved update client and is rejected before parsing.
+MAX_REQUEST_SIZE = 64 * 1024
+
+SUPPORTED_PROTOCOLS = ('2.0', '3.0')
+
+# The only field of a response which varies between otherwise identical
+# responses. Cached responses are split around it.
+_TIME_ELAPSED_FIELD = '%(time_elapsed)s'
+
+# Maximum number of pre-rendered responses kept before the cache is reset.
+_MAX_CACHED_RESPONSES = 128
+
 # Responses for the various Omaha protocols indexed by the protocol version.
 UPDATE_RESPONSE = {}
 UPDATE_RESPONSE['2.0'] = """<?xml version="1.0" encoding="UTF-8"?>
@@ -92,32 +105,79 @@ class UnknownProtocolRequestedException(Exception):
   """Raised when an supported protocol is specified."""
 
 
+class RequestTooLargeException(Exception):
+  """Raised when an update request exceeds MAX_REQUEST_SIZE."""
+
+
+class UpdateRequest(object):
+  """The parts of an update request the devserver acts upon.
+
+  Members:
+    protocol:     client's protocol version string.
+    app:          attribute dictionary of the first app element, or None.
+    event:        attribute dictionary of the first event element, or None.
+    update_check: attribute dictionary of the first updatecheck element, or
+                  None if the request is not an update check.
+  """
+  __slots__ = ('protocol', 'app', 'event', 'update_check')
+
+  def __init__(self):
+    self.protocol = None
+    self.app = None
+    self.event = None
+    self.update_check = None
+
+
 def GetSecondsSinceMidnight():
   """Returns the seconds since midnight as a decimal value."""
   now = time.localtime()
   return now[3] * 3600 + now[4] * 60 + now[5]
 
 
-def GetCommonResponseValues():
-  """Returns a dictionary of default values for the response."""
-  response_values = {}
-  response_values['appid'] = APP_ID
-  response_values['time_elapsed'] = GetSecondsSinceMidnight()
-  return response_values
+# Pre-rendered responses, keyed by everything that determines their content
+# except the time elapsed since midnight. Values are (head, tail) byte strings
+# to be joined around that field.
+_response_cache = {}
+
 
+def _ToBytes(value):
+  """Returns value UTF-8 encoded if it is a unicode string."""
+  if isinstance(value, unicode):
+    return value.encode('utf-8')
+  return value
 
-def GetSubstitutedResponse(response_dict, protocol, response_values):
-  """Substitutes the protocol-specific response with response_values.
+
+def _RenderResponseParts(response_dict, protocol, response_values):
+  """Renders a canned response, except for its time elapsed field.
 
   Args:
     response_dict: Canned response messages indexed by protocol.
     protocol: client's protocol version from the request Xml.
     response_values: Values to be substituted in the canned response.
   Returns:
-    Xml string to be passed back to client.
+    A (head, tail) pair of byte strings that surround the time elapsed value.
+  """
+  head, tail = response_dict[protocol].split(_TIME_ELAPSED_FIELD)
+  return (_ToBytes(head % response_values), _ToBytes(tail % response_values))
+
+
+def _GetCachedResponse(key, render_func):
+  """Returns a response body built from cached parts.
+
+  Args:
+    key: hashable key identifying the response parts.
+    render_func: callable returning the (head, tail) parts on a cache miss.
+  Returns:
+    The response body with the current time elapsed since midnight.
   """
-  response_xml = response_dict[protocol] % response_values
-  return response_xml
+  parts = _response_cache.get(key)
+  if parts is None:
+    parts = render_func()
+    if len(_response_cache) >= _MAX_CACHED_RESPONSES:
+      _response_cache.clear()
+    _response_cache[key] = parts
+
+  return ''.join((parts[0], str(GetSecondsSinceMidnight()), parts[1]))
 
 
 def GetUpdateResponse(sha1, sha256, size, url, is_delta_format, protocol,
@@ -135,25 +195,34 @@ def GetUpdateResponse(sha1, sha256, size, url, is_delta_format, protocol,
   Returns:
     Xml string to be passed back to client.
   """
-  response_values = GetCommonResponseValues()
-  response_values['sha1'] = sha1
-  response_values['sha256'] = sha256
-  response_values['size'] = size
-  response_values['url'] = url
-  (codebase, filename) = os.path.split(url)
-  response_values['codebase'] = codebase
-  response_values['filename'] = filename
-  response_values['is_delta_format'] = is_delta_format
-  extra_attributes = []
+  deadline = None
   if critical_update:
     # The date string looks like '20111115' (2011-11-15). As of writing,
     # there's no particular format for the deadline value that the
     # client expects -- it's just empty vs. non-empty.
-    date_str = datetime.date.today().strftime('%Y%m%d')
-    extra_attributes.append('deadline="%s"' % date_str)
-
-  response_values['extra_attr'] = ' '.join(extra_attributes)
-  return GetSubstitutedResponse(UPDATE_RESPONSE, protocol, response_values)
+    deadline = datetime.date.today().strftime('%Y%m%d')
+
+  def _Render():
+    response_values = {}
+    response_values['appid'] = APP_ID
+    response_values['sha1'] = sha1
+    response_values['sha256'] = sha256
+    response_values['size'] = size
+    response_values['url'] = url
+    (codebase, filename) = os.path.split(url)
+    response_values['codebase'] = codebase
+    response_values['filename'] = filename
+    response_values['is_delta_format'] = is_delta_format
+    extra_attributes = []
+    if deadline:
+      extra_attributes.append('deadline="%s"' % deadline)
+
+    response_values['extra_attr'] = ' '.join(extra_attributes)
+    return _RenderResponseParts(UPDATE_RESPONSE, protocol, response_values)
+
+  key = ('update', protocol, sha1, sha256, size, url, is_delta_format,
+         deadline)
+  return _GetCachedResponse(key, _Render)
 
 
 def GetNoUpdateResponse(protocol):
@@ -164,33 +233,86 @@ def GetNoUpdateResponse(protocol):
   Returns:
     Xml string to be passed back to client.
   """
-  response_values = GetCommonResponseValues()
-  return GetSubstitutedResponse(NO_UPDATE_RESPONSE, protocol, response_values)
+  return _GetCachedResponse(
+      ('noupdate', protocol),
+      lambda: _RenderResponseParts(NO_UPDATE_RESPONSE, protocol,
+                                   {'appid': APP_ID}))
+
+
+class _ParseDone(Exception):
+  """Raised from within expat handlers to stop parsing early."""
+
+
+class _UpdateRequestParser(object):
+  """Incrementally collects an UpdateRequest from expat start events."""
+
+  def __init__(self):
+    self.request = UpdateRequest()
+    self._names = None
+
+  def StartElement(self, name, attrs):
+    request = self.request
+    if self._names is None:
+      # The first element is the document root, which carries the protocol.
+      protocol = attrs.get('protocol', '')
+      if protocol not in SUPPORTED_PROTOCOLS:
+        raise UnknownProtocolRequestedException(
+            'Supported protocols are %s' % (SUPPORTED_PROTOCOLS,))
+      request.protocol = protocol
+      prefix = 'o:' if protocol == '2.0' else ''
+      self._names = (prefix + 'app', prefix + 'event', prefix + 'updatecheck')
+      return
+
+    app_name, event_name, update_check_name = self._names
+    if name == app_name:
+      if request.app is None:
+        request.app = attrs
+    elif name == event_name:
+      if request.event is None:
+        request.event = attrs
+    elif name == update_check_name:
+      if request.update_check is None:
+        request.update_check = attrs
+    else:
+      return
+
+    # Nothing past the first app, event and updatecheck elements is used.
+    if (request.app is not None and request.event is not None and
+        request.update_check is not None):
+      raise _ParseDone()
 
 
 def ParseUpdateRequest(request_string):
-  """Returns a tuple containing information parsed from an update request.
+  """Returns the information parsed from an update request.
+
+  The request is parsed incrementally with expat; only the attributes of the
+  first app, event and updatecheck elements are retained and parsing stops as
+  soon as all three have been seen.
 
   Args:
-    request_dom: an xml string containing the update request.
-  Returns tuple consisting of protocol string, app element, event element and
-    update_check element.
-  Raises UnknownProtocolRequestedException if we do not understand the
-    protocol.
+    request_string: an xml string containing the update request.
+  Returns:
+    An UpdateRequest object.
+  Raises:
+    RequestTooLargeException if the request exceeds MAX_REQUEST_SIZE.
+    UnknownProtocolRequestedException if we do not understand the protocol.
+    expat.ExpatError if the request is not well-formed.
   """
-  request_dom = minidom.parseString(request_string)
-  protocol = request_dom.firstChild.getAttribute('protocol')
-  supported_protocols = '2.0', '3.0'
-  if protocol not in supported_protocols:
-    raise UnknownProtocolRequestedException('Supported protocols are %s' %
-                                            supported_protocols)
-
-  element_dict = {}
-  for name in ['event', 'app', 'updatecheck']:
-    element_dict[name] = 'o:' + name if protocol == '2.0' else name
-
-  app = request_dom.firstChild.getElementsByTagName(element_dict['app'])[0]
-  event = request_dom.getElementsByTagName(element_dict['event'])
-  update_check = request_dom.getElementsByTagName(element_dict['updatecheck'])
-
-  return protocol, app, event, update_check
+  if len(request_string) > MAX_REQUEST_SIZE:
+    raise RequestTooLargeException(
+        'Update request of %d bytes exceeds limit of %d bytes' %
+        (len(request_string), MAX_REQUEST_SIZE))
+
+  handler = _UpdateRequestParser()
+  parser = expat.ParserCreate()
+  parser.StartElementHandler = handler.StartElement
+  try:
+    parser.Parse(request_string, True)
+  except _ParseDone:
+    pass
+
+  if handler.request.protocol is None:
+    raise UnknownProtocolRequestedException(
+        'Supported protocols are %s' % (SUPPORTED_PROTOCOLS,))
+
+  return handler.request
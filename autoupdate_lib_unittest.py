@@ -0,0 +1,195 @@
+#!/usr/bin/python
+
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unit tests for autoupdate_lib.py."""
+
+import os
+import sys
+import timeit
+import unittest
+from xml.dom import minidom
+from xml.parsers import expat
+
+import autoupdate_lib
+
+
+# Update request based on Omaha v2 protocol format.
+_UPDATE_REQUEST_V2 = """<?xml version="1.0" encoding="UTF-8"?>
+<o:gupdate xmlns:o="http://www.google.com/update2/request" version="ChromeOSUpdateEngine-0.1.0.0" updaterversion="ChromeOSUpdateEngine-0.1.0.0" protocol="2.0" ismachine="1">
+    <o:os version="Indy" platform="Chrome OS" sp="0.11.254.2011_03_09_1814_i686"></o:os>
+    <o:app appid="{DEV-BUILD}" version="0.11.254.2011_03_09_1814" lang="en-US" track="developer-build" board="x86-generic" hardware_class="BETA DVT" delta_okay="true">
+        <o:updatecheck></o:updatecheck>
+        <o:event eventtype="3" eventresult="2" previousversion="0.11.216.2011_03_02_1358"></o:event>
+    </o:app>
+</o:gupdate>
+"""
+
+# Update request based on Omaha v3 protocol format.
+_UPDATE_REQUEST_V3 = """<?xml version="1.0" encoding="UTF-8"?>
+<request version="ChromeOSUpdateEngine-0.1.0.0" updaterversion="ChromeOSUpdateEngine-0.1.0.0" protocol="3.0" ismachine="1">
+    <os version="Indy" platform="Chrome OS" sp="0.11.254.2011_03_09_1814_i686"></os>
+    <app appid="{DEV-BUILD}" version="0.11.254.2011_03_09_1814" lang="en-US" track="developer-build" board="x86-generic" hardware_class="BETA DVT" delta_okay="true">
+        <updatecheck></updatecheck>
+        <event eventtype="3" eventresult="2" previousversion="0.11.216.2011_03_02_1358"></event>
+    </app>
+</request>
+"""
+
+_PING_REQUEST_V3 = """<?xml version="1.0" encoding="UTF-8"?>
+<request protocol="3.0">
+    <app appid="{DEV-BUILD}" version="1.2.3">
+        <ping active="1"></ping>
+    </app>
+</request>
+"""
+
+# Number of requests parsed by the parsing benchmark, which only runs if this
+# environment variable is set, e.g. to 2000.
+PARSE_BENCHMARK_ITERATIONS_ENV = 'DEVSERVER_PARSE_BENCHMARK_ITERATIONS'
+
+
+def _MinidomParseUpdateRequest(request_string):
+  """The DOM-based request parsing ParseUpdateRequest used to perform."""
+  request_dom = minidom.parseString(request_string)
+  protocol = request_dom.firstChild.getAttribute('protocol')
+  prefix = 'o:' if protocol == '2.0' else ''
+  app = request_dom.firstChild.getElementsByTagName(prefix + 'app')[0]
+  event = request_dom.getElementsByTagName(prefix + 'event')
+  update_check = request_dom.getElementsByTagName(prefix + 'updatecheck')
+  return protocol, app, event, update_check
+
+
+class ParseUpdateRequestTest(unittest.TestCase):
+
+  def _VerifyRequest(self, request, protocol):
+    self.assertEqual(request.protocol, protocol)
+    self.assertEqual(request.app['version'], '0.11.254.2011_03_09_1814')
+    self.assertEqual(request.app['board'], 'x86-generic')
+    self.assertEqual(request.app['appid'], '{DEV-BUILD}')
+    self.assertEqual(request.event['eventtype'], '3')
+    self.assertEqual(request.event['eventresult'], '2')
+    self.assertEqual(request.event['previousversion'],
+                     '0.11.216.2011_03_02_1358')
+    self.assertEqual(request.update_check, {})
+
+  def testParseV2(self):
+    self._VerifyRequest(
+        autoupdate_lib.ParseUpdateRequest(_UPDATE_REQUEST_V2), '2.0')
+
+  def testParseV3(self):
+    self._VerifyRequest(
+        autoupdate_lib.ParseUpdateRequest(_UPDATE_REQUEST_V3), '3.0')
+
+  def testParseNonUpdateCheck(self):
+    request = autoupdate_lib.ParseUpdateRequest(_PING_REQUEST_V3)
+    self.assertEqual(request.app['version'], '1.2.3')
+    self.assertEqual(request.event, None)
+    self.assertEqual(request.update_check, None)
+
+  def testParseStopsEarly(self):
+    # Trailing garbage past the interesting elements is never looked at.
+    request = autoupdate_lib.ParseUpdateRequest(
+        _UPDATE_REQUEST_V3.replace('</app>', '</app><<garbage'))
+    self.assertEqual(request.event['eventtype'], '3')
+
+  def testParseUnknownProtocol(self):
+    self.assertRaises(autoupdate_lib.UnknownProtocolRequestedException,
+                      autoupdate_lib.ParseUpdateRequest,
+                      _UPDATE_REQUEST_V3.replace('"3.0"', '"4.0"'))
+
+  def testParseMalformed(self):
+    self.assertRaises(expat.ExpatError, autoupdate_lib.ParseUpdateRequest,
+                      '<request protocol="3.0"><app>')
+
+  def testParseTooLarge(self):
+    request = _UPDATE_REQUEST_V3.replace(
+        '<os ', '<!-- %s --><os ' % ('x' * autoupdate_lib.MAX_REQUEST_SIZE))
+    self.assertRaises(autoupdate_lib.RequestTooLargeException,
+                      autoupdate_lib.ParseUpdateRequest, request)
+
+
+class ResponseTest(unittest.TestCase):
+
+  def setUp(self):
+    self._seconds = autoupdate_lib.GetSecondsSinceMidnight
+    autoupdate_lib.GetSecondsSinceMidnight = lambda: 1234
+    autoupdate_lib._response_cache.clear()
+
+  def tearDown(self):
+    autoupdate_lib.GetSecondsSinceMidnight = self._seconds
+
+  def _ExpectedUpdateResponse(self, protocol, extra_attr=''):
+    return autoupdate_lib.UPDATE_RESPONSE[protocol] % {
+        'time_elapsed': 1234, 'appid': autoupdate_lib.APP_ID,
+        'sha1': 'abc', 'sha256': 'def', 'size': 42,
+        'url': 'http://host/static/update.gz',
+        'codebase': 'http://host/static', 'filename': 'update.gz',
+        'is_delta_format': False, 'extra_attr': extra_attr}
+
+  def testGetUpdateResponse(self):
+    for protocol in autoupdate_lib.SUPPORTED_PROTOCOLS:
+      for _ in range(2):
+        self.assertEqual(
+            autoupdate_lib.GetUpdateResponse(
+                'abc', 'def', 42, 'http://host/static/update.gz', False,
+                protocol),
+            self._ExpectedUpdateResponse(protocol))
+    self.assertEqual(len(autoupdate_lib._response_cache), 2)
+
+  def testGetUpdateResponseCritical(self):
+    response = autoupdate_lib.GetUpdateResponse(
+        'abc', 'def', 42, 'http://host/static/update.gz', False, '3.0',
+        critical_update=True)
+    self.assertTrue('deadline="' in response)
+    self.assertFalse('deadline="' in autoupdate_lib.GetUpdateResponse(
+        'abc', 'def', 42, 'http://host/static/update.gz', False, '3.0'))
+
+  def testGetUpdateResponseTimeElapsed(self):
+    autoupdate_lib.GetUpdateResponse(
+        'abc', 'def', 42, 'http://host/static/update.gz', False, '2.0')
+    autoupdate_lib.GetSecondsSinceMidnight = lambda: 5678
+    response = autoupdate_lib.GetUpdateResponse(
+        'abc', 'def', 42, 'http://host/static/update.gz', False, '2.0')
+    self.assertTrue('elapsed_seconds="5678"' in response)
+
+  def testGetNoUpdateResponse(self):
+    for protocol in autoupdate_lib.SUPPORTED_PROTOCOLS:
+      self.assertEqual(
+          autoupdate_lib.GetNoUpdateResponse(protocol),
+          autoupdate_lib.NO_UPDATE_RESPONSE[protocol] % {
+              'time_elapsed': 1234, 'appid': autoupdate_lib.APP_ID})
+
+
+class ParseUpdateRequestBenchmark(unittest.TestCase):
+  """Compares the streaming parser against the former minidom parser."""
+
+  def setUp(self):
+    iterations = os.environ.get(PARSE_BENCHMARK_ITERATIONS_ENV)
+    if not iterations:
+      self.skipTest('set %s to run' % PARSE_BENCHMARK_ITERATIONS_ENV)
+    self._iterations = int(iterations)
+
+  def _Benchmark(self, request_string):
+    minidom_secs = timeit.timeit(
+        lambda: _MinidomParseUpdateRequest(request_string),
+        number=self._iterations)
+    expat_secs = timeit.timeit(
+        lambda: autoupdate_lib.ParseUpdateRequest(request_string),
+        number=self._iterations)
+    sys.stderr.write(
+        '\n%d requests: minidom %.3fs, expat %.3fs (%.1fx)\n' %
+        (self._iterations, minidom_secs, expat_secs,
+         minidom_secs / expat_secs))
+
+  def testBenchmarkV2(self):
+    self._Benchmark(_UPDATE_REQUEST_V2)
+
+  def testBenchmarkV3(self):
+    self._Benchmark(_UPDATE_REQUEST_V3)
+
+
+if __name__ == '__main__':
+  unittest.main()
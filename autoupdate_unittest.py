@@ -22,7 +22,7 @@ import common_util
 
 _TEST_REQUEST = """
 <client_test xmlns:o="http://www.google.com/update2/request" updaterversion="%(client)s" protocol="3.0">
-  <app version="%(version)s" track="%(track)s" board="%(board)s" />
+  <app appid="{%(appid)s}" version="%(version)s" track="%(track)s" board="%(board)s" />
   <updatecheck />
   <event eventresult="%(event_result)d" eventtype="%(event_type)d" />
 </client_test>"""
@@ -32,8 +32,7 @@ class AutoupdateTest(mox.MoxTestBase):
   def setUp(self):
     mox.MoxTestBase.setUp(self)
     self.mox.StubOutWithMock(common_util, 'GetFileSize')
-    self.mox.StubOutWithMock(common_util, 'GetFileSha1')
-    self.mox.StubOutWithMock(common_util, 'GetFileSha256')
+    self.mox.StubOutWithMock(common_util, 'GetFileSha1AndSha256')
     self.mox.StubOutWithMock(autoupdate_lib, 'GetUpdateResponse')
     self.mox.StubOutWithMock(autoupdate.Autoupdate, '_GetLatestImageDir')
     self.mox.StubOutWithMock(autoupdate.Autoupdate, '_GetRemotePayloadAttrs')
@@ -50,7 +49,8 @@ class AutoupdateTest(mox.MoxTestBase):
         'track': 'unused_var',
         'board': self.test_board,
         'event_result': 2,
-        'event_type': 3
+        'event_type': 3,
+        'appid': autoupdate_lib.APP_ID,
     }
     self.test_data = _TEST_REQUEST % self.test_dict
     self.forced_image_path = '/path_to_force/flatcar_developer_image.bin'
@@ -102,12 +102,14 @@ class AutoupdateTest(mox.MoxTestBase):
     au_mock.GenerateUpdateImageWithCache(
         os.path.join(self.build_root, self.test_board, self.latest_dir,
                      'flatcar_developer_image.bin'),
-        static_image_dir=self.static_image_dir).AndReturn('update.gz')
+        static_image_dir=self.static_image_dir,
+        legacy_image=True).AndReturn('update.gz')
 
     self.mox.ReplayAll()
     self.assertTrue(au_mock.GenerateLatestUpdateImage(self.test_board,
                                                       'ForcedUpdate',
-                                                      self.static_image_dir))
+                                                      self.static_image_dir,
+                                                      True))
     self.mox.VerifyAll()
 
   def testHandleUpdatePingForForcedImage(self):
@@ -124,15 +126,15 @@ class AutoupdateTest(mox.MoxTestBase):
 
     au_mock.GenerateUpdateImageWithCache(
         self.forced_image_path,
-        static_image_dir=self.static_image_dir).AndReturn(None)
-    common_util.GetFileSha1(os.path.join(
-        self.static_image_dir, 'update.gz')).AndReturn(self.sha1)
-    common_util.GetFileSha256(os.path.join(
-        self.static_image_dir, 'update.gz')).AndReturn(self.sha256)
+        static_image_dir=self.static_image_dir,
+        legacy_image=True).AndReturn(None)
+    common_util.GetFileSha1AndSha256(os.path.join(
+        self.static_image_dir, 'update.gz')).AndReturn(
+            (self.sha1, self.sha256))
     common_util.GetFileSize(os.path.join(
         self.static_image_dir, 'update.gz')).AndReturn(self.size)
     au_mock._StoreMetadataToFile(self.static_image_dir,
-                                 mox.IsA(autoupdate.UpdateMetadata))
+                                 mox.IsA(autoupdate.UpdateMetadata), True)
     autoupdate_lib.GetUpdateResponse(
         self.sha1, self.sha256, self.size, self.url, False, '3.0',
         False).AndReturn(self.payload)
@@ -155,15 +157,15 @@ class AutoupdateTest(mox.MoxTestBase):
       fh.write('')
 
     au_mock.GenerateLatestUpdateImage(
-        self.test_board, 'ForcedUpdate', self.static_image_dir).AndReturn(None)
-    common_util.GetFileSha1(os.path.join(
-        self.static_image_dir, 'update.gz')).AndReturn(self.sha1)
-    common_util.GetFileSha256(os.path.join(
-        self.static_image_dir, 'update.gz')).AndReturn(self.sha256)
+        self.test_board, 'ForcedUpdate', self.static_image_dir,
+        True).AndReturn(None)
+    common_util.GetFileSha1AndSha256(os.path.join(
+        self.static_image_dir, 'update.gz')).AndReturn(
+            (self.sha1, self.sha256))
     common_util.GetFileSize(os.path.join(
         self.static_image_dir, 'update.gz')).AndReturn(self.size)
     au_mock._StoreMetadataToFile(self.static_image_dir,
-                                 mox.IsA(autoupdate.UpdateMetadata))
+                                 mox.IsA(autoupdate.UpdateMetadata), True)
     autoupdate_lib.GetUpdateResponse(
         self.sha1, self.sha256, self.size, self.url, False, '3.0',
         False).AndReturn(self.payload)
@@ -229,7 +231,7 @@ class AutoupdateTest(mox.MoxTestBase):
     new_url = self.url.replace('update.gz', test_label + '/update.gz')
 
     au_mock.GenerateLatestUpdateImage(
-        self.test_board, 'ForcedUpdate', new_image_dir).AndReturn(None)
+        self.test_board, 'ForcedUpdate', new_image_dir, True).AndReturn(None)
 
     # Generate a fake payload.
     os.makedirs(new_image_dir)
@@ -237,14 +239,12 @@ class AutoupdateTest(mox.MoxTestBase):
     with open(update_gz, 'w') as fh:
       fh.write('')
 
-    common_util.GetFileSha1(os.path.join(
-        new_image_dir, 'update.gz')).AndReturn(self.sha1)
-    common_util.GetFileSha256(os.path.join(
-        new_image_dir, 'update.gz')).AndReturn(self.sha256)
+    common_util.GetFileSha1AndSha256(os.path.join(
+        new_image_dir, 'update.gz')).AndReturn((self.sha1, self.sha256))
     common_util.GetFileSize(os.path.join(
         new_image_dir, 'update.gz')).AndReturn(self.size)
     au_mock._StoreMetadataToFile(new_image_dir,
-                                 mox.IsA(autoupdate.UpdateMetadata))
+                                 mox.IsA(autoupdate.UpdateMetadata), True)
     autoupdate_lib.GetUpdateResponse(
         self.sha1, self.sha256, self.size, new_url, False, '3.0',
         False).AndReturn(self.payload)
@@ -259,6 +259,24 @@ class AutoupdateTest(mox.MoxTestBase):
     self.assertFalse('forced_update_label' in
         au_mock.host_infos.GetHostInfo('127.0.0.1').attrs)
 
+  def testHandleHostLogPing(self):
+    au_mock = self._DummyAutoupdateConstructor(host_log=True)
+    for ip, version in (('1.1.1.1', 'a'), ('2.2.2.2', 'b'), ('1.1.1.1', 'c')):
+      au_mock.host_infos.RecordRequest(ip, {}, {'version': version})
+
+    log = json.loads(au_mock.HandleHostLogPing('1.1.1.1'))
+    self.assertEqual([e['version'] for e in log], ['a', 'c'])
+    self.assertEqual(json.loads(au_mock.HandleHostLogPing('3.3.3.3')), [])
+    self.assertEqual(
+        sorted(json.loads(au_mock.HandleHostLogPing('all', limit=2))),
+        ['1.1.1.1', '2.2.2.2'])
+
+    lines = list(au_mock.HandleHostLogPing('all', 'ndjson', cursor=1))
+    events = [json.loads(line) for line in lines]
+    self.assertTrue(all(line.endswith('\n') for line in lines))
+    self.assertEqual([(e['ip'], e['version'], e['seq']) for e in events],
+                     [('2.2.2.2', 'b', 2), ('1.1.1.1', 'c', 3)])
+
   def testGetVersionFromDir(self):
     au = self._DummyAutoupdateConstructor()
 
@@ -272,6 +290,33 @@ class AutoupdateTest(mox.MoxTestBase):
         au._GetVersionFromDir('/foo/x86-alex/0.15.938.2011_08_23_0941-a1'),
         '0.15.938.2011_08_23_0941')
 
+  def testGetVersionFromDirCached(self):
+    au = self._DummyAutoupdateConstructor()
+    image_dir = os.path.join(self.static_image_dir, 'R16-1102.0.0-a1')
+    os.mkdir(image_dir)
+    version_file = os.path.join(image_dir, 'version.txt')
+
+    def _WriteVersion(version):
+      with open(version_file, 'w') as f:
+        f.write('FLATCAR_VERSION=%s' % version)
+      os.utime(version_file, (1000, 1000))
+
+    _WriteVersion('1102.0.0')
+    self.assertEqual(au._GetVersionFromDir(image_dir), '1102.0.0')
+    # The file is only read again once its size or mtime changes.
+    _WriteVersion('1109.0.0')
+    self.assertEqual(au._GetVersionFromDir(image_dir), '1102.0.0')
+    _WriteVersion('"1103.0.0"')
+    self.assertEqual(au._GetVersionFromDir(image_dir), '1103.0.0')
+
+  def testVersionParse(self):
+    version = autoupdate.Version.Parse('1098.0.2011_09_28_1635')
+    self.assertEqual(version, (1098, 0, 2011, 9, 28, 1635))
+    self.assertTrue(autoupdate.Version.Parse('1098.0.2011_09_28_1635')
+                    is version)
+    self.assertTrue(version < autoupdate.Version.Parse('1100.0.0'))
+    self.assertEqual(autoupdate.Version.Parse('ForcedUpdate'), ())
+
   def testCanUpdate(self):
     au = self._DummyAutoupdateConstructor()
 
@@ -298,6 +343,61 @@ class AutoupdateTest(mox.MoxTestBase):
     self.assertTrue(au._CanUpdate('0.16.892.0', '0.16.892.1'))
     self.assertFalse(au._CanUpdate('0.16.892.0', '0.16.892.0'))
 
+  def testGetLocalPayloadAttrsIndexed(self):
+    au = self._DummyAutoupdateConstructor()
+    update_gz = os.path.join(self.static_image_dir, autoupdate.UPDATE_FILE)
+    with open(update_gz, 'w') as fh:
+      fh.write('payload')
+    metadata = autoupdate.UpdateMetadata(self.sha1, self.sha256, self.size,
+                                         False)
+    au._StoreMetadataToFile(self.static_image_dir, metadata, True)
+
+    self.mox.ReplayAll()
+    for _ in range(3):
+      metadata_obj = au.GetLocalPayloadAttrs(self.static_image_dir, True)
+      self.assertEqual(metadata_obj.sha256, self.sha256)
+    self.assertEqual(au.payload_index.Stats(),
+                     {'entries': 1, 'hits': 2, 'misses': 1, 'rehashes': 0})
+
+    # A replaced payload is noticed even if its metadata file is not touched.
+    with open(update_gz, 'w') as fh:
+      fh.write('new payload')
+    au.GetLocalPayloadAttrs(self.static_image_dir, True)
+    self.assertEqual(au.payload_index.misses, 2)
+    self.mox.VerifyAll()
+
+  def testGetLocalPayloadAttrsPublishedPayloadThenMetadata(self):
+    au = self._DummyAutoupdateConstructor()
+    update_gz = os.path.join(self.static_image_dir, autoupdate.UPDATE_FILE)
+    metadata_file = os.path.join(self.static_image_dir,
+                                 autoupdate.METADATA_FILE)
+    new_dir = os.path.join(self.static_image_dir, 'new')
+    os.mkdir(new_dir)
+    with open(update_gz, 'w') as fh:
+      fh.write('payload')
+    au._StoreMetadataToFile(
+        self.static_image_dir,
+        autoupdate.UpdateMetadata('old1', 'old256', 7, False), True)
+    with open(os.path.join(new_dir, autoupdate.UPDATE_FILE), 'w') as fh:
+      fh.write('new payload')
+    au._StoreMetadataToFile(
+        new_dir, autoupdate.UpdateMetadata('new1', 'new256', 11, False), True)
+
+    self.mox.ReplayAll()
+    self.assertEqual(
+        au.GetLocalPayloadAttrs(self.static_image_dir, True).sha256, 'old256')
+    # A ping between the payload and its metadata being published gets the
+    # old metadata...
+    os.rename(os.path.join(new_dir, autoupdate.UPDATE_FILE), update_gz)
+    self.assertEqual(
+        au.GetLocalPayloadAttrs(self.static_image_dir, True).sha256, 'old256')
+    # ...but not once the metadata is published too.
+    os.rename(os.path.join(new_dir, autoupdate.METADATA_FILE), metadata_file)
+    self.assertEqual(
+        au.GetLocalPayloadAttrs(self.static_image_dir, True).sha256, 'new256')
+    self.assertEqual(au.payload_index.misses, 3)
+    self.mox.VerifyAll()
+
   def testHandleUpdatePingRemotePayload(self):
     self.skipTest("broken, don't care")
     self.mox.StubOutWithMock(autoupdate.Autoupdate, '_GetRemotePayloadAttrs')
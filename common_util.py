@@ -6,19 +6,28 @@
 
 import base64
 import binascii
+import bisect
+import collections
+import contextlib
 import distutils.version
 import errno
+import fcntl
 import hashlib
+import json
+import multiprocessing.pool
 import os
+import Queue
 import random
 import re
 import shutil
+import threading
 import time
 
 import lockfile
 
 import gsutil_util
 import log_util
+import metrics
 
 
 # Module-local log function.
@@ -32,7 +41,18 @@ MTON_DIR_SUFFIX = '_mton'
 UPLOADED_LIST = 'UPLOADED'
 DEVSERVER_LOCK_FILE = 'devserver'
 
-_HASH_BLOCK_SIZE = 8192
+# Files are hashed in blocks of this size. Hashing such large blocks releases
+# the GIL, so several digests of a file can be computed in parallel threads.
+_HASH_BLOCK_SIZE = 1024 * 1024
+
+# Number of blocks read ahead of the slowest digest thread.
+_HASH_QUEUE_DEPTH = 8
+
+# Files smaller than this are hashed without spawning threads.
+_PARALLEL_HASH_MIN_SIZE = 4 * _HASH_BLOCK_SIZE
+
+# Number of files hashed concurrently by GetFilesHashes.
+_HASH_BATCH_WORKERS = 4
 
 
 def CommaSeparatedList(value_list, is_quoted=False):
@@ -57,6 +77,78 @@ class CommonUtilError(Exception):
   pass
 
 
+class SingleFlightTimeout(CommonUtilError):
+  """Raised when waiting on work done by another caller takes too long."""
+  pass
+
+
+class SingleFlight(object):
+  """Coalesces concurrent calls which would perform the same work.
+
+  The first caller for a key runs the work, while concurrent callers for the
+  same key wait for and share its outcome instead of repeating it. Calls for
+  different keys proceed in parallel.  Usage:
+
+    foo_flight = SingleFlight()
+    ...
+    result = foo_flight.Do('bar', DoBar, timeout=30)
+  """
+
+  class _Call(object):
+    """The outcome of an in-flight call."""
+
+    def __init__(self):
+      self.done = threading.Event()
+      self.result = None
+      self.error = None
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._calls = {}
+
+  def InFlight(self, key):
+    """Returns True iff work for key is currently being done."""
+    return key in self._calls
+
+  def Do(self, key, func, timeout=None):
+    """Runs func, unless it is already running for key.
+
+    Args:
+      key: hashable identifier of the work done by func.
+      func: callable doing the work, called without arguments.
+      timeout: seconds to wait on another caller's work; None waits forever.
+    Returns:
+      The value returned by func, in this or the concurrent caller.
+    Raises:
+      SingleFlightTimeout: if another caller's work did not finish in time.
+      Any exception raised by func, in this or the concurrent caller.
+    """
+    with self._lock:
+      call = self._calls.get(key)
+      is_leader = call is None
+      if is_leader:
+        call = self._Call()
+        self._calls[key] = call
+
+    if not is_leader:
+      call.done.wait(timeout)
+      if not call.done.is_set():
+        raise SingleFlightTimeout('Timed out waiting for %s' % (key,))
+      if call.error:
+        raise call.error
+      return call.result
+
+    try:
+      call.result = func()
+      return call.result
+    except Exception as e:
+      call.error = e
+      raise
+    finally:
+      with self._lock:
+        del self._calls[key]
+      call.done.set()
+
 
 def SafeSandboxAccess(static_dir, path):
   """Verify that the path is in static_dir.
@@ -151,6 +243,135 @@ def ReleaseLock(static_dir, tag, destroy=False):
     raise CommonUtilError(str(e))
 
 
+@contextlib.contextmanager
+def HoldLock(static_dir, tag, timeout=None, poll_interval=0.1):
+  """Holds the lock for a given tag, waiting for it to be released if needed.
+
+  Unlike AcquireLock, which fails if the lock is held, this waits for other
+  processes using the same lock to release it, so that it can be used to
+  serialize work across devserver processes. Usage:
+
+    with HoldLock(static_dir, 'cache/foo.lock', timeout=30):
+      # Critical section for 'cache/foo', in all processes.
+
+  The lock is an flock of a file in the tag's directory, which the kernel
+  releases if the process holding it dies.
+
+  Args:
+    static_dir:    Directory where builds are served from.
+    tag:           Unique resource/task identifier. Use '/' for nested tags.
+    timeout:       Seconds to wait for the lock; None waits forever.
+    poll_interval: Seconds between attempts to acquire the lock.
+
+  Raises:
+    SingleFlightTimeout: If the lock was not released in time.
+    CommonUtilError: If the tag is invalid.
+  """
+  lock_dir = os.path.join(static_dir, tag)
+  if not SafeSandboxAccess(static_dir, lock_dir):
+    raise CommonUtilError('Invalid tag "%s".' % tag)
+  try:
+    os.makedirs(lock_dir)
+  except OSError as e:
+    if e.errno != errno.EEXIST:
+      raise
+  deadline = None if timeout is None else time.time() + timeout
+  fd = os.open(os.path.join(lock_dir, DEVSERVER_LOCK_FILE),
+               os.O_RDWR | os.O_CREAT, 0644)
+  try:
+    while True:
+      try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        break
+      except IOError as e:
+        if e.errno not in (errno.EAGAIN, errno.EACCES):
+          raise
+        if deadline is not None and time.time() >= deadline:
+          raise SingleFlightTimeout('Timed out waiting for lock %s' % tag)
+        time.sleep(poll_interval)
+    yield
+  finally:
+    # Closing the file releases the lock.
+    os.close(fd)
+
+
+# Canonical milestone names, which are indexed.
+_MILESTONE_RE = re.compile(r'R\d+(?!\d)')
+
+
+class _BuildIndex(object):
+  """Sorted versions of the builds of a target.
+
+  Members:
+    stat_key:   (mtime, nlink, inode) of the target directory when indexed.
+    versions:   LooseVersion of every build, sorted.
+    milestones: sorted LooseVersion lists of the builds of each milestone
+                named in the build, keyed by milestone (e.g. 'R16').
+  """
+  __slots__ = ('stat_key', 'versions', 'milestones')
+
+  def __init__(self):
+    self.stat_key = None
+    self.versions = []
+    self.milestones = {}
+
+  def Update(self, builds):
+    """Adds and removes builds so that the index matches the given ones."""
+    old_builds = set(str(v) for v in self.versions)
+    removed = old_builds - builds
+    if removed:
+      self.versions = [v for v in self.versions if str(v) not in removed]
+      for milestone, versions in self.milestones.items():
+        versions = [v for v in versions if str(v) not in removed]
+        if versions:
+          self.milestones[milestone] = versions
+        else:
+          del self.milestones[milestone]
+    for build in builds - old_builds:
+      version = distutils.version.LooseVersion(build)
+      bisect.insort(self.versions, version)
+      for milestone in set(_MILESTONE_RE.findall(build)):
+        bisect.insort(self.milestones.setdefault(milestone, []), version)
+
+
+# Build indexes of targets, keyed by target path.
+_build_indexes = {}
+_build_index_lock = threading.Lock()
+_build_index_stats = {'hits': 0, 'invalidations': 0}
+
+
+def GetBuildIndexStats():
+  """Returns a dictionary of build index counters.
+
+  hits counts lookups answered from an up-to-date index, invalidations those
+  for which the builds of a target had to be listed again.
+  """
+  with _build_index_lock:
+    return dict(_build_index_stats, targets=len(_build_indexes))
+
+
+def _GetBuildIndex(target_path):
+  """Returns the up-to-date build index of a target directory.
+
+  The index is refreshed whenever the directory's mtime, link count or inode
+  changes, which happens whenever a build is added or removed; only builds
+  that changed are parsed.
+  """
+  st = os.stat(target_path)
+  stat_key = (st.st_mtime, st.st_nlink, st.st_ino)
+  with _build_index_lock:
+    index = _build_indexes.get(target_path)
+    if index is None:
+      index = _build_indexes[target_path] = _BuildIndex()
+    if index.stat_key == stat_key:
+      _build_index_stats['hits'] += 1
+    else:
+      _build_index_stats['invalidations'] += 1
+      index.Update(set(os.listdir(target_path)))
+      index.stat_key = stat_key
+    return index
+
+
 def GetLatestBuildVersion(static_dir, target, milestone=None):
   """Retrieves the latest build version for a given board.
 
@@ -174,17 +395,65 @@ def GetLatestBuildVersion(static_dir, target, milestone=None):
   if not os.path.isdir(target_path):
     raise CommonUtilError('Cannot find path %s' % target_path)
 
-  builds = [distutils.version.LooseVersion(build) for build in
-            os.listdir(target_path)]
-
-  if milestone and builds:
-    # Check if milestone Rxx is in the string representation of the build.
-    builds = filter(lambda x: milestone.upper() in str(x), builds)
+  index = _GetBuildIndex(target_path)
+  builds = index.versions
+  if milestone:
+    milestone = milestone.upper()
+    if _MILESTONE_RE.findall(milestone) == [milestone]:
+      builds = index.milestones.get(milestone, [])
+    else:
+      # Not a milestone we index; check if it is in the string
+      # representation of the builds, newest first.
+      builds = [build for build in reversed(builds)
+                if milestone in str(build)][:1]
 
   if not builds:
     raise CommonUtilError('Could not determine build for %s' % target)
 
-  return str(max(builds))
+  return str(builds[-1])
+
+
+# Number of builds whose control file catalogs are cached.
+_CONTROL_CATALOGS_CACHED = 32
+
+# Number of control files whose contents are cached.
+_CONTROL_FILES_CACHED = 512
+
+
+class _LRUCache(object):
+  """A thread-safe dictionary evicting its least recently used entries."""
+
+  def __init__(self, max_entries):
+    self._max_entries = max_entries
+    self._lock = threading.Lock()
+    self._entries = collections.OrderedDict()
+
+  def Get(self, key):
+    """Returns the value of key and marks it recently used, or None."""
+    with self._lock:
+      value = self._entries.pop(key, None)
+      if value is not None:
+        self._entries[key] = value
+      return value
+
+  def Put(self, key, value):
+    with self._lock:
+      self._entries.pop(key, None)
+      self._entries[key] = value
+      while len(self._entries) > self._max_entries:
+        self._entries.popitem(last=False)
+
+
+# Sorted control file lists, and control file contents, keyed by path and
+# validated by the (mtime, size, inode) of the path, or of each directory the
+# list was read from.
+_control_catalogs = _LRUCache(_CONTROL_CATALOGS_CACHED)
+_control_files = _LRUCache(_CONTROL_FILES_CACHED)
+
+
+def _GetStatKey(path):
+  st = os.stat(path)
+  return st.st_mtime, st.st_size, st.st_ino
 
 
 def GetControlFile(static_dir, build, control_path):
@@ -208,45 +477,102 @@ def GetControlFile(static_dir, build, control_path):
   if not SafeSandboxAccess(static_dir, control_path):
     raise CommonUtilError('Invalid control file "%s".' % control_path)
 
-  if not os.path.exists(control_path):
+  try:
+    stat_key = _GetStatKey(control_path)
+  except OSError:
     # TODO(scottz): Come up with some sort of error mechanism.
     # crosbug.com/25040
     return 'Unknown control path %s' % control_path
 
+  cached = _control_files.Get(control_path)
+  if cached and cached[0] == stat_key:
+    return cached[1]
+
   with open(control_path, 'r') as control_file:
-    return control_file.read()
+    content = control_file.read()
+  _control_files.Put(control_path, (stat_key, content))
+  return content
+
+
+def _DirsUnchanged(dir_keys):
+  """Returns whether the directories of dir_keys still have those stat keys."""
+  try:
+    return all(_GetStatKey(dir_path) == stat_key
+               for dir_path, stat_key in dir_keys.iteritems())
+  except OSError:
+    return False
+
 
+def _GetControlFileCatalog(autotest_dir):
+  """Returns the sorted paths of control files relative to autotest_dir.
+
+  The catalog is built by walking autotest_dir once, and rebuilt only if one
+  of the walked directories changes, e.g. because control files were added
+  to or removed from it, or because the build was staged again.
+  """
+  cached = _control_catalogs.Get(autotest_dir)
+  if cached and _DirsUnchanged(cached[0]):
+    return cached[1]
+
+  # Directories are stat'ed before they are listed, so that changes made
+  # during the walk invalidate the catalog on the next call.
+  dir_keys = {autotest_dir: _GetStatKey(autotest_dir)}
+  control_files = []
+  for dir_path, dirs, files in os.walk(autotest_dir):
+    for dir_entry in dirs:
+      sub_dir = os.path.join(dir_path, dir_entry)
+      try:
+        dir_keys[sub_dir] = _GetStatKey(sub_dir)
+      except OSError:
+        pass
+    rel_dir = os.path.relpath(dir_path, autotest_dir)
+    for file_entry in files:
+      if file_entry.startswith('control.') or file_entry == 'control':
+        control_files.append(file_entry if rel_dir == os.curdir
+                             else os.path.join(rel_dir, file_entry))
+  control_files.sort()
+  _control_catalogs.Put(autotest_dir, (dir_keys, control_files))
+  return control_files
 
-def GetControlFileList(static_dir, build):
+
+def GetControlFileList(static_dir, build, prefix=None, as_json=False):
   """List all control|control. files in the specified board/build path.
 
   Args:
     static_dir: Directory where builds are served from.
     build: Fully qualified build string; e.g. R17-1234.0.0-a1-b983.
+    prefix: If set, only list control files whose path starts with it.
+    as_json: Whether to return a JSON list rather than lines.
 
   Raises:
     CommonUtilError: If path is outside of sandbox.
 
   Returns:
-    String of each file separated by a newline.
+    String of each file separated by a newline, in sorted order, or a JSON
+    encoded list of them.
   """
   autotest_dir = os.path.join(static_dir, build, 'autotest/')
   if not SafeSandboxAccess(static_dir, autotest_dir):
     raise CommonUtilError('Autotest dir not in sandbox "%s".' % autotest_dir)
 
-  control_files = set()
   if not os.path.exists(autotest_dir):
     # TODO(scottz): Come up with some sort of error mechanism.
     # crosbug.com/25040
     return 'Unknown build path %s' % autotest_dir
 
-  for entry in os.walk(autotest_dir):
-    dir_path, _, files = entry
-    for file_entry in files:
-      if file_entry.startswith('control.') or file_entry == 'control':
-        control_files.add(os.path.join(dir_path,
-                                       file_entry).replace(autotest_dir, ''))
-
+  control_files = _GetControlFileCatalog(autotest_dir)
+  if prefix:
+    prefix = prefix.lstrip('/')
+    # The catalog is sorted, so matching paths are contiguous.
+    start = bisect.bisect_left(control_files, prefix)
+    end = start
+    while (end < len(control_files) and
+           control_files[end].startswith(prefix)):
+      end += 1
+    control_files = control_files[start:end]
+
+  if as_json:
+    return json.dumps(control_files)
   return '\n'.join(control_files)
 
 
@@ -255,12 +581,21 @@ def GetFileSize(file_path):
   return os.path.getsize(file_path)
 
 
+def _UpdateHasherFromQueue(hasher, block_queue):
+  """Feeds blocks from block_queue to hasher until a None block is read."""
+  for block in iter(block_queue.get, None):
+    hasher.update(block)
+
+
 # Hashlib is strange and doesn't actually define these in a sane way that
 # pylint can find them. Disable checks for them.
-# pylint: disable=E1101,W0106
+# pylint: disable=E1101
 def GetFileHashes(file_path, do_sha1=False, do_sha256=False, do_md5=False):
   """Computes and returns a list of requested hashes.
 
+  The file is read only once, regardless of the number of hashes requested.
+  For large files each digest is computed by its own thread.
+
   Args:
     file_path: path to file to be hashed
     do_sha1:   whether or not to compute a SHA1 hash
@@ -270,32 +605,74 @@ def GetFileHashes(file_path, do_sha1=False, do_sha256=False, do_md5=False):
     A dictionary containing binary hash values, keyed by 'sha1', 'sha256' and
     'md5', respectively.
   """
-  hashes = {}
-  if (do_sha1 or do_sha256 or do_md5):
-    # Initialize hashers.
-    hasher_sha1 = hashlib.sha1() if do_sha1 else None
-    hasher_sha256 = hashlib.sha256() if do_sha256 else None
-    hasher_md5 = hashlib.md5() if do_md5 else None
-
-    # Read blocks from file, update hashes.
-    with open(file_path, 'rb') as fd:
-      while True:
-        block = fd.read(_HASH_BLOCK_SIZE)
-        if not block:
-          break
-        hasher_sha1 and hasher_sha1.update(block)
-        hasher_sha256 and hasher_sha256.update(block)
-        hasher_md5 and hasher_md5.update(block)
-
-    # Update return values.
-    if hasher_sha1:
-      hashes['sha1'] = hasher_sha1.digest()
-    if hasher_sha256:
-      hashes['sha256'] = hasher_sha256.digest()
-    if hasher_md5:
-      hashes['md5'] = hasher_md5.digest()
-
-  return hashes
+  hashers = {}
+  if do_sha1:
+    hashers['sha1'] = hashlib.sha1()
+  if do_sha256:
+    hashers['sha256'] = hashlib.sha256()
+  if do_md5:
+    hashers['md5'] = hashlib.md5()
+  if not hashers:
+    return {}
+
+  with open(file_path, 'rb') as fd, metrics.TimePhase('hashing'):
+    if (len(hashers) == 1 or
+        os.fstat(fd.fileno()).st_size < _PARALLEL_HASH_MIN_SIZE):
+      # Read blocks from file, update hashes.
+      for block in iter(lambda: fd.read(_HASH_BLOCK_SIZE), ''):
+        for hasher in hashers.itervalues():
+          hasher.update(block)
+    else:
+      # Hand each block to one thread per hash.
+      queues = []
+      threads = []
+      for hasher in hashers.itervalues():
+        block_queue = Queue.Queue(_HASH_QUEUE_DEPTH)
+        thread = threading.Thread(target=_UpdateHasherFromQueue,
+                                  args=(hasher, block_queue))
+        thread.daemon = True
+        thread.start()
+        queues.append(block_queue)
+        threads.append(thread)
+      try:
+        for block in iter(lambda: fd.read(_HASH_BLOCK_SIZE), ''):
+          for block_queue in queues:
+            block_queue.put(block)
+      finally:
+        for block_queue in queues:
+          block_queue.put(None)
+        for thread in threads:
+          thread.join()
+
+  return dict((name, hasher.digest()) for name, hasher in hashers.iteritems())
+
+
+def GetFilesHashes(file_paths, do_sha1=False, do_sha256=False, do_md5=False):
+  """Computes the requested hashes of several files concurrently.
+
+  Args:
+    file_paths: list of paths to files to be hashed
+    do_sha1:   whether or not to compute SHA1 hashes
+    do_sha256: whether or not to compute SHA256 hashes
+    do_md5:    whether or not to compute MD5 hashes
+  Returns:
+    A dictionary mapping each file path to a dictionary of binary hash values,
+    as returned by GetFileHashes.
+  """
+  if not file_paths:
+    return {}
+
+  pool = multiprocessing.pool.ThreadPool(
+      min(_HASH_BATCH_WORKERS, len(file_paths)))
+  try:
+    results = pool.map(
+        lambda path: GetFileHashes(path, do_sha1=do_sha1, do_sha256=do_sha256,
+                                   do_md5=do_md5),
+        file_paths)
+  finally:
+    pool.close()
+    pool.join()
+  return dict(zip(file_paths, results))
 
 
 def GetFileSha1(file_path):
@@ -308,6 +685,15 @@ def GetFileSha256(file_path):
   return base64.b64encode(GetFileHashes(file_path, do_sha256=True)['sha256'])
 
 
+def GetFileSha1AndSha256(file_path):
+  """Returns the SHA1 and SHA256 checksums of the file given (base64 encoded).
+
+  Both checksums are computed in a single pass over the file.
+  """
+  hashes = GetFileHashes(file_path, do_sha1=True, do_sha256=True)
+  return base64.b64encode(hashes['sha1']), base64.b64encode(hashes['sha256'])
+
+
 def GetFileMd5(file_path):
   """Returns the MD5 checksum of the file given (hex encoded)."""
   return binascii.hexlify(GetFileHashes(file_path, do_md5=True)['md5'])
@@ -6,10 +6,16 @@
 
 """Unit tests for common_util module."""
 
+import hashlib
+import json
 import os
 import shutil
+import signal
 import subprocess
+import sys
 import tempfile
+import threading
+import time
 import unittest
 
 import mox
@@ -25,6 +31,10 @@ TEST_LAYOUT = {
     'test-board-3': []
 }
 
+# Size in MiB of the file hashed by the hashing benchmark, which only runs if
+# this environment variable is set, e.g. to 4096 for a multi-GB payload.
+HASH_BENCHMARK_SIZE_ENV = 'DEVSERVER_HASH_BENCHMARK_MB'
+
 
 class CommonUtilTest(mox.MoxTestBase):
 
@@ -109,6 +119,52 @@ class CommonUtilTest(mox.MoxTestBase):
                       self._static_dir, 'test-lock')
     common_util.ReleaseLock(self._static_dir, 'test-lock', destroy=True)
 
+  def testHoldLock(self):
+    # Locks are held by threads, like they are by processes.
+    held = threading.Event()
+    release = threading.Event()
+
+    def _Hold():
+      with common_util.HoldLock(self._static_dir, 'test-lock'):
+        held.set()
+        release.wait()
+
+    thread = threading.Thread(target=_Hold)
+    thread.start()
+    held.wait()
+    with self.assertRaises(common_util.SingleFlightTimeout):
+      with common_util.HoldLock(self._static_dir, 'test-lock', timeout=0.2):
+        pass
+
+    # Waits for the lock to be released.
+    timer = threading.Timer(0.2, release.set)
+    timer.start()
+    with common_util.HoldLock(self._static_dir, 'test-lock', timeout=10):
+      self.assertTrue(release.is_set())
+    thread.join()
+    timer.join()
+
+  def testHoldLockOfDeadProcess(self):
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if not pid:
+      with common_util.HoldLock(self._static_dir, 'test-lock'):
+        os.write(write_fd, 'x')
+        time.sleep(60)
+      os._exit(0)
+    os.read(read_fd, 1)
+    os.close(read_fd)
+    os.close(write_fd)
+    with self.assertRaises(common_util.SingleFlightTimeout):
+      with common_util.HoldLock(self._static_dir, 'test-lock', timeout=0.2):
+        pass
+
+    # The lock of a killed process is released.
+    os.kill(pid, signal.SIGKILL)
+    os.waitpid(pid, 0)
+    with common_util.HoldLock(self._static_dir, 'test-lock', timeout=1):
+      pass
+
   def testGetLatestBuildVersion(self):
     self.assertEqual(
         common_util.GetLatestBuildVersion(self._static_dir, 'test-board-1'),
@@ -134,6 +190,41 @@ class CommonUtilTest(mox.MoxTestBase):
         self._static_dir, 'test-board-2', milestone)
     self.assertEqual(expected_build_str, build_str)
 
+  def testGetLatestBuildVersionIndexUpdated(self):
+    """Test that added and removed builds are noticed."""
+    board_path = os.path.join(self._static_dir, 'test-board-2')
+    stats = common_util.GetBuildIndexStats()
+    self.assertEqual(
+        common_util.GetLatestBuildVersion(self._static_dir, 'test-board-2'),
+        'R17-2.0.0-a1-b1346')
+    self.assertEqual(
+        common_util.GetLatestBuildVersion(self._static_dir, 'test-board-2',
+                                          'r16'),
+        'R16-2241.0.0-a0-b2')
+    self.assertEqual(common_util.GetBuildIndexStats()['hits'],
+                     stats['hits'] + 1)
+
+    os.mkdir(os.path.join(board_path, 'R160-1.0.0-a1-b1'))
+    shutil.rmtree(os.path.join(board_path, 'R17-2.0.0-a1-b1346'))
+    self.assertEqual(
+        common_util.GetLatestBuildVersion(self._static_dir, 'test-board-2'),
+        'R160-1.0.0-a1-b1')
+    # Milestones are matched exactly, R16 does not cover R160.
+    self.assertEqual(
+        common_util.GetLatestBuildVersion(self._static_dir, 'test-board-2',
+                                          'R16'),
+        'R16-2241.0.0-a0-b2')
+    self.assertRaises(common_util.CommonUtilError,
+                      common_util.GetLatestBuildVersion,
+                      self._static_dir, 'test-board-2', 'R17')
+    # Other milestone strings fall back to substring matching.
+    self.assertEqual(
+        common_util.GetLatestBuildVersion(self._static_dir, 'test-board-2',
+                                          '2241'),
+        'R16-2241.0.0-a0-b2')
+    self.assertEqual(common_util.GetBuildIndexStats()['invalidations'],
+                     stats['invalidations'] + 2)
+
   def testGetControlFile(self):
     control_file_dir = os.path.join(
         self._static_dir, 'test-board-1', 'R17-1413.0.0-a1-b1346', 'autotest',
@@ -147,5 +238,173 @@ class CommonUtilTest(mox.MoxTestBase):
         os.path.join('server', 'site_tests', 'network_VPN', 'control'))
     self.assertEqual(control_content, 'hello!')
 
+    # Changed control files are read again.
+    with open(os.path.join(control_file_dir, 'control'), 'w') as f:
+      f.write('hello again!')
+    control_content = common_util.GetControlFile(
+        self._static_dir, 'test-board-1/R17-1413.0.0-a1-b1346',
+        os.path.join('server', 'site_tests', 'network_VPN', 'control'))
+    self.assertEqual(control_content, 'hello again!')
+
+  def testGetControlFileList(self):
+    autotest_dir = os.path.join(
+        self._static_dir, 'test-board-1', 'R17-1413.0.0-a1-b1346', 'autotest')
+    control_files = ['client/site_tests/sleeptest/control',
+                     'server/site_tests/network_VPN/control',
+                     'server/site_tests/network_VPN/control.l2tp',
+                     'control']
+    for control_file in control_files + ['server/site_tests/README']:
+      path = os.path.join(autotest_dir, control_file)
+      if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+      open(path, 'w').close()
+
+    build = 'test-board-1/R17-1413.0.0-a1-b1346'
+    self.assertEqual(common_util.GetControlFileList(self._static_dir, build),
+                     '\n'.join(sorted(control_files)))
+    self.assertEqual(
+        json.loads(common_util.GetControlFileList(
+            self._static_dir, build, prefix='/server/', as_json=True)),
+        ['server/site_tests/network_VPN/control',
+         'server/site_tests/network_VPN/control.l2tp'])
+    self.assertEqual(common_util.GetControlFileList(
+        self._static_dir, build, prefix='nothing'), '')
+
+    # Control files added to or removed from nested directories are listed
+    # on the next call, even though the top-level directory is unchanged.
+    for dir_path, _, _ in os.walk(autotest_dir):
+      os.utime(dir_path, (0, 0))
+    self.assertEqual(common_util.GetControlFileList(self._static_dir, build),
+                     '\n'.join(sorted(control_files)))
+    open(os.path.join(autotest_dir, 'server/site_tests/network_VPN/'
+                      'control.pptp'), 'w').close()
+    os.remove(os.path.join(autotest_dir, 'client/site_tests/sleeptest/control'))
+    self.assertEqual(
+        json.loads(common_util.GetControlFileList(
+            self._static_dir, build, as_json=True)),
+        ['control',
+         'server/site_tests/network_VPN/control',
+         'server/site_tests/network_VPN/control.l2tp',
+         'server/site_tests/network_VPN/control.pptp'])
+
+  def testSingleFlight(self):
+    flight = common_util.SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+    results = []
+
+    def _Work():
+      calls.append(1)
+      started.set()
+      release.wait()
+      return 'done'
+
+    def _Do():
+      results.append(flight.Do('key', _Work))
+
+    leader = threading.Thread(target=_Do)
+    leader.start()
+    started.wait()
+    self.assertTrue(flight.InFlight('key'))
+    followers = [threading.Thread(target=_Do) for _ in range(3)]
+    for follower in followers:
+      follower.start()
+    # Give the followers a chance to start waiting on the leader.
+    time.sleep(0.1)
+
+    # Other keys are not held up by the work in flight.
+    self.assertEqual(flight.Do('other', lambda: 'other'), 'other')
+    self.assertRaises(common_util.SingleFlightTimeout, flight.Do, 'key',
+                      _Work, 0.01)
+
+    release.set()
+    for thread in [leader] + followers:
+      thread.join()
+    self.assertEqual(len(calls), 1)
+    self.assertEqual(results, ['done'] * 4)
+    self.assertFalse(flight.InFlight('key'))
+
+  def testSingleFlightError(self):
+    flight = common_util.SingleFlight()
+
+    def _Fail():
+      raise common_util.CommonUtilError('failed')
+
+    self.assertRaises(common_util.CommonUtilError, flight.Do, 'key', _Fail)
+    self.assertEqual(flight.Do('key', lambda: 'retried'), 'retried')
+
+  def testGetFileHashes(self):
+    file_path = os.path.join(self._static_dir, 'payload')
+    # Large enough for every hash to be computed by its own thread.
+    content = 'x' * (common_util._PARALLEL_HASH_MIN_SIZE + 12345)
+    with open(file_path, 'w') as f:
+      f.write(content)
+
+    hashes = common_util.GetFileHashes(file_path, do_sha1=True,
+                                       do_sha256=True, do_md5=True)
+    self.assertEqual(hashes, {'sha1': hashlib.sha1(content).digest(),
+                              'sha256': hashlib.sha256(content).digest(),
+                              'md5': hashlib.md5(content).digest()})
+    self.assertEqual(common_util.GetFileHashes(file_path), {})
+    self.assertEqual(common_util.GetFileSha1AndSha256(file_path),
+                     (common_util.GetFileSha1(file_path),
+                      common_util.GetFileSha256(file_path)))
+
+  def testGetFilesHashes(self):
+    file_paths = []
+    for i in range(6):
+      file_path = os.path.join(self._static_dir, 'payload%d' % i)
+      with open(file_path, 'w') as f:
+        f.write('payload %d' % i)
+      file_paths.append(file_path)
+
+    hashes = common_util.GetFilesHashes(file_paths, do_md5=True)
+    for i, file_path in enumerate(file_paths):
+      self.assertEqual(hashes[file_path],
+                       {'md5': hashlib.md5('payload %d' % i).digest()})
+
+
+class GetFileHashesBenchmark(unittest.TestCase):
+  """Compares hashing a payload in one pass against one pass per hash."""
+
+  def setUp(self):
+    size_mb = os.environ.get(HASH_BENCHMARK_SIZE_ENV)
+    if not size_mb:
+      self.skipTest('set %s to run' % HASH_BENCHMARK_SIZE_ENV)
+
+    fd, self._file_path = tempfile.mkstemp('common_util_unittest')
+    block = os.urandom(1024 * 1024)
+    with os.fdopen(fd, 'wb') as f:
+      for _ in range(int(size_mb)):
+        f.write(block)
+    self._size_mb = int(size_mb)
+
+  def tearDown(self):
+    os.unlink(self._file_path)
+
+  def _Time(self, func):
+    start = time.time()
+    func()
+    return time.time() - start
+
+  def testBenchmark(self):
+    # The former GetLocalPayloadAttrs hashed payloads in 8 KiB blocks, once
+    # for SHA1 and once more for SHA256.
+    def _TwoPasses():
+      for hasher in hashlib.sha1(), hashlib.sha256():
+        with open(self._file_path, 'rb') as f:
+          for block in iter(lambda: f.read(8192), ''):
+            hasher.update(block)
+
+    two_passes = self._Time(_TwoPasses)
+    one_pass = self._Time(
+        lambda: common_util.GetFileSha1AndSha256(self._file_path))
+    sys.stderr.write(
+        '\nSHA1+SHA256 of %d MiB: two passes %.1f MiB/s, '
+        'one parallel pass %.1f MiB/s\n' %
+        (self._size_mb, self._size_mb / two_passes, self._size_mb / one_pass))
+
+
 if __name__ == '__main__':
   unittest.main()
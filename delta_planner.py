@@ -0,0 +1,186 @@
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Choice of the image a delta payload is generated from, per client."""
+
+import os
+import threading
+import time
+
+import autoupdate
+import log_util
+
+
+# Module-local log function.
+def _Log(message, *args):
+  return log_util.LogWithTag('DELTA_PLANNER', message, *args)
+
+
+# Seconds for which an index of images is used before the build directories
+# are read again, even if the board directory did not change.
+INDEX_TTL = 60
+
+# Number of decisions kept per index, bounding the memory used by clients
+# reporting many distinct versions.
+MAX_DECISIONS = 1000
+
+
+class _ImageIndex(object):
+  """Images of the build directories of a board, by version.
+
+  Members:
+    stat_key:  mtime of the board directory when it was read.
+    read_time: time the index was built.
+    images:    image paths, keyed by the autoupdate.Version of their
+               version.
+    versions:  versions of the images, keyed by path.
+    decisions: source images picked, keyed by (client_version, image_path).
+  """
+
+  def __init__(self, stat_key, read_time):
+    self.stat_key = stat_key
+    self.read_time = read_time
+    self.images = {}
+    self.versions = {}
+    self.decisions = {}
+
+  def Add(self, image_path, version):
+    self.images[autoupdate.Version.Parse(version)] = image_path
+    self.versions[image_path] = version
+
+
+class DeltaPlanner(object):
+  """Picks the image to generate a delta payload from for each client.
+
+  Images are indexed by the version in the version.txt of their build
+  directory. The indexed images are those of the build directories next to
+  the image clients update to, i.e. those get_latest_image.sh picks the
+  latest from, and the --src_image. A client whose version is that of an
+  indexed image older than the image it updates to gets a delta from it;
+  other clients get a full payload.
+
+  Decisions are cached per client version and image, until the board
+  directory changes or INDEX_TTL expires.
+
+  Members:
+    image_name: file name of the images in the build directories.
+    src_image:  image indexed besides those of the build directories.
+    schedule:   function queuing generation of a delta in the background,
+                given the image_path, src_image and legacy_image, if any.
+  """
+
+  def __init__(self, image_name, src_image=''):
+    self.image_name = image_name
+    self.src_image = src_image
+    self.schedule = None
+    self._lock = threading.Lock()
+    # Indexes, keyed by board directory.
+    self._indexes = {}
+    self._counters = {'hits': 0, 'misses': 0, 'deltas': 0, 'full': 0,
+                      'scans': 0}
+
+  @staticmethod
+  def _GetVersion(image_path):
+    """Returns the version of an image, or None if it has none."""
+    try:
+      return autoupdate.Autoupdate._GetVersionFromDir(
+          os.path.dirname(image_path))
+    except (autoupdate.AutoupdateError, IOError):
+      return None
+
+  def _ReadIndex(self, board_dir, stat_key):
+    """Returns a new index of the images of a board directory."""
+    index = _ImageIndex(stat_key, time.time())
+    candidates = []
+    if self.src_image:
+      candidates.append(os.path.abspath(self.src_image))
+    try:
+      entries = sorted(os.listdir(board_dir))
+    except OSError as e:
+      _Log('Failed to list images in %s: %s', board_dir, e)
+      entries = []
+    candidates.extend(os.path.join(board_dir, entry, self.image_name)
+                      for entry in entries)
+
+    for image_path in candidates:
+      if not os.path.isfile(image_path):
+        continue
+      version = self._GetVersion(image_path)
+      if version:
+        index.Add(image_path, version)
+    _Log('Indexed %d images of %s', len(index.versions), board_dir)
+    return index
+
+  def _GetIndex(self, image_path):
+    """Returns an up to date index of the images next to image_path."""
+    board_dir = os.path.dirname(os.path.dirname(image_path))
+    try:
+      stat_key = os.stat(board_dir).st_mtime
+    except OSError:
+      stat_key = None
+    with self._lock:
+      index = self._indexes.get(board_dir)
+    if (index and index.stat_key == stat_key and
+        time.time() - index.read_time < INDEX_TTL):
+      return index
+
+    index = self._ReadIndex(board_dir, stat_key)
+    with self._lock:
+      self._indexes[board_dir] = index
+      self._counters['scans'] += 1
+    return index
+
+  def _Plan(self, index, client_version, image_path):
+    """Returns the image to generate a delta from, or '' for none."""
+    src_image = index.images.get(autoupdate.Version.Parse(client_version))
+    if not src_image or src_image == image_path:
+      return ''
+    # Only update clients forwards, e.g. not when image_path is a forced
+    # image older than the client.
+    version = index.versions.get(image_path) or self._GetVersion(image_path)
+    if version and not autoupdate.Autoupdate._CanUpdate(client_version,
+                                                        version):
+      return ''
+    return src_image
+
+  def GetSourceImage(self, client_version, image_path):
+    """Returns the image to generate a delta to image_path from for a client.
+
+    Args:
+      client_version: version the client runs.
+      image_path: full path to the image the client updates to.
+    Returns:
+      Full path to the source image, or '' if the client should get a full
+      payload.
+    """
+    image_path = os.path.abspath(image_path)
+    index = self._GetIndex(image_path)
+    key = (client_version, image_path)
+    with self._lock:
+      src_image = index.decisions.get(key)
+      if src_image is not None:
+        self._counters['hits'] += 1
+        return src_image
+
+    src_image = self._Plan(index, client_version, image_path)
+    with self._lock:
+      if len(index.decisions) >= MAX_DECISIONS:
+        index.decisions.clear()
+      index.decisions[key] = src_image
+      self._counters['misses'] += 1
+      self._counters['deltas' if src_image else 'full'] += 1
+    if src_image:
+      _Log('Clients of version %s update to %s by a delta from %s',
+           client_version, image_path, src_image)
+    return src_image
+
+  def Stats(self):
+    """Returns a dictionary of planning counters."""
+    with self._lock:
+      stats = dict(self._counters)
+      stats['images'] = sum(len(index.versions)
+                            for index in self._indexes.itervalues())
+      stats['decisions'] = sum(len(index.decisions)
+                               for index in self._indexes.itervalues())
+    return stats
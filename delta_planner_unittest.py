@@ -0,0 +1,106 @@
+#!/usr/bin/python
+
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unit tests for delta_planner.py."""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import mox
+
+import autoupdate
+import delta_planner
+
+
+_IMAGE_NAME = 'flatcar_developer_image.bin'
+
+
+class DeltaPlannerTest(mox.MoxTestBase):
+
+  def setUp(self):
+    mox.MoxTestBase.setUp(self)
+    self.board_dir = tempfile.mkdtemp('delta_planner_unittest')
+    self.images = [self._AddImage(version)
+                   for version in ['100.0.0', '101.0.0', '102.0.0']]
+    self.planner = delta_planner.DeltaPlanner(_IMAGE_NAME)
+
+  def tearDown(self):
+    shutil.rmtree(self.board_dir)
+
+  def _AddImage(self, version):
+    build_dir = os.path.join(self.board_dir, version + '-a1')
+    os.mkdir(build_dir)
+    with open(os.path.join(build_dir, 'version.txt'), 'w') as f:
+      f.write('FLATCAR_VERSION=%s\n' % version)
+    image = os.path.join(build_dir, _IMAGE_NAME)
+    with open(image, 'w') as f:
+      f.write(version)
+    return image
+
+  def testGetSourceImage(self):
+    latest = self.images[2]
+    self.assertEqual(self.planner.GetSourceImage('100.0.0', latest),
+                     self.images[0])
+    self.assertEqual(self.planner.GetSourceImage('101.0.0', latest),
+                     self.images[1])
+    self.assertEqual(self.planner.GetSourceImage('101.0.0', latest),
+                     self.images[1])
+    # Unknown, current and newer versions get a full payload.
+    self.assertEqual(self.planner.GetSourceImage('99.0.0', latest), '')
+    self.assertEqual(self.planner.GetSourceImage('102.0.0', latest), '')
+    self.assertEqual(self.planner.GetSourceImage('101.0.0', self.images[0]),
+                     '')
+    self.assertEqual(self.planner.GetSourceImage('ForcedUpdate', latest), '')
+
+    stats = self.planner.Stats()
+    self.assertEqual((stats['hits'], stats['misses'], stats['deltas']),
+                     (1, 6, 2))
+    self.assertEqual((stats['images'], stats['scans']), (3, 1))
+
+  def testNewImagesAreIndexed(self):
+    latest = self.images[2]
+    self.assertEqual(self.planner.GetSourceImage('103.0.0', latest), '')
+    newer = self._AddImage('103.0.0')
+    self.assertEqual(self.planner.GetSourceImage('103.0.0', newer), '')
+    self.assertEqual(self.planner.GetSourceImage('102.0.0', newer), latest)
+    self.assertEqual(self.planner.Stats()['scans'], 2)
+
+  def testGeneratePlannedDelta(self):
+    static_dir = tempfile.mkdtemp('delta_planner_unittest')
+    try:
+      updater = autoupdate.Autoupdate(static_dir=static_dir)
+      updater.delta_planner = self.planner
+      self.mox.StubOutWithMock(updater, 'FindCachedUpdateImageSubDir')
+      self.mox.StubOutWithMock(updater, 'GenerateCachedUpdateImage')
+      updater.FindCachedUpdateImageSubDir(
+          self.images[0], self.images[2]).MultipleTimes().AndReturn(
+              'cache/a_b')
+      updater.GenerateCachedUpdateImage(
+          self.images[0], self.images[2], static_dir, True,
+          wait_timeout=None).AndReturn('cache/a_b')
+      self.mox.ReplayAll()
+
+      self.assertEqual(updater._GeneratePlannedDelta(
+          '99.0.0', self.images[2], static_dir, True), None)
+      self.assertEqual(updater._GeneratePlannedDelta(
+          '100.0.0', self.images[2], static_dir, True), 'cache/a_b')
+
+      # With a scheduler, clients get a full payload until the delta is
+      # generated.
+      scheduled = []
+      self.planner.schedule = lambda *args: scheduled.append(args)
+      self.assertEqual(updater._GeneratePlannedDelta(
+          '100.0.0', self.images[2], static_dir, True), None)
+      self.assertEqual(scheduled, [(self.images[2], self.images[0], True)])
+      self.mox.VerifyAll()
+    finally:
+      shutil.rmtree(static_dir)
+
+
+if __name__ == '__main__':
+  unittest.main()
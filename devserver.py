@@ -7,21 +7,37 @@
 """A CherryPy-based webserver to host images and build packages."""
 
 import cherrypy
+from cherrypy import _cpdispatch
+from cherrypy.process import servers
+import functools
 import json
 import logging
 import optparse
 import os
 import re
+import shutil
 import socket
 import sys
 import subprocess
 import tempfile
 import threading
+import time
 import types
 
+import async_server
 import autoupdate
+import autoupdate_lib
 import common_util
+import delta_planner
+import hash_cache
+import host_info
+import host_journal
 import log_util
+import metrics
+import payload_cache
+import prefork
+import pregenerator
+import static_server
 
 
 # Module-local log function.
@@ -29,11 +45,31 @@ def _Log(message, *args):
   return log_util.LogWithTag('DEVSERVER', message, *args)
 
 
-CACHED_ENTRIES = 12
+# Seconds between checks for changes to files with cached hashes.
+HASH_REFRESH_INTERVAL = 60
+
+# Seconds between scans of the payload cache for payloads generated or used
+# by other processes.
+CACHE_SCAN_INTERVAL = 60
 
 # Sets up global to share between classes.
 updater = None
 
+# Background payload pre-generation service, if enabled.
+pregen_service = None
+
+# Metrics recorded for each exposed method, keyed by its path.
+_REQUESTS = metrics.Counter(
+    'devserver_requests_total',
+    'Requests handled, by endpoint and HTTP status code.',
+    ('endpoint', 'code'))
+_REQUESTS_IN_FLIGHT = metrics.Gauge(
+    'devserver_requests_in_flight', 'Requests being handled.', ('endpoint',))
+_REQUEST_SECONDS = metrics.Histogram(
+    'devserver_request_duration_seconds',
+    'Time spent in request handlers, until the response body is returned.',
+    ('endpoint',))
+
 
 class DevServerError(Exception):
   """Exception class used by this module."""
@@ -123,14 +159,19 @@ def _GetConfig(options):
                     'response.timeout': 6000,
                     'request.show_tracebacks': True,
                     'server.socket_timeout': 60,
-                    'tools.staticdir.root':
-                      os.path.dirname(os.path.abspath(sys.argv[0])),
+                    # Lets /static send payloads with sendfile.
+                    'server.wsgi_version': static_server.WSGI_VERSION,
                   },
                   '/api':
                   {
                     # Gets rid of cherrypy parsing post file for args.
                     'request.process_request_body': False,
                   },
+                  '/api/hostlog':
+                  {
+                    # Streams ndjson host logs as they are serialized.
+                    'response.stream': True,
+                  },
                   '/build':
                   {
                     'response.timeout': 100000,
@@ -141,10 +182,9 @@ def _GetConfig(options):
                     'request.process_request_body': False,
                     'response.timeout': 10000,
                   },
-                  # Sets up the static dir for file hosting.
+                  # Static files are hosted by DevServerRoot.static.
                   '/static':
-                  { 'tools.staticdir.dir': 'static',
-                    'tools.staticdir.on': True,
+                  { 'response.stream': True,
                     'response.timeout': 10000,
                   },
                 }
@@ -238,6 +278,131 @@ def _FindExposedMethods(root, prefix, unlisted=None):
   return method_list
 
 
+def _InstrumentHandler(owner, name, endpoint):
+  """Records request metrics for an exposed method of owner.
+
+  The method is replaced by a wrapper in owner's instance dictionary, unless
+  it was already instrumented.
+
+  Args:
+    owner: object the method is exposed by.
+    name: name of the method.
+    endpoint: value of the endpoint label of the metrics.
+  """
+  handler = getattr(owner, name)
+  if getattr(handler, 'metrics_endpoint', None):
+    return
+  in_flight = _REQUESTS_IN_FLIGHT.Labels(endpoint)
+  duration = _REQUEST_SECONDS.Labels(endpoint)
+
+  @functools.wraps(handler)
+  def _InstrumentedHandler(*args, **kwargs):
+    code = 500
+    in_flight.Inc()
+    start = time.time()
+    try:
+      result = handler(*args, **kwargs)
+      code = cherrypy.response.status or 200
+      return result
+    except (cherrypy.HTTPError, cherrypy.HTTPRedirect) as e:
+      code = e.status
+      raise
+    except TypeError:
+      # Tell missing or unexpected parameters (a 404) from errors in the
+      # handler, as CherryPy would if the handler were not wrapped.
+      try:
+        _cpdispatch.test_callable_spec(handler, args, kwargs)
+      except cherrypy.HTTPError as http_error:
+        code = http_error.status
+        raise
+      raise
+    finally:
+      duration.Observe(time.time() - start)
+      in_flight.Dec()
+      _REQUESTS.Labels(endpoint, str(code).split(' ')[0]).Inc()
+
+  _InstrumentedHandler.metrics_endpoint = endpoint
+  setattr(owner, name, _InstrumentedHandler)
+
+
+def _InstrumentExposedMethods(root):
+  """Records request metrics for all methods found by _FindExposedMethods."""
+  for path in _FindExposedMethods(root, ''):
+    members = path.split('/')
+    owner = root
+    for member in members[:-1]:
+      owner = getattr(owner, member)
+    _InstrumentHandler(owner, members[-1], path)
+
+
+def _GetUpdaterStats(get_stats):
+  """Returns a function returning statistics of the updater, if any."""
+  def _GetStats():
+    return get_stats(updater) if updater else {}
+  return _GetStats
+
+
+def _GetStaticFileCacheStats():
+  app = cherrypy.tree.apps.get('')
+  static = getattr(app and app.root, 'static', None)
+  return static.file_cache.Stats() if static else {}
+
+
+def _AddStatsCollectors(registry):
+  """Exports the statistics of the devserver's caches and tables."""
+  registry.AddStatsCollector(
+      'devserver_latest_image',
+      _GetUpdaterStats(lambda u: u.latest_image.Stats()),
+      counters=('hits', 'scans', 'script_runs'),
+      help_text='Resolution of the latest image of boards.')
+  registry.AddStatsCollector(
+      'devserver_payload_index',
+      _GetUpdaterStats(lambda u: u.payload_index.Stats()),
+      counters=('hits', 'misses', 'rehashes'),
+      help_text='Index of local payload metadata.')
+  registry.AddStatsCollector(
+      'devserver_payload_cache',
+      _GetUpdaterStats(lambda u: (u.payload_cache.Stats() if u.payload_cache
+                                  else {})),
+      counters=('hits', 'misses', 'evictions', 'evicted_bytes'),
+      help_text='Cache of generated payloads.')
+  registry.AddStatsCollector(
+      'devserver_payload_store',
+      _GetUpdaterStats(lambda u: (u.payload_store.Stats() if u.payload_store
+                                  else {})),
+      counters=('link', 'reflink', 'copy', 'unchanged', 'pruned'),
+      help_text='Payloads published from the content-addressed store.')
+  registry.AddStatsCollector(
+      'devserver_delta_planner',
+      _GetUpdaterStats(lambda u: (u.delta_planner.Stats() if u.delta_planner
+                                  else {})),
+      counters=('hits', 'misses', 'deltas', 'full', 'scans'),
+      help_text='Planning of delta payloads per client version.')
+  registry.AddStatsCollector(
+      'devserver_hash_cache', _GetUpdaterStats(lambda u: u.hash_cache.Stats()),
+      counters=('hits', 'misses', 'refreshes'),
+      help_text='Cache of staged file hashes.')
+  registry.AddStatsCollector(
+      'devserver_remote_metadata',
+      _GetUpdaterStats(lambda u: u.remote_metadata.Stats()),
+      counters=('hits', 'revalidations', 'fetches', 'stale_hits'),
+      help_text='Cache of remote payload metadata.')
+  registry.AddStatsCollector(
+      'devserver_host_table',
+      _GetUpdaterStats(lambda u: u.host_infos.Stats()),
+      counters=('evictions',), help_text='Table of known hosts.')
+  registry.AddStatsCollector(
+      'devserver_build_index', common_util.GetBuildIndexStats,
+      counters=('hits', 'invalidations'), help_text='Indexes of builds.')
+  registry.AddStatsCollector(
+      'devserver_static_file_cache', _GetStaticFileCacheStats,
+      counters=('hits', 'misses'),
+      help_text='Open files kept to serve /static.')
+
+
+_AddStatsCollectors(metrics.REGISTRY)
+
+
 def _GetScriptsDir(devserver_dir):
   """Return the path to src/scripts in the SDK"""
 
@@ -285,20 +450,86 @@ class ApiRoot(object):
     return updater.HandleHostInfoPing(ip)
 
   @cherrypy.expose
-  def hostlog(self, ip):
+  def hostlog(self, ip, **params):
     """Returns a JSON object containing a log of host event.
 
     Args:
       ip: address of host whose event log is requested, or `all'
+      format: `json' (default) for a single JSON document, or `ndjson' to
+        stream events as newline delimited JSON objects, oldest first
+      since: only return events recorded at or after this time (seconds
+        since the epoch)
+      until: only return events recorded before this time
+      cursor: only return events recorded after the one with this seq
+      limit: maximum number of events returned
+      event_type: only return events of this type
+      event_result: only return events with this result
     Returns:
       A JSON encoded list (log) of dictionaries (events), each of which
       containing a `timestamp' and other event fields, as described under
-      /api/hostinfo.
+      /api/hostinfo. For `all', a dictionary of such lists keyed by ip. In
+      ndjson format, each event additionally carries its `ip', its numeric
+      `time' and a `seq' number to pass as cursor to fetch the next events.
 
-    Example URL:
+    Example URLs:
       http://myhost/api/hostlog?ip=192.168.1.5
+      http://myhost/api/hostlog?ip=all&format=ndjson&cursor=1234&limit=500
+    """
+    log_format = params.pop('format', 'json')
+    if log_format not in ('json', 'ndjson'):
+      raise cherrypy.HTTPError(400, 'Unknown log format %s.' % log_format)
+    try:
+      filters = dict((name, float(params[name]))
+                     for name in ('since', 'until') if name in params)
+      filters.update((name, int(params[name]))
+                     for name in ('cursor', 'event_type', 'event_result')
+                     if name in params)
+      limit = int(params['limit']) if 'limit' in params else None
+      if limit is not None and limit < 0:
+        raise ValueError('negative limit')
+    except ValueError as e:
+      raise cherrypy.HTTPError(400, 'Invalid log filter: %s' % e)
+
+    if log_format == 'ndjson':
+      cherrypy.response.headers['Content-Type'] = 'application/x-ndjson'
+    return updater.HandleHostLogPing(ip, log_format, limit, **filters)
+
+  @cherrypy.expose
+  def hoststats(self):
+    """Returns a JSON object describing the size of the host table.
+
+    Returns:
+      A JSON encoded dictionary containing the following fields:
+        hosts (int):        number of hosts currently known
+        log_entries (int):  number of host events recorded
+        evictions (int):    number of hosts forgotten for being idle
+        shards (int):       number of independently locked table shards
+        log_size (int):     number of events recorded per host
+        unrestored_hosts (int): number of hosts in the --host_log_dir
+                                journal that were not looked up yet
+
+    Example URL:
+      http://myhost/api/hoststats
     """
-    return updater.HandleHostLogPing(ip)
+    return json.dumps(updater.host_infos.Stats())
+
+  @cherrypy.expose
+  def metrics(self):
+    """Returns the devserver's metrics in Prometheus text format.
+
+    Metrics include the number of requests handled by each endpoint and
+    their status codes, the number of requests in flight, histograms of
+    request handling times and of the time spent parsing update requests,
+    looking up payload metadata, generating payloads, hashing files and
+    rendering responses, and the counters of the devserver's caches. With
+    --workers, metrics other than those of the host table are kept by each
+    worker process, and describe the worker that answered.
+
+    Example URL:
+      http://myhost/api/metrics
+    """
+    cherrypy.response.headers['Content-Type'] = metrics.CONTENT_TYPE
+    return metrics.REGISTRY.Render()
 
   @cherrypy.expose
   def setnextupdate(self, ip):
@@ -318,33 +549,116 @@ class ApiRoot(object):
 
 
   @cherrypy.expose
-  def fileinfo(self, *path_args):
+  def pregen(self):
+    """Returns a JSON object describing the payload pre-generation queue.
+
+    Returns:
+      A JSON encoded dictionary containing the following fields:
+        enabled (bool):   whether payloads are pre-generated at all
+        workers (int):    number of payloads generated in parallel
+        queued (list):    jobs waiting to be run
+        running (list):   jobs being run
+        finished (list):  most recently finished jobs
+      Each job is a dictionary with the image_path, src_image and
+      legacy_image of the payload, its state, queued_time, start_time and
+      end_time timestamps, the cache_sub_dir it was generated in and an
+      error, if it failed.
+
+    Example URL:
+      http://myhost/api/pregen
+    """
+    if not pregen_service:
+      return json.dumps({'enabled': False})
+    return json.dumps(pregen_service.Status())
+
+  @staticmethod
+  def _GetStagedFilePath(rel_path):
+    """Returns the path to a staged file.
+
+    Raises:
+      DevServerError: if the file is outside the static dir or missing.
+    """
+    file_path = os.path.join(updater.static_dir, rel_path)
+    if not common_util.SafeSandboxAccess(updater.static_dir, file_path):
+      raise DevServerError('invalid file path: %s' % rel_path)
+    if not os.path.exists(file_path):
+      raise DevServerError('file not found: %s' % file_path)
+    return file_path
+
+  @classmethod
+  def _GetFileInfo(cls, rel_path):
+    """Returns the stat key and info dictionary of a staged file.
+
+    Raises:
+      DevServerError: if the file is outside the static dir or missing.
+    """
+    file_path = cls._GetStagedFilePath(rel_path)
+    try:
+      stat_key = hash_cache.GetStatKey(file_path)
+      hashes = updater.hash_cache.GetHashes(file_path, ['sha1', 'sha256'])
+    except (IOError, OSError) as e:
+      raise DevServerError('failed to get info for file %s: %s' %
+                           (file_path, str(e)))
+    return stat_key, {'size': stat_key[2], 'sha1': hashes['sha1'],
+                      'sha256': hashes['sha256']}
+
+  @cherrypy.expose
+  def fileinfo(self, *path_args, **params):
     """Returns information about a given staged file.
 
+    Hashes are cached for as long as the file does not change. Responses for
+    a single file carry ETag and Last-Modified headers, and conditional
+    requests (If-None-Match, If-Modified-Since) for an unchanged file are
+    answered with 304 Not Modified without looking at its contents.
+
     Args:
       path_args: path to the file inside the server's static staging directory
+      path: instead of path_args, one or more paths to files inside the
+            static staging directory to return information about at once
     Returns:
       A JSON encoded dictionary with information about the said file, which may
       contain the following keys/values:
         size (int):      the file size in bytes
         sha1 (string):   a base64 encoded SHA1 hash
         sha256 (string): a base64 encoded SHA256 hash
+      If path is given, a JSON encoded dictionary of such dictionaries keyed
+      by path; files whose information cannot be obtained are described by a
+      dictionary with a single `error' key.
 
     Example URL:
       http://myhost/api/fileinfo/some/path/to/file
+      http://myhost/api/fileinfo?path=some/file&path=some/other/file
     """
-    file_path = os.path.join(updater.static_dir, *path_args)
-    if not os.path.exists(file_path):
-      raise DevServerError('file not found: %s' % file_path)
+    if 'path' in params:
+      paths = params['path']
+      if not isinstance(paths, list):
+        paths = [paths]
+      file_infos = {}
+      for rel_path in paths:
+        try:
+          file_infos[rel_path] = self._GetFileInfo(rel_path)[1]
+        except DevServerError as e:
+          file_infos[rel_path] = {'error': str(e)}
+      return json.dumps(file_infos)
+
+    rel_path = os.path.join(*path_args) if path_args else ''
+    file_path = self._GetStagedFilePath(rel_path)
     try:
-      file_size = os.path.getsize(file_path)
-      file_sha1 = common_util.GetFileSha1(file_path)
-      file_sha256 = common_util.GetFileSha256(file_path)
-    except os.error, e:
-      raise DevServerError('failed to get info for file %s: %s' %
-                           (file_path, str(e)))
-    return json.dumps(
-        {'size': file_size, 'sha1': file_sha1, 'sha256': file_sha256})
+      stat_key = hash_cache.GetStatKey(file_path)
+    except OSError:
+      raise DevServerError('file not found: %s' % file_path)
+
+    # Answer conditional requests for unchanged files before hashing them.
+    dev, inode, size, mtime_ns = stat_key
+    response_headers = cherrypy.response.headers
+    response_headers['ETag'] = '"%x-%x-%x-%x"' % (dev, inode, size, mtime_ns)
+    response_headers['Last-Modified'] = cherrypy.lib.httputil.HTTPDate(
+        mtime_ns / 1000000000)
+    cherrypy.lib.cptools.validate_since()
+    cherrypy.lib.cptools.validate_etags()
+
+    return json.dumps(self._GetFileInfo(rel_path)[1])
+
 
 class DevServerRoot(object):
   """The Root Class for the Dev Server.
@@ -362,9 +676,24 @@ class DevServerRoot(object):
 
   api = ApiRoot()
 
-  def __init__(self):
+  def __init__(self, static_root=None):
+    """Creates the root.
+
+    Args:
+      static_root: directory served under /static, the static directory next
+                   to the devserver by default.
+    """
     self._builder = None
     self._download_lock_dict = LockDict()
+    if static_root is None:
+      static_root = os.path.join(os.path.dirname(os.path.abspath(sys.argv[0])),
+                                 'static')
+    self.static = static_server.StaticServer(static_root)
+    _InstrumentExposedMethods(self)
+    # Cached payloads being downloaded are not evicted.
+    if updater and updater.payload_cache:
+      updater.payload_cache.AddInUseCheck(self.static.file_cache.InUse)
+    _InstrumentHandler(self.static, 'default', 'static')
 
   @cherrypy.expose
   def build(self, board, pkg, **kwargs):
@@ -455,6 +784,8 @@ class DevServerRoot(object):
     Example URL:
       To List all control files:
       http://dev-server/controlfiles?board=x86-alex-release&build=R18-1514.0.0
+      To List server side control files as JSON:
+      http://dev-server/controlfiles?build=x86-alex-release/R18-1514.0.0&prefix=server/&format=json
       To return the contents of a path:
       http://dev-server/controlfiles?board=x86-alex-release&build=R18-1514.0.0&control_path=client/sleeptest/control
 
@@ -463,9 +794,11 @@ class DevServerRoot(object):
       control_path: If you want the contents of a control file set this
         to the path. E.g. client/site_tests/sleeptest/control
         Optional, if not provided return a list of control files is returned.
+      prefix: Only list control files whose path starts with this.
+      format: Set to json to list control files as a JSON list.
     Returns:
       Contents of a control file if control_path is provided.
-      A list of control files if no control_path is provided.
+      A sorted list of control files if no control_path is provided.
     """
     if not params:
       return _PrintDocStringAsHTML(self.controlfiles)
@@ -476,7 +809,8 @@ class DevServerRoot(object):
 
     if 'control_path' not in params:
       return common_util.GetControlFileList(
-          updater.static_dir, params['build'])
+          updater.static_dir, params['build'], prefix=params.get('prefix'),
+          as_json=params.get('format') == 'json')
     else:
       return common_util.GetControlFile(
           updater.static_dir, params['build'], params['control_path'])
@@ -521,32 +855,122 @@ class DevServerRoot(object):
     """
     label = '/'.join(args)
     body_length = int(cherrypy.request.headers.get('Content-Length', 0))
+    if body_length > autoupdate_lib.MAX_REQUEST_SIZE:
+      raise cherrypy.HTTPError(413, 'Update request too large.')
     data = cherrypy.request.rfile.read(body_length)
     return updater.HandleUpdatePing(data, label)
 
 
-def _CleanCache(cache_dir, wipe):
-  """Wipes any excess cached items in the cache_dir.
+def _ClearCache(cache_dir):
+  """Wipes all the contents of the cache_dir, exiting on failure.
 
-  Args:
-    cache_dir: the directory we are wiping from.
-    wipe: If True, wipe all the contents -- not just the excess.
+  Excess cached payloads are evicted by updater.payload_cache instead.
   """
-  if wipe:
-    # Clear the cache and exit on error.
-    cmd = 'rm -rf %s/*' % cache_dir
-    if os.system(cmd) != 0:
-      _Log('Failed to clear the cache with %s' % cmd)
-      sys.exit(1)
-  else:
-    # Clear all but the last N cached updates
-    cmd = ('cd %s; ls -tr | head --lines=-%d | xargs rm -rf' %
-           (cache_dir, CACHED_ENTRIES))
-    if os.system(cmd) != 0:
-      _Log('Failed to clean up old delta cache files with %s' % cmd)
+  for name in os.listdir(cache_dir):
+    path = os.path.join(cache_dir, name)
+    try:
+      if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+      else:
+        os.unlink(path)
+    except OSError as e:
+      _Log('Failed to clear the cache: %s', e)
       sys.exit(1)
 
 
+def _StartBackgroundServices(options, serve_only, pregenerate=True):
+  """Starts the threads refreshing hashes, evicting cached payloads and
+  pre-generating payloads.
+  """
+  # pylint: disable=W0603
+  global pregen_service
+
+  updater.hash_cache.StartBackgroundRefresh(HASH_REFRESH_INTERVAL)
+  if updater.payload_cache:
+    updater.payload_cache.StartBackgroundEviction(CACHE_SCAN_INTERVAL)
+
+  if (pregenerate and options.pregen_workers > 0 and not serve_only and
+      not options.remote_payload and not options.payload):
+    pregen_service = pregenerator.Pregenerator(
+        updater, num_workers=options.pregen_workers,
+        num_deltas=options.pregen_deltas,
+        poll_interval=options.pregen_interval)
+    pregen_service.Start()
+    if updater.delta_planner:
+      # Generate planned deltas in the background, rather than while clients
+      # wait for a response.
+      updater.delta_planner.schedule = pregen_service.Enqueue
+
+
+def _SetUpServer(options, config, listener=None):
+  """Sets up the HTTP server started along with the CherryPy engine.
+
+  Args:
+    options: parsed command line options; only server and port are used.
+    config: CherryPy configuration, as returned by _GetConfig.
+    listener: listening socket to accept connections on, if it is not to be
+              bound to the configured address.
+  """
+  global_config = config['global']
+  if options.server == 'async':
+    server = async_server.AsyncServer(
+        cherrypy.tree, global_config['server.socket_host'], options.port,
+        num_workers=global_config.get('server.thread_pool', 10),
+        socket_timeout=global_config['server.socket_timeout'],
+        listener=listener)
+    # Replace CherryPy's HTTP server, starting after the other plugins.
+    cherrypy.server.unsubscribe()
+    cherrypy.engine.subscribe('start', server.Start, priority=75)
+    cherrypy.engine.subscribe('stop', server.Stop, priority=25)
+    metrics.REGISTRY.AddStatsCollector(
+        'devserver_async_server', server.Stats,
+        help_text='Connections and requests of the event-loop server.')
+  elif listener:
+    # The server is created from cherrypy.server, which is configured here.
+    cherrypy.config.update(config)
+    cherrypy.server.unsubscribe()
+    servers.ServerAdapter(
+        cherrypy.engine,
+        prefork.InheritedSocketWSGIServer(listener, cherrypy.server)
+    ).subscribe()
+
+
+def _Serve(options, config, listener=None):
+  """Serves requests until the CherryPy engine exits.
+
+  Args are those of _SetUpServer.
+  """
+  _SetUpServer(options, config, listener=listener)
+  cherrypy.quickstart(DevServerRoot(), config=config)
+
+
+def _ServeWithWorkers(options, config, serve_only):
+  """Serves requests from several worker processes until interrupted.
+
+  Workers share the listening socket, host info served by a separate
+  process, and payload generation locks.
+  """
+  global_config = config['global']
+  listener = async_server.BindSocket(global_config['server.socket_host'],
+                                     options.port)
+  host_manager = host_info.StartHostInfoManager(
+      log_size=options.host_log_size, idle_timeout=options.host_idle_timeout,
+      log_dir=options.host_log_dir)
+  # Reloading would replace workers with standalone devservers.
+  cherrypy.config.update({'engine.autoreload.on': False})
+
+  def _RunWorker(index):
+    updater.host_infos = host_manager.Connect()
+    # Payloads for new images are pre-generated by the first worker only.
+    _StartBackgroundServices(options, serve_only, pregenerate=index == 0)
+    _Serve(options, config, listener=listener)
+
+  _Log('Starting %d workers', options.workers)
+  prefork.WorkerPool(options.workers, _RunWorker).Run()
+  host_manager.shutdown()
+  listener.close()
+
+
 def main():
   devkey = "/usr/share/update_engine/update-payload-key.key.pem"
   devserver_dir = os.path.dirname(os.path.abspath(sys.argv[0]))
@@ -561,6 +985,16 @@ def main():
                     help='Enables serve-only mode. Serves archived builds only')
   parser.add_option('--board', default=_GetDefaultBoardID(scripts_dir),
                     help='when pre-generating update, board for latest image')
+  parser.add_option('--cache_max_entries',
+                    metavar='NUM', default=payload_cache.DEFAULT_MAX_ENTRIES,
+                    type='int',
+                    help='number of generated payloads kept in the cache, 0 '
+                    'for no limit (default: %d)'
+                    % payload_cache.DEFAULT_MAX_ENTRIES)
+  parser.add_option('--cache_max_size',
+                    metavar='MB', default=0, type='int',
+                    help='megabytes of generated payloads kept in the cache '
+                    '(default: 0, no limit)')
   parser.add_option('--clear_cache',
                     action='store_true', default=False,
                     help='clear out all cached updates and exit')
@@ -580,11 +1014,38 @@ def main():
   parser.add_option('--host_log',
                     action='store_true', default=False,
                     help='record history of host update events (/api/hostlog)')
+  parser.add_option('--host_idle_timeout',
+                    metavar='SECS', default=0, type='int',
+                    help='forget hosts that made no requests for this long '
+                    '(default: 0, never)')
+  parser.add_option('--host_log_dir',
+                    metavar='PATH',
+                    help='persist host info and events to a journal in this '
+                    'directory, so that they survive restarts')
+  parser.add_option('--host_log_size',
+                    metavar='NUM', default=host_info.DEFAULT_LOG_SIZE,
+                    type='int',
+                    help='number of events recorded per host with --host_log '
+                    '(default: 1000)')
   parser.add_option('--image',
                     metavar='FILE',
                     help='Force update using this image. Can only be used when '
                     'not in serve-only mode as it is used to generate a '
                     'payload.')
+  parser.add_option('--log_format',
+                    default='text', type='choice', choices=log_util.FORMATS,
+                    help='text: CherryPy log lines; json: a JSON object per '
+                    'line (default: text)')
+  parser.add_option('--log_level',
+                    default='info', type='choice',
+                    choices=sorted(log_util.LEVELS),
+                    help='minimum level of logged messages; update requests '
+                    'are logged at debug level (default: info)')
+  parser.add_option('--log_sample',
+                    metavar='TAG[:LEVEL]=RATE', action='append', default=[],
+                    help='only log a fraction of the messages with this tag, '
+                    'at or below LEVEL (default: debug), e.g. UPDATE=1%; may '
+                    'be repeated')
   parser.add_option('--logfile',
                     metavar='PATH',
                     help='log output to this file instead of stdout')
@@ -600,9 +1061,31 @@ def main():
   parser.add_option('--payload',
                     metavar='PATH',
                     help='use update payload from specified directory')
+  parser.add_option('--payload_wait_timeout',
+                    metavar='SECS', default=30, type='float',
+                    help='how long an update check waits on a payload being '
+                    'generated for another client before getting no update '
+                    '(default: 30)')
+  parser.add_option('--plan_deltas',
+                    action='store_true', default=False,
+                    help='give clients a delta payload from the image of the '
+                    'version they run, when it is among the images of the '
+                    'board or the --src_image')
   parser.add_option('--port',
                     default=8080, type='int',
                     help='port for the dev server to use (default: 8080)')
+  parser.add_option('--pregen_deltas',
+                    metavar='NUM', default=0, type='int',
+                    help='number of previous images to pre-generate delta '
+                    'payloads from (default: 0)')
+  parser.add_option('--pregen_interval',
+                    metavar='SECS', default=60, type='int',
+                    help='seconds between checks for new images to '
+                    'pre-generate payloads for (default: 60)')
+  parser.add_option('--pregen_workers',
+                    metavar='NUM', default=0, type='int',
+                    help='pre-generate payloads for new images in the '
+                    'background with this many workers (default: 0, off)')
   parser.add_option('--private_key',
                     metavar='PATH', default=devkey,
                     help='path to the private key in pem format')
@@ -615,6 +1098,21 @@ def main():
   parser.add_option('--remote_payload',
                     action='store_true', default=False,
                     help='Payload is being served from a remote machine')
+  parser.add_option('--remote_payload_max_stale',
+                    metavar='SECS', default=300, type='float',
+                    help='how long remote payload attributes are still used '
+                    'while the remote devserver is unreachable (default: 300)')
+  parser.add_option('--remote_payload_ttl',
+                    metavar='SECS', default=10, type='float',
+                    help='how long remote payload attributes are used before '
+                    'revalidating them with the remote devserver '
+                    '(default: 10)')
+  parser.add_option('--server',
+                    metavar='TYPE', default='threaded', type='choice',
+                    choices=('threaded', 'async'),
+                    help='threaded: a thread per connection; async: an event '
+                    'loop holding connections, and threads only running '
+                    'requests (default: threaded)')
   parser.add_option('--src_image',
                     metavar='PATH', default='',
                     help='source image for generating delta updates from')
@@ -624,8 +1122,21 @@ def main():
   parser.add_option('-u', '--urlbase',
                     metavar='URL',
                     help='base URL for update images, other than the devserver')
+  parser.add_option('--workers',
+                    metavar='NUM', default=1, type='int',
+                    help='serve from this many processes sharing the port, '
+                    'to use more than one core (default: 1)')
   (options, _) = parser.parse_args()
 
+  try:
+    log_util.Configure(
+        level=log_util.LEVELS[options.log_level],
+        log_format=options.log_format,
+        sample_rates=[log_util.ParseSampleRate(spec)
+                      for spec in options.log_sample])
+  except log_util.LogUtilError as e:
+    parser.error(str(e))
+
   static_dir = os.path.realpath('%s/static' % options.data_dir)
   os.system('mkdir -p %s' % static_dir)
 
@@ -654,10 +1165,10 @@ def main():
         options.image):
       parser.error('Incompatible flags detected for serve_only mode.')
 
-  elif os.path.exists(cache_dir):
-    _CleanCache(cache_dir, options.clear_cache)
-  else:
+  elif not os.path.exists(cache_dir):
     os.makedirs(cache_dir)
+  elif options.clear_cache:
+    _ClearCache(cache_dir)
 
   _Log('Using cache directory %s' % cache_dir)
   _Log('Data dir is %s' % options.data_dir)
@@ -667,6 +1178,15 @@ def main():
   # We allow global use here to share with cherrypy classes.
   # pylint: disable=W0603
   global updater
+
+  journal = None
+  # With several workers, the journal is kept by the shared host info table.
+  if options.host_log_dir and not options.exit and options.workers <= 1:
+    journal = host_journal.HostJournal(options.host_log_dir,
+                                       options.host_log_size)
+    journal.Open()
+    cherrypy.engine.subscribe('stop', journal.Close)
+
   updater = autoupdate.Autoupdate(
       devserver_dir=devserver_dir,
       scripts_dir=scripts_dir,
@@ -686,13 +1206,36 @@ def main():
       remote_payload=options.remote_payload,
       max_updates=options.max_updates,
       host_log=options.host_log,
+      host_log_size=options.host_log_size,
+      host_idle_timeout=options.host_idle_timeout,
+      host_journal=journal,
+      payload_wait_timeout=options.payload_wait_timeout,
+      remote_payload_ttl=options.remote_payload_ttl,
+      remote_payload_max_stale=options.remote_payload_max_stale,
+      process_locks=options.workers > 1,
+      cache_max_size=options.cache_max_size * 1024 * 1024,
+      cache_max_entries=options.cache_max_entries,
   )
 
+  if options.plan_deltas and not serve_only:
+    updater.delta_planner = delta_planner.DeltaPlanner(
+        updater._GetImageName(), src_image=options.src_image)
+
+  if updater.payload_cache:
+    # The cache may have outgrown its budget while the devserver was down.
+    updater.payload_cache.Scan()
+    updater.payload_cache.Evict()
+    updater.payload_store.Prune()
+
   if options.pregenerate_update:
     updater.PreGenerateUpdate()
+    # Save the hashes computed meanwhile, in case the devserver exits.
+    updater.hash_cache.Save()
 
   # If the command line requested after setup, it's time to do it.
   if not options.exit:
+    updater.IndexLocalPayloads()
+
     # Handle options that must be set globally in cherrypy.
     if options.production:
       cherrypy.config.update({'environment': 'production'})
@@ -701,8 +1244,17 @@ def main():
     else:
       cherrypy.config.update({'log.error_file': options.logfile,
                               'log.access_file': options.logfile})
-
-    cherrypy.quickstart(DevServerRoot(), config=_GetConfig(options))
+    # Write log messages from a thread while serving, in every worker.
+    cherrypy.engine.subscribe('start', log_util.StartWriter, priority=10)
+    cherrypy.engine.subscribe('stop', log_util.StopWriter, priority=90)
+    cherrypy.engine.subscribe('stop', updater.hash_cache.Save)
+
+    config = _GetConfig(options)
+    if options.workers > 1:
+      _ServeWithWorkers(options, config, serve_only)
+    else:
+      _StartBackgroundServices(options, serve_only)
+      _Serve(options, config)
 
 
 if __name__ == '__main__':
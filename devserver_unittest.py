@@ -58,6 +58,8 @@ API_SET_UPDATE_BAD_URL = 'http://127.0.0.1:8080/api/setnextupdate/'
 API_SET_UPDATE_URL = API_SET_UPDATE_BAD_URL + '127.0.0.1'
 
 API_SET_UPDATE_REQUEST = 'new_update-test/the-new-update'
+
+API_FILE_INFO_URL = 'http://127.0.0.1:8080/api/fileinfo'
 DEVSERVER_STARTUP_DELAY = 1
 
 
@@ -226,6 +228,64 @@ class DevserverTest(unittest.TestCase):
     finally:
       os.kill(pid, signal.SIGKILL)
 
+  def testApiFileInfoConditional(self):
+    """Tests fileinfo ETags and conditional requests."""
+    pid = self._StartServer()
+    try:
+      connection = urllib2.urlopen(API_FILE_INFO_URL + '/' + TEST_IMAGE_NAME)
+      file_info = json.loads(connection.read())
+      etag = connection.info()['ETag']
+      connection.close()
+      self.assertEqual(file_info['sha1'], EXPECTED_HASH)
+      self.assertEqual(file_info['size'], os.path.getsize(self.image))
+
+      # An unchanged file is not described again.
+      request = urllib2.Request(API_FILE_INFO_URL + '/' + TEST_IMAGE_NAME,
+                                headers={'If-None-Match': etag})
+      try:
+        urllib2.urlopen(request).close()
+        self.fail('Conditional fileinfo request was not answered with 304!')
+      except urllib2.HTTPError as e:
+        self.assertEqual(e.code, 304)
+    finally:
+      os.kill(pid, signal.SIGKILL)
+
+  def testApiFileInfoBatch(self):
+    """Tests getting information about several files at once."""
+    pid = self._StartServer()
+    try:
+      connection = urllib2.urlopen(
+          API_FILE_INFO_URL + '?path=%s&path=missing&path=../../etc/passwd' %
+          TEST_IMAGE_NAME)
+      file_infos = json.loads(connection.read())
+      connection.close()
+      self.assertEqual(sorted(file_infos),
+                       ['../../etc/passwd', 'missing', TEST_IMAGE_NAME])
+      self.assertEqual(file_infos[TEST_IMAGE_NAME]['sha1'], EXPECTED_HASH)
+      self.assertTrue(file_infos['missing']['error'].startswith(
+          'file not found'))
+      self.assertTrue(file_infos['../../etc/passwd']['error'].startswith(
+          'invalid file path'))
+    finally:
+      os.kill(pid, signal.SIGKILL)
+
+  def testApiFileInfoOutsideSandbox(self):
+    """Tests that fileinfo does not tell about files outside static."""
+    pid = self._StartServer()
+    try:
+      for path in ('/etc/passwd', '/etc/missing'):
+        request = urllib2.Request(
+            API_FILE_INFO_URL + '/../..' * 8 + path,
+            headers={'If-None-Match': '*'})
+        try:
+          urllib2.urlopen(request).close()
+          self.fail('fileinfo request outside static did not fail!')
+        except urllib2.HTTPError as e:
+          self.assertNotEqual(e.code, 304)
+          self.assertTrue('invalid file path' in e.read())
+    finally:
+      os.kill(pid, signal.SIGKILL)
+
 
 if __name__ == '__main__':
   unittest.main()
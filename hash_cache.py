@@ -0,0 +1,236 @@
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Persistent cache of file hashes, validated against file status."""
+
+import base64
+import binascii
+import json
+import os
+import tempfile
+import threading
+import time
+
+import common_util
+import log_util
+
+
+# Module-local log function.
+def _Log(message, *args):
+  return log_util.LogWithTag('HASH_CACHE', message, *args)
+
+
+HASH_CACHE_FILE = '.hash_cache.json'
+
+# Minimum number of seconds between writes of the database after misses;
+# entries added meanwhile are saved by the next write or by Save.
+SAVE_INTERVAL = 10
+
+# Hash types and the common_util.GetFileHashes argument computing them.
+_HASH_ARGS = {
+    'md5': 'do_md5',
+    'sha1': 'do_sha1',
+    'sha256': 'do_sha256',
+}
+
+
+def _EncodeHash(hash_type, digest):
+  """Encodes a binary digest the way the common_util getters do."""
+  if hash_type == 'md5':
+    return binascii.hexlify(digest)
+  return base64.b64encode(digest)
+
+
+def GetStatKey(path):
+  """Returns the [dev, inode, size, mtime_ns] identity of a file.
+
+  Raises:
+    OSError: if the file cannot be stat'ed.
+  """
+  st = os.stat(path)
+  mtime_ns = getattr(st, 'st_mtime_ns', None)
+  if mtime_ns is None:
+    mtime_ns = int(st.st_mtime * 1000000000)
+  return [st.st_dev, st.st_ino, st.st_size, mtime_ns]
+
+
+class HashCache(object):
+  """Caches file hashes keyed by path.
+
+  A cached hash is only used while the file's device, inode, size and mtime
+  match those it was computed for. Entries are optionally persisted to a JSON
+  database so that hashes of large images survive devserver restarts, and can
+  be refreshed in the background when the files they describe change.
+
+  Members:
+    hits:      number of lookups answered from the cache.
+    misses:    number of lookups for which a file had to be hashed.
+    refreshes: number of entries rehashed in the background.
+  """
+
+  def __init__(self, db_path=None):
+    """Initializes the cache, loading db_path if it exists."""
+    self._db_path = db_path
+    self._lock = threading.Lock()
+    self._save_lock = threading.Lock()
+    self._dirty = False
+    self._last_save = 0
+    self._hash_flight = common_util.SingleFlight()
+    self._refresh_thread = None
+    # Dictionaries with a 'stat' key and hashes by type, keyed by file path.
+    self._entries = {}
+    self.hits = 0
+    self.misses = 0
+    self.refreshes = 0
+    self._Load()
+
+  def _Load(self):
+    if not (self._db_path and os.path.exists(self._db_path)):
+      return
+    try:
+      with open(self._db_path) as db_file:
+        self._entries = json.load(db_file)
+    except (IOError, ValueError) as e:
+      _Log('Ignoring unreadable hash cache %s: %s', self._db_path, e)
+
+  def Save(self):
+    """Atomically writes the cache database, if entries changed."""
+    if not self._db_path:
+      return
+    db_dir = os.path.dirname(self._db_path)
+    if not os.path.isdir(db_dir):
+      return
+    with self._save_lock:
+      with self._lock:
+        if not self._dirty:
+          return
+        data = json.dumps(self._entries)
+        self._dirty = False
+        self._last_save = time.time()
+      try:
+        fd, tmp_path = tempfile.mkstemp(dir=db_dir, prefix=HASH_CACHE_FILE)
+        with os.fdopen(fd, 'w') as db_file:
+          db_file.write(data)
+        os.rename(tmp_path, self._db_path)
+      except (IOError, OSError) as e:
+        _Log('Failed to save hash cache %s: %s', self._db_path, e)
+
+  def _SaveSoon(self):
+    """Saves the database now, unless it was saved too recently."""
+    with self._lock:
+      self._dirty = True
+      due = time.time() - self._last_save >= SAVE_INTERVAL
+    if due:
+      self.Save()
+
+  def _Hash(self, path, hash_types):
+    """Hashes path in a single pass and records the result."""
+    stat_key = GetStatKey(path)
+    hashes = common_util.GetFileHashes(
+        path, **dict((_HASH_ARGS[t], True) for t in hash_types))
+    if GetStatKey(path) != stat_key:
+      # The file changed while it was being hashed; don't cache the result.
+      return dict((t, _EncodeHash(t, hashes[t])) for t in hash_types)
+
+    with self._lock:
+      entry = self._entries.get(path)
+      if not entry or entry['stat'] != stat_key:
+        entry = {'stat': stat_key}
+        self._entries[path] = entry
+      for hash_type in hash_types:
+        entry[hash_type] = _EncodeHash(hash_type, hashes[hash_type])
+      entry = dict(entry)
+    self._SaveSoon()
+    return entry
+
+  def GetHashes(self, path, hash_types):
+    """Returns the requested hashes of a file.
+
+    Args:
+      path: path to the file.
+      hash_types: iterable of 'md5', 'sha1' and/or 'sha256'.
+    Returns:
+      A dictionary of hex encoded MD5 and base64 encoded SHA1/SHA256 hashes,
+      keyed by hash type.
+    Raises:
+      OSError: if the file cannot be stat'ed.
+      IOError: if the file cannot be read.
+    """
+    path = os.path.abspath(path)
+    stat_key = GetStatKey(path)
+    with self._lock:
+      entry = self._entries.get(path)
+      if entry and entry['stat'] == stat_key:
+        missing = [t for t in hash_types if t not in entry]
+      else:
+        missing = list(hash_types)
+      if not missing:
+        self.hits += 1
+        return dict((t, entry[t]) for t in hash_types)
+      self.misses += 1
+
+    entry = self._hash_flight.Do((path, tuple(sorted(missing))),
+                                 lambda: self._Hash(path, missing))
+    if any(t not in entry for t in hash_types):
+      # The file changed since the hashes that were not missing were
+      # computed, so those are stale too.
+      entry = self._Hash(path, hash_types)
+    return dict((t, entry[t]) for t in hash_types)
+
+  def GetFileMd5(self, path):
+    """Returns the hex encoded MD5 of a file, as common_util.GetFileMd5."""
+    try:
+      return self.GetHashes(path, ['md5'])['md5']
+    except OSError:
+      # Files we cannot stat are hashed without caching.
+      return common_util.GetFileMd5(path)
+
+  def Refresh(self):
+    """Rehashes cached files that changed and drops those that are gone."""
+    with self._lock:
+      paths = self._entries.keys()
+
+    for path in paths:
+      with self._lock:
+        entry = self._entries.get(path)
+      if not entry:
+        continue
+      try:
+        if GetStatKey(path) == entry['stat']:
+          continue
+        self._Hash(path, [t for t in _HASH_ARGS if t in entry])
+        with self._lock:
+          self.refreshes += 1
+      except (IOError, OSError):
+        with self._lock:
+          self._entries.pop(path, None)
+          self._dirty = True
+    self.Save()
+
+  def StartBackgroundRefresh(self, interval):
+    """Starts a daemon thread that calls Refresh every interval seconds.
+
+    Refresh also saves entries added since the database was last written.
+    """
+    if self._refresh_thread:
+      return
+
+    def _RefreshLoop():
+      while True:
+        time.sleep(interval)
+        try:
+          self.Refresh()
+        except Exception as e:
+          _Log('Background hash refresh failed: %s', e)
+
+    self._refresh_thread = threading.Thread(target=_RefreshLoop,
+                                            name='hash_cache_refresh')
+    self._refresh_thread.daemon = True
+    self._refresh_thread.start()
+
+  def Stats(self):
+    """Returns a dictionary of cache counters."""
+    with self._lock:
+      return {'entries': len(self._entries), 'hits': self.hits,
+              'misses': self.misses, 'refreshes': self.refreshes}
@@ -0,0 +1,106 @@
+#!/usr/bin/python
+
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unit tests for hash_cache module."""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import common_util
+import hash_cache
+
+
+class HashCacheTest(unittest.TestCase):
+
+  def setUp(self):
+    self._test_dir = tempfile.mkdtemp('hash_cache_unittest')
+    self._db_path = os.path.join(self._test_dir, hash_cache.HASH_CACHE_FILE)
+    self._file_path = os.path.join(self._test_dir, 'image.bin')
+    self._WriteFile('some image')
+
+  def tearDown(self):
+    shutil.rmtree(self._test_dir)
+
+  def _WriteFile(self, content):
+    with open(self._file_path, 'w') as f:
+      f.write(content)
+
+  def testGetHashes(self):
+    cache = hash_cache.HashCache(self._db_path)
+    hashes = cache.GetHashes(self._file_path, ['md5', 'sha1', 'sha256'])
+    self.assertEqual(hashes['md5'], common_util.GetFileMd5(self._file_path))
+    self.assertEqual(hashes['sha1'], common_util.GetFileSha1(self._file_path))
+    self.assertEqual(hashes['sha256'],
+                     common_util.GetFileSha256(self._file_path))
+    self.assertEqual(cache.GetFileMd5(self._file_path), hashes['md5'])
+    self.assertEqual(cache.Stats(),
+                     {'entries': 1, 'hits': 1, 'misses': 1, 'refreshes': 0})
+
+  def testChangedFileIsRehashed(self):
+    cache = hash_cache.HashCache(self._db_path)
+    old_md5 = cache.GetFileMd5(self._file_path)
+    self._WriteFile('another image')
+    new_md5 = cache.GetFileMd5(self._file_path)
+    self.assertNotEqual(old_md5, new_md5)
+    self.assertEqual(new_md5, common_util.GetFileMd5(self._file_path))
+    self.assertEqual(cache.misses, 2)
+
+  def testFileChangedWhileHashingPartialMiss(self):
+    cache = hash_cache.HashCache(self._db_path)
+    cache.GetFileMd5(self._file_path)
+
+    get_file_hashes = common_util.GetFileHashes
+    def _ChangeFileOnce(*args, **kwargs):
+      common_util.GetFileHashes = get_file_hashes
+      hashes = get_file_hashes(*args, **kwargs)
+      self._WriteFile('another, larger image')
+      return hashes
+
+    common_util.GetFileHashes = _ChangeFileOnce
+    try:
+      hashes = cache.GetHashes(self._file_path, ['md5', 'sha1'])
+    finally:
+      common_util.GetFileHashes = get_file_hashes
+    self.assertEqual(hashes['md5'], common_util.GetFileMd5(self._file_path))
+    self.assertEqual(hashes['sha1'], common_util.GetFileSha1(self._file_path))
+
+  def testSaveIsDeferred(self):
+    cache = hash_cache.HashCache(self._db_path)
+    cache.GetFileMd5(self._file_path)
+    other_path = os.path.join(self._test_dir, 'other.bin')
+    with open(other_path, 'w') as f:
+      f.write('other image')
+    cache.GetFileMd5(other_path)
+    self.assertEqual(hash_cache.HashCache(self._db_path).Stats()['entries'], 1)
+    cache.Save()
+    self.assertEqual(hash_cache.HashCache(self._db_path).Stats()['entries'], 2)
+
+  def testPersistence(self):
+    md5 = hash_cache.HashCache(self._db_path).GetFileMd5(self._file_path)
+    cache = hash_cache.HashCache(self._db_path)
+    self.assertEqual(cache.GetFileMd5(self._file_path), md5)
+    self.assertEqual(cache.hits, 1)
+    self.assertEqual(cache.misses, 0)
+
+  def testRefresh(self):
+    cache = hash_cache.HashCache(self._db_path)
+    cache.GetFileMd5(self._file_path)
+    self._WriteFile('another image')
+    cache.Refresh()
+    self.assertEqual(cache.refreshes, 1)
+    self.assertEqual(cache.GetFileMd5(self._file_path),
+                     common_util.GetFileMd5(self._file_path))
+    self.assertEqual(cache.misses, 1)
+
+    os.unlink(self._file_path)
+    cache.Refresh()
+    self.assertEqual(cache.Stats()['entries'], 0)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,423 @@
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Thread-safe, bounded records of hosts engaging in update activity."""
+
+import collections
+import heapq
+import itertools
+from multiprocessing import managers
+from multiprocessing import util
+import signal
+import threading
+import time
+
+import host_journal
+import log_util
+
+
+# Module-local log function.
+def _Log(message, *args):
+  return log_util.LogWithTag('HOSTINFO', message, *args)
+
+
+# Number of log entries kept per host by default.
+DEFAULT_LOG_SIZE = 1000
+
+# Number of independently locked shards of a host table.
+DEFAULT_NUM_SHARDS = 16
+
+# Upper bound on the time between two sweeps for idle hosts, in seconds.
+MAX_SWEEP_INTERVAL = 60
+
+
+class HostLogEntry(object):
+  """A compact record of an update request made by a host.
+
+  Members:
+    seq:       position of the entry among all entries of its host table.
+    timestamp: time the entry was recorded, in seconds since the epoch.
+    Remaining members are the request fields of the same name, or None if
+    the request did not carry them.
+  """
+  FIELDS = ('version', 'track', 'board', 'event_result', 'event_type',
+            'previous_version')
+  __slots__ = ('seq', 'timestamp') + FIELDS
+
+  def __init__(self, seq, timestamp, version=None, track=None, board=None,
+               event_result=None, event_type=None, previous_version=None):
+    self.seq = seq
+    self.timestamp = timestamp
+    self.version = version
+    self.track = track
+    self.board = board
+    self.event_result = event_result
+    self.event_type = event_type
+    self.previous_version = previous_version
+
+  def ToDict(self):
+    """Returns the entry as a dictionary, the way it is served to clients."""
+    entry = dict((name, getattr(self, name)) for name in self.FIELDS
+                 if getattr(self, name) is not None)
+    entry['timestamp'] = time.strftime('%Y-%m-%d %H:%M:%S',
+                                       time.localtime(self.timestamp))
+    return entry
+
+
+class HostInfo(object):
+  """Records information about an individual host.
+
+  Members:
+    attrs: Static attributes (legacy)
+    log: Most recent recorded client entries, oldest first
+    last_seen: time of the last request from or about the host
+  """
+
+  def __init__(self, log_size=DEFAULT_LOG_SIZE):
+    # A dictionary of current attributes pertaining to the host.
+    self.attrs = {}
+
+    # A ring buffer of HostLogEntry objects; old entries are dropped once
+    # log_size entries have been recorded.
+    self.log = collections.deque(maxlen=log_size)
+
+    self.last_seen = time.time()
+
+  def __repr__(self):
+    return 'attrs=%s, log=%s' % (self.attrs, self.GetLog())
+
+  def AddLogEntry(self, entry, seq=0, timestamp=None):
+    """Append a new log entry, given as a dictionary of request fields.
+
+    Returns:
+      The HostLogEntry appended.
+    """
+    assert not 'timestamp' in entry, 'Oops, timestamp field already in use'
+    log_entry = HostLogEntry(seq, timestamp or time.time(), **entry)
+    self.log.append(log_entry)
+    return log_entry
+
+  def GetLog(self):
+    """Returns the log as a list of dictionaries."""
+    return [entry.ToDict() for entry in self.log]
+
+
+class HostInfoTable(object):
+  """Records information about a set of hosts who engage in update activity.
+
+  Hosts are spread over shards, each protected by its own lock, so that
+  requests from different hosts rarely contend. Methods that read host
+  information return copies made under the lock, and hosts not heard of for
+  idle_timeout seconds are evicted.
+
+  Given a host_journal.HostJournal, changes to hosts are also recorded to
+  it, and hosts it holds records of are restored from it when first looked
+  up.
+
+  Members:
+    log_size:     number of log entries kept per host.
+    idle_timeout: seconds after which idle hosts are evicted, or 0 for never.
+    evictions:    number of hosts evicted so far.
+  """
+
+  def __init__(self, log_size=DEFAULT_LOG_SIZE, idle_timeout=0,
+               num_shards=DEFAULT_NUM_SHARDS, journal=None):
+    self.log_size = log_size
+    self.idle_timeout = idle_timeout
+    self.evictions = 0
+    # Dictionaries of HostInfo objects keyed by host ID (normally an IP
+    # address), along with the locks protecting them.
+    self._shards = [{} for _ in range(num_shards)]
+    self._locks = [threading.Lock() for _ in range(num_shards)]
+    self._sweep_lock = threading.Lock()
+    self._last_sweep = time.time()
+    self._journal = journal
+    # Source of log entry sequence numbers; next() on it is atomic.
+    self._seq = itertools.count((journal.max_seq if journal else 0) + 1)
+
+  def __repr__(self):
+    return '%s' % self.GetAllHostIds()
+
+  def __len__(self):
+    return sum(len(shard) for shard in self._shards)
+
+  def _GetShard(self, host_id):
+    index = hash(host_id) % len(self._shards)
+    return self._shards[index], self._locks[index]
+
+  def _LookupLocked(self, shard, host_id):
+    """Returns a host's info object or None; assumes the lock is held."""
+    host_info = shard.get(host_id)
+    if host_info is None and self._journal and self._journal.HasHost(host_id):
+      restored = self._journal.Restore(host_id)
+      if restored:
+        attrs, log = restored
+        host_info = shard[host_id] = HostInfo(self.log_size)
+        host_info.attrs.update(attrs)
+        for seq, timestamp, entry in log:
+          host_info.log.append(HostLogEntry(seq, timestamp, **entry))
+    return host_info
+
+  def _RestoreAll(self):
+    """Restores all hosts the journal holds records of."""
+    if self._journal:
+      for host_id in self._journal.GetHostIds():
+        shard, lock = self._GetShard(host_id)
+        with lock:
+          self._LookupLocked(shard, host_id)
+
+  def _GetInitLocked(self, shard, host_id):
+    """Returns a host's touched info object; assumes the lock is held."""
+    host_info = self._LookupLocked(shard, host_id)
+    if host_info is None:
+      host_info = shard[host_id] = HostInfo(self.log_size)
+    host_info.last_seen = time.time()
+    return host_info
+
+  def GetInitHostInfo(self, host_id):
+    """Return a host's info object, or create a new one if none exists."""
+    self._MaybeEvictIdle()
+    shard, lock = self._GetShard(host_id)
+    with lock:
+      return self._GetInitLocked(shard, host_id)
+
+  def GetHostInfo(self, host_id):
+    """Return an info object for given host, if such exists."""
+    shard, lock = self._GetShard(host_id)
+    with lock:
+      return self._LookupLocked(shard, host_id)
+
+  def GetAllHostIds(self):
+    """Returns a list of the IDs of all known hosts."""
+    self._RestoreAll()
+    host_ids = []
+    for shard, lock in zip(self._shards, self._locks):
+      with lock:
+        host_ids.extend(shard.keys())
+    return host_ids
+
+  def RecordRequest(self, host_id, attrs, log_entry=None, pop_attr=None):
+    """Atomically records a request made by a host.
+
+    Args:
+      host_id: ID of the requesting host.
+      attrs: dictionary of attributes to set on the host.
+      log_entry: dictionary of request fields to log, if any.
+      pop_attr: name of an attribute to remove and return, if any.
+    Returns:
+      The value of pop_attr before it was removed, or None.
+    """
+    self._MaybeEvictIdle()
+    shard, lock = self._GetShard(host_id)
+    with lock:
+      host_info = self._GetInitLocked(shard, host_id)
+      host_info.attrs.update(attrs)
+      seq = 0
+      timestamp = host_info.last_seen
+      if log_entry is not None:
+        seq = next(self._seq)
+        host_info.AddLogEntry(log_entry, seq, timestamp)
+      popped = host_info.attrs.pop(pop_attr, None) if pop_attr else None
+      if self._journal:
+        self._journal.Append(host_id, seq, timestamp, dict(host_info.attrs),
+                             log_entry)
+      return popped
+
+  def SetAttr(self, host_id, name, value):
+    """Sets an attribute of a host, creating the host if needed."""
+    shard, lock = self._GetShard(host_id)
+    with lock:
+      host_info = self._GetInitLocked(shard, host_id)
+      host_info.attrs[name] = value
+      if self._journal:
+        self._journal.Append(host_id, 0, host_info.last_seen,
+                             dict(host_info.attrs))
+
+  def GetAttrs(self, host_id):
+    """Returns a copy of a host's attributes, or None for unknown hosts."""
+    shard, lock = self._GetShard(host_id)
+    with lock:
+      host_info = self._LookupLocked(shard, host_id)
+      return dict(host_info.attrs) if host_info else None
+
+  def GetLog(self, host_id):
+    """Returns a host's log as a list of dictionaries, or None if unknown."""
+    shard, lock = self._GetShard(host_id)
+    with lock:
+      host_info = self._LookupLocked(shard, host_id)
+      return host_info.GetLog() if host_info else None
+
+  def GetAllLogs(self):
+    """Returns a dictionary of all host logs, keyed by host ID."""
+    self._RestoreAll()
+    logs = {}
+    for shard, lock in zip(self._shards, self._locks):
+      with lock:
+        for host_id, host_info in shard.iteritems():
+          logs[host_id] = host_info.GetLog()
+    return logs
+
+  def QueryLog(self, host_id=None, since=None, until=None, cursor=None,
+               event_type=None, event_result=None):
+    """Yields log entries matching all of the given filters.
+
+    Entries are snapshotted when the method is called and yielded in the
+    order they were recorded in, merging the logs of all hosts if needed.
+
+    Args:
+      host_id: ID of the host whose log to query, or None for all hosts.
+      since: only yield entries recorded at or after this time.
+      until: only yield entries recorded before this time.
+      cursor: only yield entries with a sequence number above this one.
+      event_type: only yield entries with this event type.
+      event_result: only yield entries with this event result.
+    Yields:
+      (host_id, HostLogEntry) tuples.
+    """
+    if host_id is None:
+      self._RestoreAll()
+      snapshots = []
+      for shard, lock in zip(self._shards, self._locks):
+        with lock:
+          snapshots.extend((h, list(info.log)) for h, info in shard.iteritems())
+    else:
+      shard, lock = self._GetShard(host_id)
+      with lock:
+        host_info = self._LookupLocked(shard, host_id)
+        snapshots = [(host_id, list(host_info.log))] if host_info else []
+
+    def _Filter(host_id, entries):
+      for entry in entries:
+        if ((cursor is None or entry.seq > cursor) and
+            (since is None or entry.timestamp >= since) and
+            (until is None or entry.timestamp < until) and
+            (event_type is None or entry.event_type == event_type) and
+            (event_result is None or entry.event_result == event_result)):
+          yield entry.seq, host_id, entry
+
+    for _, host_id, entry in heapq.merge(
+        *[_Filter(h, entries) for h, entries in snapshots]):
+      yield host_id, entry
+
+  def EvictIdle(self, now=None):
+    """Evicts hosts idle for longer than idle_timeout.
+
+    Returns:
+      The number of hosts evicted.
+    """
+    if not self.idle_timeout:
+      return 0
+    deadline = (now or time.time()) - self.idle_timeout
+    evicted = 0
+    for shard, lock in zip(self._shards, self._locks):
+      with lock:
+        idle = [host_id for host_id, host_info in shard.iteritems()
+                if host_info.last_seen < deadline]
+        for host_id in idle:
+          del shard[host_id]
+        evicted += len(idle)
+    if evicted:
+      with self._sweep_lock:
+        self.evictions += evicted
+      _Log('Evicted %d idle hosts', evicted)
+    return evicted
+
+  def _MaybeEvictIdle(self):
+    """Sweeps for idle hosts if the last sweep is old enough."""
+    if not self.idle_timeout:
+      return
+    now = time.time()
+    interval = min(self.idle_timeout, MAX_SWEEP_INTERVAL)
+    with self._sweep_lock:
+      if now - self._last_sweep < interval:
+        return
+      self._last_sweep = now
+    self.EvictIdle(now)
+
+  def Stats(self):
+    """Returns a dictionary describing the size of the table."""
+    hosts = 0
+    log_entries = 0
+    for shard, lock in zip(self._shards, self._locks):
+      with lock:
+        hosts += len(shard)
+        log_entries += sum(len(info.log) for info in shard.itervalues())
+    return {'hosts': hosts, 'log_entries': log_entries,
+            'evictions': self.evictions, 'shards': len(self._shards),
+            'log_size': self.log_size,
+            'unrestored_hosts': (len(self._journal.GetHostIds())
+                                 if self._journal else 0)}
+
+
+class _SharedHostInfoTable(HostInfoTable):
+  """A HostInfoTable whose query results can be sent to other processes."""
+
+  def QueryLog(self, *args, **kwargs):
+    return list(super(_SharedHostInfoTable, self).QueryLog(*args, **kwargs))
+
+
+# The table served by a HostInfoManager, in the manager's process.
+_shared_table = None
+
+
+def _InitSharedTable(log_size, idle_timeout, log_dir):
+  """Creates the shared table when a HostInfoManager starts."""
+  # Interrupts are for the devserver; it shuts the manager down on exit.
+  signal.signal(signal.SIGINT, signal.SIG_IGN)
+  journal = None
+  if log_dir:
+    journal = host_journal.HostJournal(log_dir, log_size)
+    journal.Open()
+    util.Finalize(journal, journal.Close, exitpriority=10)
+  global _shared_table
+  _shared_table = _SharedHostInfoTable(log_size=log_size,
+                                       idle_timeout=idle_timeout,
+                                       journal=journal)
+
+
+def _GetSharedTable():
+  return _shared_table
+
+
+class HostInfoManager(managers.BaseManager):
+  """Serves a single HostInfoTable to several devserver processes.
+
+  Start the manager with StartHostInfoManager, then have each process that
+  uses the table connect to it with Connect. HostInfoTable() returns a proxy
+  to the shared table, exposing the methods which do not return host info
+  objects. QueryLog returns a list rather than a generator.
+  """
+
+  def Connect(self):
+    """Returns a proxy to the shared table, from a new connection.
+
+    Processes forked after the manager was started must call this rather
+    than use proxies from their parent.
+    """
+    manager = HostInfoManager(address=self.address, authkey=self._authkey)
+    manager.connect()
+    return manager.HostInfoTable()
+
+
+HostInfoManager.register(
+    'HostInfoTable', callable=_GetSharedTable,
+    exposed=('GetAllHostIds', 'RecordRequest', 'SetAttr', 'GetAttrs',
+             'GetLog', 'GetAllLogs', 'QueryLog', 'EvictIdle', 'Stats'))
+
+
+def StartHostInfoManager(log_size=DEFAULT_LOG_SIZE, idle_timeout=0,
+                         log_dir=None):
+  """Starts a process serving a HostInfoTable to other processes.
+
+  Args:
+    log_size: number of log entries kept per host.
+    idle_timeout: seconds after which idle hosts are evicted, or 0 for never.
+    log_dir: directory of a host_journal.HostJournal backing the table, if
+             any; it is opened and closed by the manager process.
+  Returns:
+    The started HostInfoManager.
+  """
+  manager = HostInfoManager()
+  manager.start(_InitSharedTable, (log_size, idle_timeout, log_dir))
+  return manager
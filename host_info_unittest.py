@@ -0,0 +1,134 @@
+#!/usr/bin/python
+
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unit tests for host_info module."""
+
+import os
+import threading
+import time
+import unittest
+
+import host_info
+
+
+class HostInfoTableTest(unittest.TestCase):
+
+  def testRecordRequest(self):
+    table = host_info.HostInfoTable()
+    table.SetAttr('1.2.3.4', 'forced_update_label', 'label')
+    label = table.RecordRequest(
+        '1.2.3.4', {'last_known_version': '1.0'},
+        {'version': '1.0', 'event_type': 3}, pop_attr='forced_update_label')
+    self.assertEqual(label, 'label')
+    self.assertEqual(table.GetAttrs('1.2.3.4'),
+                     {'last_known_version': '1.0'})
+    log = table.GetLog('1.2.3.4')
+    self.assertEqual(len(log), 1)
+    self.assertEqual(log[0]['version'], '1.0')
+    self.assertEqual(log[0]['event_type'], 3)
+    self.assertFalse('board' in log[0])
+    self.assertTrue('timestamp' in log[0])
+    self.assertEqual(table.GetAllLogs(), {'1.2.3.4': log})
+
+  def testUnknownHost(self):
+    table = host_info.HostInfoTable()
+    self.assertEqual(table.GetHostInfo('1.2.3.4'), None)
+    self.assertEqual(table.GetAttrs('1.2.3.4'), None)
+    self.assertEqual(table.GetLog('1.2.3.4'), None)
+
+  def testLogIsBounded(self):
+    table = host_info.HostInfoTable(log_size=3)
+    for i in range(5):
+      table.RecordRequest('1.2.3.4', {}, {'version': str(i)})
+    self.assertEqual([e['version'] for e in table.GetLog('1.2.3.4')],
+                     ['2', '3', '4'])
+    self.assertEqual(table.Stats()['log_entries'], 3)
+
+  def testEvictIdle(self):
+    table = host_info.HostInfoTable(idle_timeout=60)
+    table.GetInitHostInfo('1.2.3.4')
+    table.GetInitHostInfo('5.6.7.8').last_seen -= 120
+    self.assertEqual(table.EvictIdle(), 1)
+    self.assertEqual(table.GetAllHostIds(), ['1.2.3.4'])
+    self.assertEqual(table.Stats()['evictions'], 1)
+
+  def testNoEvictionWithoutTimeout(self):
+    table = host_info.HostInfoTable()
+    table.GetInitHostInfo('1.2.3.4').last_seen = 0
+    self.assertEqual(table.EvictIdle(), 0)
+    self.assertEqual(len(table), 1)
+
+  def testQueryLog(self):
+    table = host_info.HostInfoTable()
+    table.RecordRequest('1.1.1.1', {}, {'version': 'a', 'event_type': 3})
+    table.RecordRequest('2.2.2.2', {}, {'version': 'b', 'event_type': 13})
+    table.RecordRequest('1.1.1.1', {}, {'version': 'c', 'event_type': 3})
+    table.GetInitHostInfo('2.2.2.2').log[0].timestamp -= 3600
+
+    def _Query(**filters):
+      return [(h, e.version) for h, e in table.QueryLog(**filters)]
+
+    self.assertEqual(_Query(), [('1.1.1.1', 'a'), ('2.2.2.2', 'b'),
+                                ('1.1.1.1', 'c')])
+    self.assertEqual(_Query(host_id='1.1.1.1'),
+                     [('1.1.1.1', 'a'), ('1.1.1.1', 'c')])
+    self.assertEqual(_Query(host_id='3.3.3.3'), [])
+    self.assertEqual(_Query(cursor=1), [('2.2.2.2', 'b'), ('1.1.1.1', 'c')])
+    self.assertEqual(_Query(event_type=13), [('2.2.2.2', 'b')])
+    self.assertEqual(_Query(since=time.time() - 60),
+                     [('1.1.1.1', 'a'), ('1.1.1.1', 'c')])
+    self.assertEqual(_Query(until=time.time() - 60), [('2.2.2.2', 'b')])
+
+  def testConcurrentRequests(self):
+    table = host_info.HostInfoTable(log_size=100)
+
+    def _Ping(thread_index):
+      for i in range(200):
+        table.RecordRequest('10.0.%d.%d' % (thread_index, i % 10),
+                            {'last_known_version': str(i)}, {'version': 'v'})
+
+    threads = [threading.Thread(target=_Ping, args=(i,)) for i in range(8)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    stats = table.Stats()
+    self.assertEqual(stats['hosts'], 80)
+    self.assertEqual(stats['log_entries'], 80 * 20)
+
+
+class HostInfoManagerTest(unittest.TestCase):
+
+  def testSharedAcrossProcesses(self):
+    manager = host_info.StartHostInfoManager(log_size=10)
+    try:
+      table = manager.Connect()
+      table.RecordRequest('1.1.1.1', {'last_known_version': '1.0'},
+                          {'version': '1.0'})
+      pid = os.fork()
+      if not pid:
+        exit_code = 1
+        try:
+          forked_table = manager.Connect()
+          forked_table.SetAttr('1.1.1.1', 'forced_update_label', 'label')
+          forked_table.RecordRequest('2.2.2.2', {}, {'version': '2.0'})
+          exit_code = 0
+        finally:
+          os._exit(exit_code)
+      self.assertEqual(os.waitpid(pid, 0)[1], 0)
+
+      self.assertEqual(table.GetAttrs('1.1.1.1'),
+                       {'last_known_version': '1.0',
+                        'forced_update_label': 'label'})
+      self.assertEqual([(h, e.version) for h, e in table.QueryLog()],
+                       [('1.1.1.1', '1.0'), ('2.2.2.2', '2.0')])
+      self.assertEqual(table.Stats()['hosts'], 2)
+    finally:
+      manager.shutdown()
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,298 @@
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Append-only on-disk journal of host update activity."""
+
+import collections
+import json
+import os
+import Queue
+import re
+import threading
+import time
+
+import log_util
+
+
+# Module-local log function.
+def _Log(message, *args):
+  return log_util.LogWithTag('HOSTJOURNAL', message, *args)
+
+
+# Segments are rotated once they grow past this many bytes.
+SEGMENT_SIZE = 16 * 1024 * 1024
+
+# Number of most recent segments kept; older ones are deleted on rotation.
+MAX_SEGMENTS = 16
+
+# Maximum number of seconds between writing a record and syncing it to disk.
+SYNC_INTERVAL = 1.0
+
+_SEGMENT_RE = re.compile(r'^hostlog\.(\d+)\.ndjson$')
+
+# Every record starts with its host and seq, so that segments can be indexed
+# without decoding whole records.
+_RECORD_PREFIX_RE = re.compile(r'^\{"ip": ("(?:[^"\\]|\\.)*"), "seq": (\d+),')
+
+
+# Queued to make the writer thread exit.
+_STOP = object()
+
+
+def _SegmentName(index):
+  return 'hostlog.%08d.ndjson' % index
+
+
+def _EncodeRecord(host_id, seq, timestamp, attrs, entry):
+  """Returns a record as a line of JSON, starting with the host and seq."""
+  record = '{"ip": %s, "seq": %d, "t": %r, "a": %s' % (
+      json.dumps(host_id), seq, timestamp, json.dumps(attrs))
+  if entry is not None:
+    record += ', "e": %s' % json.dumps(entry)
+  return record + '}\n'
+
+
+class _HostIndex(object):
+  """Locations of the journal records needed to restore a host.
+
+  Locations are (segment index, offset) pairs.
+
+  Members:
+    latest: location of the most recent record, which holds all attributes.
+    log:    locations of the records holding the most recent log entries.
+  """
+  __slots__ = ('latest', 'log')
+
+  def __init__(self, log_size):
+    self.latest = None
+    self.log = collections.deque(maxlen=log_size)
+
+
+class HostJournal(object):
+  """Records host attributes and events to rotating NDJSON segments.
+
+  Each record is a line holding the host ID (ip), the seq number of its log
+  entry (0 if it has none), its time (t), all attributes of the host after
+  the change (a) and the log entry, if any (e). Appending a record only
+  queues it; a writer thread encodes and writes queued records in batches
+  and syncs them to disk at most SYNC_INTERVAL seconds later.
+
+  When opened, existing segments are scanned to index, by host, the records
+  needed to restore it; hosts are only restored from disk when looked up.
+
+  Members:
+    log_dir:  directory holding the segments.
+    log_size: number of log entries restored per host.
+    max_seq:  highest log entry seq number found in existing segments.
+  """
+
+  def __init__(self, log_dir, log_size, segment_size=SEGMENT_SIZE,
+               max_segments=MAX_SEGMENTS, sync_interval=SYNC_INTERVAL):
+    self.log_dir = log_dir
+    self.log_size = log_size
+    self.max_seq = 0
+    self._segment_size = segment_size
+    self._max_segments = max_segments
+    self._sync_interval = sync_interval
+    self._lock = threading.Lock()
+    self._queue = Queue.Queue()
+    # _HostIndex objects of hosts not restored yet, keyed by host ID.
+    self._index = {}
+    self._segments = []
+    self._file = None
+    self._writer = None
+
+  def Open(self):
+    """Indexes existing segments and starts writing to a new one."""
+    if not os.path.isdir(self.log_dir):
+      os.makedirs(self.log_dir)
+    self._segments = sorted(
+        int(m.group(1)) for m in map(_SEGMENT_RE.match,
+                                     os.listdir(self.log_dir)) if m)
+    start_time = time.time()
+    end = 0
+    for segment in self._segments:
+      end = self._IndexSegment(segment)
+    _Log('Indexed %d hosts from %d segments in %.3fs', len(self._index),
+         len(self._segments), time.time() - start_time)
+
+    # Keep appending to the last segment, so that restarting does not rotate
+    # away the records of hosts that were not seen since. It may end with a
+    # partial record if the devserver was killed while writing it, which is
+    # cut off first.
+    if self._segments and end < self._segment_size:
+      segment = self._segments.pop()
+      with open(os.path.join(self.log_dir, _SegmentName(segment)),
+                'r+b') as f:
+        f.truncate(end)
+    else:
+      segment = self._segments[-1] + 1 if self._segments else 0
+    self._OpenSegment(segment)
+    self._writer = threading.Thread(target=self._WriteLoop,
+                                    name='host_journal_writer')
+    self._writer.daemon = True
+    self._writer.start()
+
+  def _IndexSegment(self, segment):
+    """Indexes the records of a segment.
+
+    Returns:
+      The offset just past the last complete line of the segment.
+    """
+    offset = 0
+    end = 0
+    with open(os.path.join(self.log_dir, _SegmentName(segment)), 'rb') as f:
+      for line in f:
+        match = _RECORD_PREFIX_RE.match(line)
+        if match and line.endswith('\n'):
+          host_id = json.loads(match.group(1))
+          seq = int(match.group(2))
+          host_index = self._index.get(host_id)
+          if host_index is None:
+            host_index = self._index[host_id] = _HostIndex(self.log_size)
+          host_index.latest = (segment, offset)
+          if seq:
+            host_index.log.append((segment, offset))
+            self.max_seq = max(self.max_seq, seq)
+        offset += len(line)
+        if line.endswith('\n'):
+          end = offset
+    return end
+
+  def _OpenSegment(self, segment):
+    if self._file:
+      self._file.close()
+    self._file = open(os.path.join(self.log_dir, _SegmentName(segment)), 'ab')
+    self._segments.append(segment)
+    while len(self._segments) > self._max_segments:
+      try:
+        os.remove(os.path.join(self.log_dir,
+                               _SegmentName(self._segments.pop(0))))
+      except OSError as e:
+        _Log('Failed to remove old journal segment: %s', e)
+
+  def Append(self, host_id, seq, timestamp, attrs, entry=None):
+    """Queues a record of a change to a host.
+
+    Args:
+      host_id: ID of the host.
+      seq: seq number of the log entry, or 0 if there is none.
+      timestamp: time of the change, in seconds since the epoch.
+      attrs: dictionary of all host attributes after the change; it must not
+             be modified afterwards.
+      entry: dictionary of the logged request fields, if any.
+    """
+    self._queue.put((host_id, seq, timestamp, attrs, entry))
+
+  def Flush(self):
+    """Blocks until all queued records have been written and synced."""
+    done = threading.Event()
+    self._queue.put(done)
+    done.wait()
+
+  def Close(self):
+    """Writes and syncs all queued records and stops the writer thread."""
+    if not self._writer:
+      return
+    self._queue.put(_STOP)
+    self._writer.join()
+    self._writer = None
+    self._file.close()
+    self._file = None
+
+  def _WriteLoop(self):
+    last_sync = time.time()
+    dirty = False
+    stop = False
+    while not stop:
+      try:
+        item = self._queue.get(timeout=self._sync_interval)
+      except Queue.Empty:
+        item = None
+
+      # Write whatever else is queued along with the first record.
+      waiters = []
+      lines = []
+      while item is not None:
+        if isinstance(item, tuple):
+          lines.append(_EncodeRecord(*item))
+        elif item is _STOP:
+          stop = True
+        else:
+          waiters.append(item)
+        try:
+          item = self._queue.get_nowait()
+        except Queue.Empty:
+          item = None
+
+      try:
+        if lines:
+          self._file.write(''.join(lines))
+          dirty = True
+        now = time.time()
+        if dirty and (waiters or stop or
+                      now - last_sync >= self._sync_interval):
+          self._file.flush()
+          os.fsync(self._file.fileno())
+          last_sync = now
+          dirty = False
+          if self._file.tell() >= self._segment_size:
+            self._OpenSegment(self._segments[-1] + 1)
+      except (IOError, OSError) as e:
+        _Log('Failed to write host journal: %s', e)
+
+      for waiter in waiters:
+        waiter.set()
+
+  def HasHost(self, host_id):
+    """Returns whether host_id has records that were not restored yet."""
+    return host_id in self._index
+
+  def GetHostIds(self):
+    """Returns a list of hosts with records that were not restored yet."""
+    with self._lock:
+      return self._index.keys()
+
+  def _ReadRecord(self, files, location):
+    segment, offset = location
+    f = files.get(segment)
+    if f is None:
+      f = files[segment] = open(
+          os.path.join(self.log_dir, _SegmentName(segment)), 'rb')
+    f.seek(offset)
+    return json.loads(f.readline())
+
+  def Restore(self, host_id):
+    """Reads the records of a host that was not restored yet.
+
+    A host is only restored once; subsequent calls return None.
+
+    Returns:
+      A (attrs, log) tuple, where log is a list of (seq, timestamp, entry)
+      tuples, oldest first, or None if there is nothing to restore.
+    """
+    with self._lock:
+      host_index = self._index.pop(host_id, None)
+    if not host_index:
+      return None
+
+    attrs = {}
+    log = []
+    files = {}
+    try:
+      try:
+        attrs = self._ReadRecord(files, host_index.latest)['a']
+      except (IOError, ValueError) as e:
+        _Log('Failed to restore attributes of %s: %s', host_id, e)
+      for location in host_index.log:
+        try:
+          record = self._ReadRecord(files, location)
+        except (IOError, ValueError):
+          # The segment was rotated away.
+          continue
+        log.append((record['seq'], record['t'], record['e']))
+    finally:
+      for f in files.itervalues():
+        f.close()
+    return attrs, log
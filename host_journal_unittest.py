@@ -0,0 +1,119 @@
+#!/usr/bin/python
+
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unit tests for host_journal module."""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import host_info
+import host_journal
+
+
+class HostJournalTest(unittest.TestCase):
+
+  def setUp(self):
+    self._log_dir = tempfile.mkdtemp('host_journal_unittest')
+    self._journals = []
+
+  def tearDown(self):
+    for journal in self._journals:
+      journal.Close()
+    shutil.rmtree(self._log_dir)
+
+  def _OpenTable(self, log_size=10, **kwargs):
+    journal = host_journal.HostJournal(self._log_dir, log_size, **kwargs)
+    journal.Open()
+    self._journals.append(journal)
+    return host_info.HostInfoTable(log_size=log_size, journal=journal), journal
+
+  def testRestoredAfterRestart(self):
+    table, journal = self._OpenTable()
+    table.RecordRequest('1.1.1.1', {'last_known_version': '1.0'},
+                        {'version': '1.0', 'event_type': 3})
+    table.SetAttr('1.1.1.1', 'forced_update_label', 'label')
+    table.RecordRequest('2.2.2.2', {'last_known_version': '2.0'})
+    journal.Flush()
+    old_log = table.GetLog('1.1.1.1')
+
+    table, journal = self._OpenTable()
+    self.assertEqual(table.Stats()['unrestored_hosts'], 2)
+    self.assertEqual(table.GetAttrs('1.1.1.1'),
+                     {'last_known_version': '1.0',
+                      'forced_update_label': 'label'})
+    self.assertEqual(table.GetLog('1.1.1.1'), old_log)
+    self.assertEqual(table.Stats()['unrestored_hosts'], 1)
+    self.assertEqual(table.GetAttrs('2.2.2.2'), {'last_known_version': '2.0'})
+    self.assertEqual(table.GetLog('3.3.3.3'), None)
+
+    # Sequence numbers carry on after those in the journal.
+    table.RecordRequest('1.1.1.1', {}, {'version': '1.1'})
+    self.assertEqual([e.seq for _, e in table.QueryLog()], [1, 2])
+
+  def testRestoredLogIsBounded(self):
+    table, journal = self._OpenTable(log_size=3)
+    for i in range(5):
+      table.RecordRequest('1.1.1.1', {}, {'version': str(i)})
+    journal.Flush()
+
+    table, journal = self._OpenTable(log_size=3)
+    self.assertEqual([e['version'] for e in table.GetLog('1.1.1.1')],
+                     ['2', '3', '4'])
+
+  def testPartialRecordIgnored(self):
+    table, journal = self._OpenTable()
+    table.RecordRequest('1.1.1.1', {}, {'version': '1.0'})
+    journal.Flush()
+    segment = os.path.join(self._log_dir, os.listdir(self._log_dir)[0])
+    with open(segment, 'a') as f:
+      f.write('{"ip": "2.2.2.2", "seq": 7, "t"')
+
+    table, journal = self._OpenTable()
+    self.assertEqual(journal.max_seq, 1)
+    self.assertEqual(sorted(table.GetAllHostIds()), ['1.1.1.1'])
+
+  def testRestoredAfterManyRestarts(self):
+    table, journal = self._OpenTable()
+    table.RecordRequest('1.1.1.1', {'last_known_version': '1.0'},
+                        {'version': '1.0'})
+    journal.Flush()
+    for _ in range(host_journal.MAX_SEGMENTS + 1):
+      journal.Close()
+      table, journal = self._OpenTable()
+    self.assertEqual(len(os.listdir(self._log_dir)), 1)
+    self.assertEqual(table.GetAttrs('1.1.1.1'), {'last_known_version': '1.0'})
+    self.assertEqual([e['version'] for e in table.GetLog('1.1.1.1')], ['1.0'])
+
+  def testPartialRecordOverwritten(self):
+    table, journal = self._OpenTable()
+    table.RecordRequest('1.1.1.1', {}, {'version': '1.0'})
+    journal.Flush()
+    segment = os.path.join(self._log_dir, os.listdir(self._log_dir)[0])
+    with open(segment, 'a') as f:
+      f.write('{"ip": "2.2.2.2", "seq": 7, "t"')
+
+    table, journal = self._OpenTable()
+    table.RecordRequest('3.3.3.3', {}, {'version': '3.0'})
+    journal.Flush()
+    table, journal = self._OpenTable()
+    self.assertEqual(sorted(table.GetAllHostIds()), ['1.1.1.1', '3.3.3.3'])
+    self.assertEqual([e['version'] for e in table.GetLog('3.3.3.3')], ['3.0'])
+
+  def testRotation(self):
+    table, journal = self._OpenTable(segment_size=1, max_segments=2)
+    for i in range(4):
+      table.RecordRequest('1.1.1.1', {}, {'version': str(i)})
+      journal.Flush()
+    self.assertEqual(len(os.listdir(self._log_dir)), 2)
+
+    table, journal = self._OpenTable()
+    self.assertEqual([e['version'] for e in table.GetLog('1.1.1.1')], ['3'])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,133 @@
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Resolution of the latest image built for a board."""
+
+import os
+import threading
+import time
+
+import log_util
+
+
+# Module-local log function.
+def _Log(message, *args):
+  return log_util.LogWithTag('LATEST_IMAGE', message, *args)
+
+
+# Name of the link to the latest image directory in the images directory of
+# a board.
+LATEST_LINK = 'latest'
+
+# Seconds for which the latest image directory of a board is used without
+# resolving it again, as long as the images directory does not change. This
+# bounds how long it takes to notice an older build directory that became
+# the most recently modified one.
+REFRESH_INTERVAL = 10
+
+
+class LatestImageResolver(object):
+  """Finds the latest image directory of a board, as get_latest_image.sh does.
+
+  The latest image directory is the target of the `latest' link in the images
+  directory of the board, <build root>/images/<board>, or else the most
+  recently modified entry of the images directory. It is found by scanning
+  the images directory, and cached per board until the images directory
+  changes or REFRESH_INTERVAL passes. get_latest_image.sh is only run when
+  the images directory cannot be scanned, and its output is cached likewise.
+
+  Members:
+    scripts_dir: src/scripts directory of the SDK, holding
+                 get_latest_image.sh.
+    build_root:  directory holding the images directory, $CHROMEOS_BUILD_ROOT
+                 or the build directory next to scripts_dir by default.
+  """
+
+  def __init__(self, scripts_dir, build_root=None):
+    self.scripts_dir = scripts_dir
+    if build_root is None and scripts_dir:
+      build_root = os.environ.get('CHROMEOS_BUILD_ROOT') or os.path.join(
+          os.path.dirname(os.path.abspath(scripts_dir)), 'build')
+    self.build_root = build_root
+    self._lock = threading.Lock()
+    # (images directory mtime, resolution time, latest image directory),
+    # keyed by board.
+    self._latest = {}
+    self._counters = {'hits': 0, 'scans': 0, 'script_runs': 0}
+
+  @staticmethod
+  def _ScanImagesDir(images_dir):
+    """Returns the latest image directory in images_dir, or None if empty.
+
+    Like `ls -t | head -1', entries are ordered by their own mtime, newest
+    first, then by name, and hidden entries are skipped.
+
+    Raises:
+      OSError: if images_dir cannot be listed.
+    """
+    link = os.path.join(images_dir, LATEST_LINK)
+    if os.path.islink(link):
+      return os.path.realpath(link)
+
+    latest = None
+    for name in os.listdir(images_dir):
+      if name.startswith('.'):
+        continue
+      try:
+        key = (-os.lstat(os.path.join(images_dir, name)).st_mtime, name)
+      except OSError:
+        continue
+      if latest is None or key < latest:
+        latest = key
+    return os.path.join(images_dir, latest[1]) if latest else None
+
+  def _RunScript(self, board):
+    """Returns the latest image directory get_latest_image.sh prints."""
+    cmd = '%s/get_latest_image.sh --board %s' % (self.scripts_dir, board)
+    return os.popen(cmd).read().strip()
+
+  def GetLatestImageDir(self, board):
+    """Returns the latest image directory of a board.
+
+    Args:
+      board: name of the board.
+    Returns:
+      Full path to the directory, or '' if none is found.
+    """
+    board = board.strip()
+    images_dir = None
+    mtime = None
+    if self.build_root:
+      images_dir = os.path.join(self.build_root, 'images', board)
+      try:
+        mtime = os.stat(images_dir).st_mtime
+      except OSError:
+        pass
+
+    now = time.time()
+    with self._lock:
+      cached = self._latest.get(board)
+      if cached and cached[0] == mtime and now - cached[1] < REFRESH_INTERVAL:
+        self._counters['hits'] += 1
+        return cached[2]
+
+    latest_dir = None
+    counter = 'scans'
+    if mtime is not None:
+      try:
+        latest_dir = self._ScanImagesDir(images_dir)
+      except OSError as e:
+        _Log('Failed to scan %s: %s', images_dir, e)
+    if not latest_dir:
+      latest_dir = self._RunScript(board)
+      counter = 'script_runs'
+    with self._lock:
+      self._latest[board] = (mtime, now, latest_dir)
+      self._counters[counter] += 1
+    return latest_dir
+
+  def Stats(self):
+    """Returns a dictionary of resolution counters."""
+    with self._lock:
+      return dict(self._counters)
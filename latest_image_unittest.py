@@ -0,0 +1,93 @@
+#!/usr/bin/python
+
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unit tests for latest_image.py."""
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import mox
+
+import latest_image
+
+
+class LatestImageResolverTest(mox.MoxTestBase):
+
+  def setUp(self):
+    mox.MoxTestBase.setUp(self)
+    self.src_dir = tempfile.mkdtemp('latest_image_unittest')
+    self.scripts_dir = os.path.join(self.src_dir, 'scripts')
+    self.images_dir = os.path.join(self.src_dir, 'build', 'images',
+                                   'test-board')
+    os.makedirs(self.images_dir)
+    self.build_dirs = []
+    for i, build in enumerate(['100.0.0-a1', '102.0.0-a1', '101.0.0-a1']):
+      self.build_dirs.append(self._AddBuild(build, time.time() - 100 + i))
+    self.resolver = latest_image.LatestImageResolver(self.scripts_dir)
+    self.mox.StubOutWithMock(self.resolver, '_RunScript')
+
+  def tearDown(self):
+    shutil.rmtree(self.src_dir)
+
+  def _AddBuild(self, build, mtime):
+    build_dir = os.path.join(self.images_dir, build)
+    os.mkdir(build_dir)
+    os.utime(build_dir, (mtime, mtime))
+    return build_dir
+
+  def testMostRecentlyModified(self):
+    self.mox.ReplayAll()
+    self.assertEqual(self.resolver.GetLatestImageDir('test-board\n'),
+                     self.build_dirs[2])
+    self.assertEqual(self.resolver.GetLatestImageDir('test-board'),
+                     self.build_dirs[2])
+    newer = self._AddBuild('103.0.0-a1', time.time())
+    self.assertEqual(self.resolver.GetLatestImageDir('test-board'), newer)
+    self.assertEqual(self.resolver.Stats(),
+                     {'hits': 1, 'scans': 2, 'script_runs': 0})
+    self.mox.VerifyAll()
+
+  def testLatestLink(self):
+    self.mox.ReplayAll()
+    os.symlink('102.0.0-a1', os.path.join(self.images_dir, 'latest'))
+    self.assertEqual(self.resolver.GetLatestImageDir('test-board'),
+                     self.build_dirs[1])
+    self.mox.VerifyAll()
+
+  def testRefresh(self):
+    self.mox.ReplayAll()
+    self.assertEqual(self.resolver.GetLatestImageDir('test-board'),
+                     self.build_dirs[2])
+    # Build directories modified in place are noticed once the latest image
+    # directory is refreshed.
+    os.utime(self.build_dirs[0], None)
+    self.assertEqual(self.resolver.GetLatestImageDir('test-board'),
+                     self.build_dirs[2])
+    old_interval = latest_image.REFRESH_INTERVAL
+    latest_image.REFRESH_INTERVAL = 0
+    try:
+      self.assertEqual(self.resolver.GetLatestImageDir('test-board'),
+                       self.build_dirs[0])
+    finally:
+      latest_image.REFRESH_INTERVAL = old_interval
+    self.mox.VerifyAll()
+
+  def testScriptFallback(self):
+    self.resolver._RunScript('other-board').AndReturn('/other/latest')
+    self.mox.ReplayAll()
+    self.assertEqual(self.resolver.GetLatestImageDir('other-board'),
+                     '/other/latest')
+    self.assertEqual(self.resolver.GetLatestImageDir('other-board'),
+                     '/other/latest')
+    self.assertEqual(self.resolver.Stats()['script_runs'], 1)
+    self.mox.VerifyAll()
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -2,24 +2,218 @@
 # Use of this source code is governed by a BSD-style license that can be
 # found in the LICENSE file.
 
-"""Logging via CherryPy."""
+"""Logging via CherryPy.
 
+Messages are logged with a tag and a level. Messages below the configured
+level, or not picked by the sampling configured for their tag, are dropped
+before being formatted. Once StartWriter is called, messages are formatted
+and written by a background thread, off the request handling path, either
+as CherryPy log lines or as JSON objects, one per line.
+"""
+
+import json
+import logging
+import Queue
+import random
 import re
+import threading
+import time
 
 import cherrypy
 
 
+DEBUG = logging.DEBUG
+INFO = logging.INFO
+WARNING = logging.WARNING
+ERROR = logging.ERROR
+
+LEVELS = {'debug': DEBUG, 'info': INFO, 'warning': WARNING, 'error': ERROR}
+
+FORMATS = ('text', 'json')
+
+# Number of messages waiting for the writer thread beyond which messages
+# are dropped rather than slowing down their callers.
+MAX_QUEUED_MESSAGES = 10000
+
+_MONTHS = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep',
+           'Oct', 'Nov', 'Dec')
+
+# Minimum level of logged messages.
+_level = INFO
+# Format of logged messages, one of FORMATS.
+_format = 'text'
+# Sampled tags, mapped to the maximum level of sampled messages and the
+# fraction of them that is logged.
+_sample_rates = {}
+# Writer thread, if started.
+_writer = None
+
+
+class LogUtilError(Exception):
+  """Exception class used by this module."""
+  pass
+
+
 class Loggable(object):
   """Provides a log method, with automatic log tag generation."""
   _CAMELCASE_RE = re.compile('(?<=.)([A-Z])')
 
-  def _Log(self, message, *args):
+  def _Log(self, message, *args, **kwargs):
     return LogWithTag(
         self._CAMELCASE_RE.sub(r'_\1', self.__class__.__name__).upper(),
-        message, *args)
+        message, *args, **kwargs)
+
+
+def Configure(level=INFO, log_format='text', sample_rates=None):
+  """Configures which messages are logged, and how.
+
+  Args:
+    level: minimum level of logged messages.
+    log_format: `text' for CherryPy log lines, `json' for JSON objects with
+                time, level, tag and message keys.
+    sample_rates: list of (tag, level, rate) tuples, each logging only a
+                  fraction rate of the messages with tag at or below level.
+  """
+  # pylint: disable=W0603
+  global _level, _format, _sample_rates
+  if log_format not in FORMATS:
+    raise LogUtilError('unknown log format %s' % log_format)
+  _level = level
+  _format = log_format
+  _sample_rates = dict((tag, (max_level, rate))
+                       for tag, max_level, rate in sample_rates or [])
+  if cherrypy.log.error_log.level > level:
+    cherrypy.log.error_log.setLevel(level)
+
+
+def ParseSampleRate(spec):
+  """Parses a TAG[:LEVEL]=RATE sample rate, as taken by Configure.
+
+  LEVEL defaults to debug, and RATE is a fraction or a percentage, e.g.
+  UPDATE:debug=1%.
+
+  Raises:
+    LogUtilError: if spec is malformed.
+  """
+  match = re.match(r'^([^:=]+)(?::(\w+))?=([\d.]+)(%?)$', spec)
+  if not match:
+    raise LogUtilError('invalid sample rate %s, expected TAG[:LEVEL]=RATE'
+                       % spec)
+  tag, level_name, rate, percent = match.groups()
+  level = LEVELS.get((level_name or 'debug').lower())
+  if level is None:
+    raise LogUtilError('unknown log level %s' % level_name)
+  try:
+    rate = float(rate) / (100 if percent else 1)
+  except ValueError:
+    raise LogUtilError('invalid sample rate %s' % spec)
+  if not 0 <= rate <= 1:
+    raise LogUtilError('sample rate %s is not between 0 and 1' % spec)
+  return tag, level, rate
+
+
+def _FormatRecord(record):
+  """Returns the line a (time, tag, level, message, args) record is logged as.
+  """
+  timestamp, tag, level, message, args = record
+  try:
+    if args:
+      message = message % args
+  except (TypeError, ValueError) as e:
+    message = 'Failed to format %r with %r: %s' % (message, args, e)
+  if _format == 'json':
+    return json.dumps({'time': timestamp, 'tag': tag,
+                       'level': logging.getLevelName(level),
+                       'message': message})
+  # Same as CherryPy's own log lines.
+  t = time.localtime(timestamp)
+  return '[%02d/%s/%04d:%02d:%02d:%02d] %s %s' % (
+      t.tm_mday, _MONTHS[t.tm_mon - 1], t.tm_year, t.tm_hour, t.tm_min,
+      t.tm_sec, tag, message)
+
+
+def _WriteRecord(record):
+  cherrypy.log.error_log.log(record[2], _FormatRecord(record))
+
+
+class _Writer(object):
+  """Formats and writes log records from a background thread."""
+
+  def __init__(self, max_queued=MAX_QUEUED_MESSAGES):
+    self.dropped = 0
+    self._queue = Queue.Queue(max_queued)
+    self._thread = threading.Thread(target=self._Run, name='log_writer')
+    self._thread.daemon = True
+
+  def Start(self):
+    self._thread.start()
+
+  def Put(self, record):
+    try:
+      self._queue.put_nowait(record)
+    except Queue.Full:
+      self.dropped += 1
+
+  def Stop(self):
+    """Writes the queued records, and stops the thread."""
+    self._queue.put(None)
+    self._thread.join()
+
+  def _Run(self):
+    while True:
+      record = self._queue.get()
+      if record is None:
+        break
+      if self.dropped:
+        dropped, self.dropped = self.dropped, 0
+        _WriteRecord((record[0], 'LOG', WARNING,
+                      'Dropped %d log messages', (dropped,)))
+      try:
+        _WriteRecord(record)
+      except Exception as e:  # pylint: disable=W0703
+        # Never let a broken handler stop the writer.
+        _WriteRecord((record[0], 'LOG', ERROR,
+                      'Failed to write log message: %r', (e,)))
+
+
+def StartWriter():
+  """Writes messages from a background thread from now on."""
+  # pylint: disable=W0603
+  global _writer
+  if not _writer:
+    writer = _Writer()
+    writer.Start()
+    _writer = writer
+
+
+def StopWriter():
+  """Writes the queued messages, and writes messages synchronously again."""
+  # pylint: disable=W0603
+  global _writer
+  writer, _writer = _writer, None
+  if writer:
+    writer.Stop()
+
+
+def LogWithTag(tag, message, *args, **kwargs):
+  """Logs a message, formatted with args unless it is dropped.
 
+  Args:
+    tag: tag of the message, typically the name of the logging module.
+    message: message, formatted with args when it is written.
+    level: level of the message, INFO by default.
+  """
+  level = kwargs.get('level', INFO)
+  if level < _level:
+    return
+  sample_rate = _sample_rates.get(tag)
+  if (sample_rate and level <= sample_rate[0] and
+      random.random() >= sample_rate[1]):
+    return
 
-def LogWithTag(tag, message, *args):
-  # CherryPy log doesn't seem to take any optional args, so we just handle
-  # args by formatting them into message.
-  return cherrypy.log(message % args, context=tag)
+  record = (time.time(), tag, level, message, args)
+  writer = _writer
+  if writer:
+    writer.Put(record)
+  else:
+    _WriteRecord(record)
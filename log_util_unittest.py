@@ -0,0 +1,95 @@
+#!/usr/bin/python
+
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unit tests for log_util module."""
+
+import json
+import logging
+import unittest
+
+import cherrypy
+
+import log_util
+
+
+class _ListHandler(logging.Handler):
+
+  def __init__(self):
+    logging.Handler.__init__(self)
+    self.records = []
+
+  def emit(self, record):
+    self.records.append((record.levelno, record.getMessage()))
+
+
+class LogUtilTest(unittest.TestCase):
+
+  def setUp(self):
+    self.handler = _ListHandler()
+    cherrypy.log.error_log.addHandler(self.handler)
+
+  def tearDown(self):
+    log_util.StopWriter()
+    log_util.Configure()
+    cherrypy.log.error_log.removeHandler(self.handler)
+
+  def _Messages(self):
+    return [message for _, message in self.handler.records]
+
+  def testLevels(self):
+    log_util.Configure(level=log_util.INFO)
+    log_util.LogWithTag('TAG', 'hidden %s', 'debug', level=log_util.DEBUG)
+    log_util.LogWithTag('TAG', 'shown %s', 'info')
+    log_util.LogWithTag('TAG', 'unformatted %s')
+    self.assertEqual(len(self.handler.records), 2)
+    self.assertTrue(self._Messages()[0].endswith('] TAG shown info'))
+    self.assertTrue(self._Messages()[1].endswith('] TAG unformatted %s'))
+
+    log_util.Configure(level=log_util.DEBUG)
+    log_util.LogWithTag('TAG', 'shown %s', 'debug', level=log_util.DEBUG)
+    self.assertEqual(self.handler.records[-1][0], log_util.DEBUG)
+
+  def testSampling(self):
+    log_util.Configure(level=log_util.DEBUG, sample_rates=[
+        log_util.ParseSampleRate('UPDATE=0%'),
+        log_util.ParseSampleRate('OTHER:info=1')])
+    for _ in range(10):
+      log_util.LogWithTag('UPDATE', 'sampled', level=log_util.DEBUG)
+      log_util.LogWithTag('OTHER', 'kept', level=log_util.DEBUG)
+    log_util.LogWithTag('UPDATE', 'warning', level=log_util.WARNING)
+    self.assertEqual(len([m for m in self._Messages() if 'sampled' in m]), 0)
+    self.assertEqual(len([m for m in self._Messages() if 'kept' in m]), 10)
+    self.assertEqual(len([m for m in self._Messages() if 'warning' in m]), 1)
+
+  def testParseSampleRate(self):
+    self.assertEqual(log_util.ParseSampleRate('UPDATE=1%'),
+                     ('UPDATE', log_util.DEBUG, 0.01))
+    self.assertEqual(log_util.ParseSampleRate('A:warning=0.5'),
+                     ('A', log_util.WARNING, 0.5))
+    for spec in ('UPDATE', 'UPDATE=2', 'UPDATE:bogus=1', 'UPDATE=x'):
+      self.assertRaises(log_util.LogUtilError, log_util.ParseSampleRate, spec)
+
+  def testWriterAndJson(self):
+    log_util.Configure(log_format='json')
+    log_util.StartWriter()
+    args = ['a']
+    for i in range(100):
+      log_util.LogWithTag('TAG', 'message %d %s', i, args)
+    log_util.StopWriter()
+    messages = [json.loads(m) for m in self._Messages()]
+    self.assertEqual([m['message'] for m in messages],
+                     ["message %d ['a']" % i for i in range(100)])
+    self.assertEqual(messages[0]['tag'], 'TAG')
+    self.assertEqual(messages[0]['level'], 'INFO')
+
+    # Messages are written synchronously once the writer is stopped.
+    log_util.LogWithTag('TAG', 'bad format %d', 'x')
+    self.assertTrue(json.loads(self._Messages()[-1])['message'].startswith(
+        'Failed to format'))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,338 @@
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Counters, gauges and histograms, exported in Prometheus text format.
+
+Metrics are created once, typically at module level, and register
+themselves with a Registry, by default REGISTRY:
+
+  REQUESTS = metrics.Counter('devserver_requests_total', 'Requests handled.',
+                             ('endpoint',))
+  ...
+  REQUESTS.Labels('update').Inc()
+
+Updating a metric takes a dictionary lookup and a short lock, so that it
+can be done on every request. Counters kept by other modules, such as the
+Stats() of caches, are exported by collectors, which are only called when
+the metrics are rendered.
+"""
+
+import bisect
+import contextlib
+import threading
+import time
+
+
+# Default histogram bucket upper bounds, in seconds.
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+# Content type of rendered metrics.
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class MetricsError(Exception):
+  """Exception class used by this module."""
+  pass
+
+
+def _FormatValue(value):
+  if value == float('inf'):
+    return '+Inf'
+  if isinstance(value, (int, long)):
+    return str(value)
+  if isinstance(value, float) and value.is_integer():
+    return '%d' % value
+  return repr(value)
+
+
+def _EscapeLabelValue(value):
+  return (str(value).replace('\\', r'\\').replace('\n', r'\n')
+          .replace('"', r'\"'))
+
+
+def _FormatLabels(names, values, extra=None):
+  pairs = zip(names, values)
+  if extra:
+    pairs.append(extra)
+  if not pairs:
+    return ''
+  return '{%s}' % ','.join('%s="%s"' % (name, _EscapeLabelValue(value))
+                           for name, value in pairs)
+
+
+class _Metric(object):
+  """A metric, made of one child holding the value per label value tuple."""
+
+  TYPE = None
+
+  def __init__(self, new_child, name, help_text, labels=(), registry=None):
+    """Creates a metric, and registers it.
+
+    Args:
+      new_child: function returning a new child.
+      name: name of the metric.
+      help_text: description of the metric.
+      labels: names of the metric's labels.
+      registry: Registry to register the metric with, REGISTRY by default.
+    """
+    self._new_child = new_child
+    self.name = name
+    self.help_text = help_text
+    self.label_names = tuple(labels)
+    self._children = {}
+    self._lock = threading.Lock()
+    (REGISTRY if registry is None else registry).Register(self)
+
+  def Labels(self, *values):
+    """Returns the child holding the value for the given label values."""
+    child = self._children.get(values)
+    if child is None:
+      if len(values) != len(self.label_names):
+        raise MetricsError('%s takes labels %s, got %r' %
+                           (self.name, self.label_names, values))
+      with self._lock:
+        child = self._children.setdefault(values, self._new_child())
+    return child
+
+  def Samples(self):
+    """Yields the (name suffix, label values, extra label, value) samples."""
+    with self._lock:
+      children = sorted(self._children.items())
+    for values, child in children:
+      for suffix, extra, value in child.Samples():
+        yield suffix, values, extra, value
+
+  def Render(self):
+    """Returns the lines of the metric in Prometheus text format."""
+    lines = ['# HELP %s %s' % (self.name, self.help_text),
+             '# TYPE %s %s' % (self.name, self.TYPE)]
+    for suffix, values, extra, value in self.Samples():
+      lines.append('%s%s%s %s' % (
+          self.name, suffix, _FormatLabels(self.label_names, values, extra),
+          _FormatValue(value)))
+    return lines
+
+
+class _CounterChild(object):
+
+  def __init__(self):
+    self._value = 0
+    self._lock = threading.Lock()
+
+  def Inc(self, amount=1):
+    with self._lock:
+      self._value += amount
+
+  @property
+  def value(self):
+    return self._value
+
+  def Samples(self):
+    return [('', None, self._value)]
+
+
+class Counter(_Metric):
+  """A count that only goes up, e.g. of requests handled."""
+
+  TYPE = 'counter'
+
+  def __init__(self, name, help_text, labels=(), registry=None):
+    """Creates a counter, and registers it; args are those of _Metric."""
+    super(Counter, self).__init__(_CounterChild, name, help_text, labels,
+                                  registry)
+
+  def Inc(self, amount=1):
+    """Increments the counter of a metric without labels."""
+    self.Labels().Inc(amount)
+
+
+class _GaugeChild(_CounterChild):
+
+  def Dec(self, amount=1):
+    self.Inc(-amount)
+
+  def Set(self, value):
+    self._value = value
+
+  @contextlib.contextmanager
+  def TrackInProgress(self):
+    self.Inc()
+    try:
+      yield
+    finally:
+      self.Dec()
+
+
+class Gauge(_Metric):
+  """A value that goes up and down, e.g. of requests being handled."""
+
+  TYPE = 'gauge'
+
+  def __init__(self, name, help_text, labels=(), registry=None):
+    """Creates a gauge, and registers it; args are those of _Metric."""
+    super(Gauge, self).__init__(_GaugeChild, name, help_text, labels,
+                                registry)
+
+  def Set(self, value):
+    """Sets the value of a metric without labels."""
+    self.Labels().Set(value)
+
+
+class _HistogramChild(object):
+
+  def __init__(self, buckets):
+    self._buckets = buckets
+    self._counts = [0] * (len(buckets) + 1)
+    self._sum = 0.0
+    self._lock = threading.Lock()
+
+  def Observe(self, value):
+    index = bisect.bisect_left(self._buckets, value)
+    with self._lock:
+      self._counts[index] += 1
+      self._sum += value
+
+  @contextlib.contextmanager
+  def Time(self):
+    """Observes the time the with statement takes, in seconds."""
+    start = time.time()
+    try:
+      yield
+    finally:
+      self.Observe(time.time() - start)
+
+  def Samples(self):
+    with self._lock:
+      counts = list(self._counts)
+      total = self._sum
+    samples = []
+    cumulative = 0
+    for bound, count in zip(self._buckets + (float('inf'),), counts):
+      cumulative += count
+      samples.append(('_bucket', ('le', _FormatValue(float(bound))),
+                      cumulative))
+    samples.append(('_sum', None, total))
+    samples.append(('_count', None, cumulative))
+    return samples
+
+
+class Histogram(_Metric):
+  """Counts of observed values, e.g. latencies, falling in buckets."""
+
+  TYPE = 'histogram'
+
+  def __init__(self, name, help_text, labels=(), registry=None,
+               buckets=DEFAULT_BUCKETS):
+    """Creates a histogram, and registers it.
+
+    Args:
+      buckets: increasing upper bounds of the buckets; a +Inf bucket is
+               always added.
+      Other args are those of _Metric.
+    """
+    buckets = tuple(float(bound) for bound in buckets)
+    if list(buckets) != sorted(set(buckets)):
+      raise MetricsError('%s buckets are not increasing' % name)
+    super(Histogram, self).__init__(lambda: _HistogramChild(buckets), name,
+                                    help_text, labels, registry)
+
+  def Observe(self, value):
+    """Observes a value of a metric without labels."""
+    self.Labels().Observe(value)
+
+  def Time(self):
+    """Times the with statement, for a metric without labels."""
+    return self.Labels().Time()
+
+
+class Registry(object):
+  """A set of metrics and collectors, rendered together."""
+
+  def __init__(self):
+    self._metrics = {}
+    self._collectors = []
+    self._lock = threading.Lock()
+
+  def Register(self, metric):
+    with self._lock:
+      if metric.name in self._metrics:
+        raise MetricsError('metric %s is already registered' % metric.name)
+      self._metrics[metric.name] = metric
+
+  def AddCollector(self, collect):
+    """Adds a function called when rendering, returning a list of metrics.
+
+    The metrics returned by a collector must not be registered.
+    """
+    with self._lock:
+      self._collectors.append(collect)
+
+  def AddStatsCollector(self, prefix, get_stats, counters=(), help_text=''):
+    """Exports a dictionary of statistics, such as a Stats() method returns.
+
+    Each numeric statistic becomes a metric named prefix_<key>; those listed
+    in counters only go up, and are exported as counters named
+    prefix_<key>_total, the others as gauges.
+
+    Args:
+      prefix: prefix of the metric names.
+      get_stats: function returning the dictionary of statistics.
+      counters: keys of the statistics that are counters.
+      help_text: description of the statistics.
+    """
+    def _Collect():
+      collected = []
+      for key, value in sorted(get_stats().iteritems()):
+        if not isinstance(value, (int, long, float)):
+          continue
+        if key in counters:
+          metric = Counter('%s_%s_total' % (prefix, key), help_text,
+                           registry=_UNREGISTERED)
+          metric.Inc(value)
+        else:
+          metric = Gauge('%s_%s' % (prefix, key), help_text,
+                         registry=_UNREGISTERED)
+          metric.Set(value)
+        collected.append(metric)
+      return collected
+
+    self.AddCollector(_Collect)
+
+  def Render(self):
+    """Returns all the metrics in Prometheus text format."""
+    with self._lock:
+      metrics = sorted(self._metrics.items())
+      collectors = list(self._collectors)
+    lines = []
+    for _, metric in metrics:
+      lines.extend(metric.Render())
+    for collect in collectors:
+      for metric in collect():
+        lines.extend(metric.Render())
+    return '\n'.join(lines) + '\n'
+
+
+class _Unregistered(Registry):
+  """A registry that does not hold on to metrics, for collected metrics."""
+
+  def Register(self, metric):
+    pass
+
+
+_UNREGISTERED = _Unregistered()
+
+# The registry metrics are registered with by default.
+REGISTRY = Registry()
+
+# Time spent in internal phases of handling requests, such as parsing
+# update requests or hashing payloads.
+PHASE_SECONDS = Histogram('devserver_phase_duration_seconds',
+                          'Time spent in phases of handling requests.',
+                          ('phase',))
+
+
+def TimePhase(phase):
+  """Returns a context manager timing a phase of handling requests."""
+  return PHASE_SECONDS.Labels(phase).Time()
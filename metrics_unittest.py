@@ -0,0 +1,86 @@
+#!/usr/bin/python
+
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unit tests for metrics module."""
+
+import unittest
+
+import metrics
+
+
+class MetricsTest(unittest.TestCase):
+
+  def setUp(self):
+    self.registry = metrics.Registry()
+
+  def testCounterAndGauge(self):
+    requests = metrics.Counter('requests_total', 'Requests.',
+                               ('endpoint', 'code'), registry=self.registry)
+    in_flight = metrics.Gauge('in_flight', 'In flight.',
+                              registry=self.registry)
+    requests.Labels('update', '200').Inc()
+    requests.Labels('update', '200').Inc(2)
+    requests.Labels('a"b\\c', '404').Inc()
+    in_flight.Set(3)
+    in_flight.Labels().Dec()
+    with in_flight.Labels().TrackInProgress():
+      self.assertEqual(in_flight.Labels().value, 3)
+    self.assertEqual(
+        self.registry.Render(),
+        '# HELP in_flight In flight.\n'
+        '# TYPE in_flight gauge\n'
+        'in_flight 2\n'
+        '# HELP requests_total Requests.\n'
+        '# TYPE requests_total counter\n'
+        'requests_total{endpoint="a\\"b\\\\c",code="404"} 1\n'
+        'requests_total{endpoint="update",code="200"} 3\n')
+
+  def testHistogram(self):
+    latency = metrics.Histogram('latency_seconds', 'Latency.', ('phase',),
+                                registry=self.registry, buckets=(0.1, 1))
+    child = latency.Labels('parse')
+    child.Observe(0.05)
+    child.Observe(0.1)
+    child.Observe(0.5)
+    child.Observe(2)
+    with child.Time():
+      pass
+    self.assertEqual(
+        self.registry.Render().splitlines()[2:],
+        ['latency_seconds_bucket{phase="parse",le="0.1"} 3',
+         'latency_seconds_bucket{phase="parse",le="1"} 4',
+         'latency_seconds_bucket{phase="parse",le="+Inf"} 5',
+         'latency_seconds_sum{phase="parse"} %r' % (
+             child.Samples()[-2][2]),
+         'latency_seconds_count{phase="parse"} 5'])
+    self.assertTrue(2.65 <= child.Samples()[-2][2] < 2.7)
+
+  def testErrors(self):
+    counter = metrics.Counter('c', 'C.', ('a',), registry=self.registry)
+    self.assertRaises(metrics.MetricsError, counter.Labels)
+    self.assertRaises(metrics.MetricsError, metrics.Counter, 'c', 'C.',
+                      registry=self.registry)
+    self.assertRaises(metrics.MetricsError, metrics.Histogram, 'h', 'H.',
+                      registry=self.registry, buckets=(1, 0.5))
+
+  def testStatsCollector(self):
+    stats = {'entries': 2, 'hits': 5, 'name': 'ignored'}
+    self.registry.AddStatsCollector('cache', lambda: stats,
+                                    counters=('hits',), help_text='Cache.')
+    self.assertEqual(
+        self.registry.Render(),
+        '# HELP cache_entries Cache.\n'
+        '# TYPE cache_entries gauge\n'
+        'cache_entries 2\n'
+        '# HELP cache_hits_total Cache.\n'
+        '# TYPE cache_hits_total counter\n'
+        'cache_hits_total 5\n')
+    stats['hits'] = 6
+    self.assertIn('cache_hits_total 6\n', self.registry.Render())
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,299 @@
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Least recently used eviction of the payloads cached by the devserver."""
+
+import contextlib
+import errno
+import os
+import shutil
+import threading
+import time
+
+import common_util
+import log_util
+
+
+# Module-local log function.
+def _Log(message, *args):
+  return log_util.LogWithTag('PAYLOAD_CACHE', message, *args)
+
+
+# Default maximum number of cached payload directories.
+DEFAULT_MAX_ENTRIES = 12
+
+# Seconds between updates of the mtime of an entry being accessed, which
+# tells other processes sharing the cache that it was accessed.
+ACCESS_TIME_RESOLUTION = 60
+
+# Prefix of entries being removed.
+_EVICTED_PREFIX = '.evicted-'
+
+
+def _GetDirSize(path):
+  """Returns the total size of the files under path, in bytes."""
+  size = 0
+  for dir_path, _, file_names in os.walk(path):
+    for file_name in file_names:
+      try:
+        size += os.lstat(os.path.join(dir_path, file_name)).st_size
+      except OSError:
+        pass
+  return size
+
+
+class _Entry(object):
+  """A cached payload directory.
+
+  Members:
+    size:        total size of its files, in bytes.
+    last_access: time it was last used, or modified.
+    users:       number of payload generations or lookups using it.
+    touched:     time its mtime was last set to record an access.
+  """
+
+  def __init__(self, size, last_access):
+    self.size = size
+    self.last_access = last_access
+    self.users = 0
+    self.touched = 0
+
+
+class PayloadCache(object):
+  """Payload directories in a cache directory, evicted when over budget.
+
+  Each subdirectory of the cache directory, such as <src>_<dest>+<key>, is an
+  entry. Whenever the cache holds more than max_entries entries or max_size
+  bytes, the least recently accessed entries are removed. Entries being used,
+  by payload generation or according to in-use checks such as the one of the
+  files being downloaded, are never removed.
+
+  Access times are recorded as the mtimes of the entries, so that processes
+  sharing the cache directory see the entries the others use, and so that they
+  survive restarts.
+  """
+
+  def __init__(self, cache_dir, max_size=0, max_entries=DEFAULT_MAX_ENTRIES,
+               ignored=(), entry_lock=None, on_evict=None):
+    """Creates a cache; Scan must be called to find its existing entries.
+
+    Args:
+      cache_dir: directory holding the entries.
+      max_size: maximum total size of the entries in bytes, 0 for no limit.
+      max_entries: maximum number of entries, 0 for no limit.
+      ignored: names of subdirectories of cache_dir that are not entries.
+      entry_lock: function returning a context manager locking an entry,
+                  given its name, against other processes, which raises
+                  common_util.SingleFlightTimeout if it is held.
+      on_evict: function called after entries were evicted, e.g. to remove
+                files that only they used.
+    """
+    self.cache_dir = os.path.realpath(cache_dir)
+    self.max_size = max_size
+    self.max_entries = max_entries
+    self._ignored = set(ignored)
+    self._entry_lock = entry_lock
+    self._on_evict = on_evict
+    self._in_use_checks = []
+    self._lock = threading.Lock()
+    self._entries = {}
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self.evicted_bytes = 0
+
+  def AddInUseCheck(self, in_use):
+    """Adds a function telling whether an entry, given its path, is in use."""
+    with self._lock:
+      self._in_use_checks.append(in_use)
+
+  def _GetEntryName(self, entry_dir):
+    """Returns the name of the entry at entry_dir, or None if it is not one."""
+    parent, name = os.path.split(os.path.realpath(entry_dir))
+    if parent != self.cache_dir or name in self._ignored:
+      return None
+    return name
+
+  def Scan(self):
+    """Updates the entries and their sizes from the cache directory."""
+    try:
+      names = os.listdir(self.cache_dir)
+    except OSError as e:
+      if e.errno != errno.ENOENT:
+        raise
+      names = []
+
+    found = {}
+    for name in names:
+      path = os.path.join(self.cache_dir, name)
+      if name.startswith(_EVICTED_PREFIX):
+        # Left over by an interrupted eviction.
+        shutil.rmtree(path, ignore_errors=True)
+        continue
+      if name in self._ignored:
+        continue
+      try:
+        st = os.stat(path)
+      except OSError:
+        continue
+      if os.path.isdir(path):
+        found[name] = (_GetDirSize(path), st.st_mtime)
+
+    with self._lock:
+      for name in self._entries.keys():
+        if name not in found and not self._entries[name].users:
+          del self._entries[name]
+      for name, (size, mtime) in found.iteritems():
+        entry = self._entries.get(name)
+        if entry:
+          entry.size = size
+          entry.last_access = max(entry.last_access, mtime)
+        else:
+          self._entries[name] = _Entry(size, mtime)
+
+  @contextlib.contextmanager
+  def Use(self, entry_dir):
+    """Keeps an entry from being evicted while it is generated or looked up.
+
+    Once done, the size of the entry is updated, and the cache is brought
+    back within its budget. Directories outside the cache directory are not
+    tracked.
+
+    Args:
+      entry_dir: path to the entry, which need not exist yet.
+    """
+    name = self._GetEntryName(entry_dir)
+    if name is None:
+      yield
+      return
+
+    now = time.time()
+    with self._lock:
+      entry = self._entries.get(name)
+      if entry:
+        self.hits += 1
+      else:
+        self.misses += 1
+        entry = self._entries[name] = _Entry(0, now)
+      entry.users += 1
+      entry.last_access = now
+      touch = now - entry.touched >= ACCESS_TIME_RESOLUTION
+      if touch:
+        entry.touched = now
+    try:
+      yield
+    finally:
+      exists = os.path.isdir(entry_dir)
+      size = _GetDirSize(entry_dir) if exists else 0
+      if exists and touch:
+        try:
+          os.utime(entry_dir, None)
+        except OSError:
+          pass
+      with self._lock:
+        entry.users -= 1
+        entry.size = size
+        if not exists and not entry.users and self._entries.get(name) is entry:
+          # Generation failed, and removed the entry.
+          del self._entries[name]
+      # The entry was just used, so it is kept even if it alone is over the
+      # budget.
+      self.Evict(keep=name)
+
+  def _IsInUse(self, name, entry):
+    """Returns whether an entry is in use; assumes the lock is held."""
+    if entry.users:
+      return True
+    path = os.path.join(self.cache_dir, name)
+    return any(in_use(path) for in_use in self._in_use_checks)
+
+  def _OverBudget(self, num_entries, size):
+    return ((self.max_entries and num_entries > self.max_entries) or
+            (self.max_size and size > self.max_size))
+
+  def Evict(self, keep=None):
+    """Removes least recently accessed entries until within the budget.
+
+    Args:
+      keep: name of an entry not to remove, if any.
+    Returns:
+      The number of entries removed.
+    """
+    evicted = []
+    with self._lock:
+      num_entries = len(self._entries)
+      size = sum(entry.size for entry in self._entries.itervalues())
+      if not self._OverBudget(num_entries, size):
+        return 0
+
+      by_access = sorted(self._entries.iteritems(),
+                         key=lambda item: item[1].last_access)
+      for name, entry in by_access:
+        if not self._OverBudget(num_entries, size):
+          break
+        if name == keep or self._IsInUse(name, entry):
+          continue
+        # Renaming the entry away lets it be generated again while it is
+        # being removed.
+        path = os.path.join(self.cache_dir, name)
+        evicted_path = os.path.join(
+            self.cache_dir, '%s%s-%d' % (_EVICTED_PREFIX, name, os.getpid()))
+        try:
+          if self._entry_lock:
+            with self._entry_lock(name):
+              os.rename(path, evicted_path)
+          else:
+            os.rename(path, evicted_path)
+        except common_util.SingleFlightTimeout:
+          # In use by another process.
+          continue
+        except OSError as e:
+          if e.errno != errno.ENOENT:
+            _Log('Failed to evict %s: %s', path, e)
+            continue
+          evicted_path = None
+        del self._entries[name]
+        num_entries -= 1
+        size -= entry.size
+        self.evictions += 1
+        self.evicted_bytes += entry.size
+        evicted.append((name, evicted_path))
+
+    for name, evicted_path in evicted:
+      _Log('Evicted cached payload %s', name)
+      if evicted_path:
+        shutil.rmtree(evicted_path, ignore_errors=True)
+    if evicted and self._on_evict:
+      self._on_evict()
+    return len(evicted)
+
+  def StartBackgroundEviction(self, interval):
+    """Rescans the cache and evicts entries every interval seconds.
+
+    This picks up entries added or accessed by other processes.
+    """
+    def _EvictionLoop():
+      while True:
+        time.sleep(interval)
+        try:
+          self.Scan()
+          self.Evict()
+        except Exception as e:  # pylint: disable=W0703
+          _Log('Failed to evict cached payloads: %s', e)
+
+    thread = threading.Thread(target=_EvictionLoop, name='payload_cache')
+    thread.daemon = True
+    thread.start()
+
+  def Stats(self):
+    """Returns a dictionary of cache counters."""
+    with self._lock:
+      return {'entries': len(self._entries),
+              'bytes': sum(entry.size for entry in self._entries.itervalues()),
+              'in_use': sum(1 for entry in self._entries.itervalues()
+                            if entry.users),
+              'max_entries': self.max_entries, 'max_bytes': self.max_size,
+              'hits': self.hits, 'misses': self.misses,
+              'evictions': self.evictions,
+              'evicted_bytes': self.evicted_bytes}
@@ -0,0 +1,124 @@
+#!/usr/bin/python
+
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unit tests for payload_cache module."""
+
+import contextlib
+import os
+import shutil
+import tempfile
+import unittest
+
+import common_util
+import payload_cache
+
+
+class PayloadCacheTest(unittest.TestCase):
+
+  def setUp(self):
+    self.cache_dir = tempfile.mkdtemp('payload_cache_unittest')
+    os.mkdir(os.path.join(self.cache_dir, 'locks'))
+
+  def tearDown(self):
+    shutil.rmtree(self.cache_dir)
+
+  def _AddEntry(self, name, size, mtime):
+    path = os.path.join(self.cache_dir, name)
+    os.mkdir(path)
+    with open(os.path.join(path, 'update.gz'), 'w') as f:
+      f.write('x' * size)
+    os.utime(path, (mtime, mtime))
+    return path
+
+  def _Entries(self):
+    return sorted(name for name in os.listdir(self.cache_dir)
+                  if name != 'locks')
+
+  def testEvictByEntriesAndSize(self):
+    for i in range(5):
+      self._AddEntry('entry%d' % i, 100, 1000 + i)
+    cache = payload_cache.PayloadCache(self.cache_dir, max_entries=3,
+                                       ignored=('locks',))
+    cache.Scan()
+    self.assertEqual(cache.Stats()['bytes'], 500)
+    self.assertEqual(cache.Evict(), 2)
+    self.assertEqual(self._Entries(), ['entry2', 'entry3', 'entry4'])
+
+    cache.max_size = 250
+    self.assertEqual(cache.Evict(), 1)
+    self.assertEqual(self._Entries(), ['entry3', 'entry4'])
+    stats = cache.Stats()
+    self.assertEqual(stats['evictions'], 3)
+    self.assertEqual(stats['evicted_bytes'], 300)
+    self.assertEqual(stats['entries'], 2)
+
+  def testUseProtectsAndRecordsAccess(self):
+    old_path = self._AddEntry('old', 100, 1000)
+    self._AddEntry('new', 100, 2000)
+    cache = payload_cache.PayloadCache(self.cache_dir, max_entries=1,
+                                       ignored=('locks',))
+    cache.Scan()
+    with cache.Use(old_path):
+      # The least recently used entry is in use; only the other one can go.
+      self.assertEqual(cache.Evict(), 1)
+      self.assertEqual(self._Entries(), ['old'])
+      self.assertEqual(cache.Stats()['in_use'], 1)
+
+    new_path = os.path.join(self.cache_dir, 'new')
+    with cache.Use(new_path):
+      self._AddEntry('new', 50, 0)
+    # Generating new made old the least recently used entry.
+    self.assertEqual(self._Entries(), ['new'])
+    stats = cache.Stats()
+    self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+    self.assertEqual(stats['bytes'], 50)
+    self.assertTrue(os.stat(new_path).st_mtime > 2000)
+
+    # Directories outside the cache are not tracked.
+    with cache.Use(os.path.join(self.cache_dir, 'locks')):
+      pass
+    self.assertEqual(cache.Stats()['entries'], 1)
+
+  def testEntryOverBudgetKeptAfterUse(self):
+    self._AddEntry('old', 5, 1000)
+    cache = payload_cache.PayloadCache(self.cache_dir, max_size=10,
+                                       ignored=('locks',))
+    cache.Scan()
+    with cache.Use(os.path.join(self.cache_dir, 'big')):
+      self._AddEntry('big', 100, 2000)
+    # The entry just used is kept, although it alone is over the budget.
+    self.assertEqual(self._Entries(), ['big'])
+    self.assertEqual(cache.Stats()['bytes'], 100)
+
+  def testInUseChecksAndLocks(self):
+    in_use_path = self._AddEntry('downloaded', 100, 1000)
+    self._AddEntry('locked', 100, 1001)
+    self._AddEntry('free', 100, 1002)
+    self._AddEntry('.evicted-leftover-1', 100, 1003)
+
+    @contextlib.contextmanager
+    def _EntryLock(name):
+      if name == 'locked':
+        raise common_util.SingleFlightTimeout('locked')
+      yield
+
+    cache = payload_cache.PayloadCache(self.cache_dir, max_entries=1,
+                                       ignored=('locks',),
+                                       entry_lock=_EntryLock)
+    cache.AddInUseCheck(lambda path: path == in_use_path)
+    cache.Scan()
+    self.assertEqual(self._Entries(), ['downloaded', 'free', 'locked'])
+    self.assertEqual(cache.Evict(), 1)
+    self.assertEqual(self._Entries(), ['downloaded', 'locked'])
+
+    # Entries removed by other processes are forgotten.
+    shutil.rmtree(os.path.join(self.cache_dir, 'locked'))
+    cache.Scan()
+    self.assertEqual(cache.Stats()['entries'], 1)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,233 @@
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Content-addressed store of payloads, published without copying them."""
+
+import base64
+import binascii
+import errno
+import fcntl
+import os
+import shutil
+import stat
+import thread
+import threading
+import time
+
+import common_util
+import hash_cache
+import log_util
+
+
+# Module-local log function.
+def _Log(message, *args):
+  return log_util.LogWithTag('PAYLOAD_STORE', message, *args)
+
+
+# Directory of the payload cache holding the store's objects.
+OBJECTS_DIR = 'objects'
+
+# Seconds for which objects are kept after they were last linked to, so that
+# objects being published are not pruned.
+PRUNE_GRACE_PERIOD = 60
+
+# Linux ioctl cloning a file's blocks into another file (a reflink).
+_FICLONE = 0x40049409
+
+# Errors of os.link for which files are cloned or copied instead.
+_LINK_ERRNOS = (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP)
+
+
+def _CloneOrCopyFile(source, dest):
+  """Creates dest with the contents of source, sharing its blocks if possible.
+
+  Returns:
+    'reflink' if the blocks are shared, 'copy' otherwise.
+  """
+  with open(source, 'rb') as src, open(dest, 'wb') as dst:
+    try:
+      fcntl.ioctl(dst.fileno(), _FICLONE, src.fileno())
+      method = 'reflink'
+    except IOError:
+      shutil.copyfileobj(src, dst, 1024 * 1024)
+      method = 'copy'
+  shutil.copymode(source, dest)
+  return method
+
+
+def PublishFile(source, dest, link=True):
+  """Atomically replaces dest with the contents of source.
+
+  dest is a hardlink to source when both are on the same file system and
+  link is set, and a reflink or copy of source otherwise. It is created under
+  a temporary name and renamed, so that readers see either the old or the new
+  file, whole.
+
+  Returns:
+    'link', 'reflink' or 'copy', the way dest was created.
+  """
+  dest_dir, name = os.path.split(dest)
+  tmp_path = os.path.join(dest_dir, '.%s.tmp-%d-%d' % (name, os.getpid(),
+                                                       thread.get_ident()))
+  try:
+    if os.path.lexists(tmp_path):
+      # Left over by an interrupted publication.
+      os.unlink(tmp_path)
+    method = None
+    if link:
+      try:
+        os.link(source, tmp_path)
+        method = 'link'
+      except OSError as e:
+        if e.errno not in _LINK_ERRNOS:
+          raise
+    if not method:
+      method = _CloneOrCopyFile(source, tmp_path)
+    os.rename(tmp_path, dest)
+  except:
+    if os.path.lexists(tmp_path):
+      os.unlink(tmp_path)
+    raise
+  return method
+
+
+class PayloadStore(object):
+  """Payloads kept under the hex SHA256 of their contents.
+
+  Payloads the devserver generated are added to the store by hardlink when
+  possible, others by reflink or copy, so that changes made to them in place
+  never change an object. Payloads are published from the store to the paths
+  they are served from by PublishFile, so that serving a payload from several
+  paths keeps a single copy of it. Objects no longer published anywhere are
+  removed by Prune.
+  """
+
+  def __init__(self, objects_dir):
+    self.objects_dir = objects_dir
+    self._lock = threading.Lock()
+    self._counters = {'link': 0, 'reflink': 0, 'copy': 0, 'unchanged': 0,
+                      'pruned': 0}
+    # Stat keys and SHA256 of the files published, keyed by path.
+    self._published = {}
+
+  def _Count(self, counter):
+    with self._lock:
+      self._counters[counter] += 1
+
+  def GetObjectPath(self, sha256):
+    """Returns the path of the object with a base64 encoded SHA256."""
+    return os.path.join(self.objects_dir,
+                        binascii.hexlify(base64.b64decode(sha256)))
+
+  def Add(self, path, sha256=None, owned=True):
+    """Adds a file to the store, unless its contents are already there.
+
+    Args:
+      path: path to the file.
+      sha256: base64 encoded SHA256 of the file, computed if not given.
+      owned: whether the devserver owns the file and never changes it in
+             place, so that it may be hardlinked into the store.
+    Returns:
+      The path of the object holding the file's contents.
+    """
+    if sha256 is None:
+      sha256 = common_util.GetFileSha256(path)
+    object_path = self.GetObjectPath(sha256)
+    # An object sharing its inode with a file the devserver does not own,
+    # e.g. one added by an earlier version, is replaced by a copy.
+    valid = os.path.exists(object_path) and (
+        owned or not os.path.samefile(path, object_path))
+    if valid:
+      # Refresh the ctime of the object, without changing its times, so that
+      # Prune leaves it to be published.
+      try:
+        os.chmod(object_path, stat.S_IMODE(os.stat(object_path).st_mode))
+      except OSError as e:
+        if e.errno != errno.ENOENT:
+          raise
+        valid = False
+    if not valid:
+      try:
+        os.makedirs(self.objects_dir)
+      except OSError as e:
+        if e.errno != errno.EEXIST:
+          raise
+      PublishFile(path, object_path, link=owned)
+    return object_path
+
+  def Publish(self, path, dest, sha256=None, owned=True):
+    """Makes dest a file with the contents of path, through the store.
+
+    Nothing is done if dest already has those contents, as the object
+    holding them or as the unchanged copy published last.
+
+    Args:
+      path: path to the file.
+      dest: path to publish the file at.
+      sha256: base64 encoded SHA256 of the file, computed if not given.
+      owned: whether the devserver owns the file, as for Add.
+    """
+    if sha256 is None:
+      sha256 = common_util.GetFileSha256(path)
+    try:
+      dest_key = hash_cache.GetStatKey(dest)
+    except OSError:
+      dest_key = None
+    with self._lock:
+      unchanged = dest_key and self._published.get(dest) == (dest_key, sha256)
+    if unchanged:
+      self._Count('unchanged')
+      return
+
+    object_path = self.Add(path, sha256, owned)
+    if dest_key and os.path.samefile(object_path, dest):
+      method = 'unchanged'
+    else:
+      try:
+        method = PublishFile(object_path, dest)
+      except EnvironmentError as e:
+        if e.errno != errno.ENOENT:
+          raise
+        # Pruned since it was added; add it again.
+        object_path = self.Add(path, sha256, owned)
+        method = PublishFile(object_path, dest)
+      _Log('Published %s to %s by %s', os.path.basename(object_path), dest,
+           method)
+    with self._lock:
+      self._counters[method] += 1
+      self._published[dest] = (hash_cache.GetStatKey(dest), sha256)
+
+  def Prune(self):
+    """Removes objects that are not published anywhere anymore.
+
+    Returns:
+      The number of objects removed.
+    """
+    try:
+      names = os.listdir(self.objects_dir)
+    except OSError as e:
+      if e.errno != errno.ENOENT:
+        raise
+      return 0
+
+    pruned = 0
+    deadline = time.time() - PRUNE_GRACE_PERIOD
+    for name in names:
+      path = os.path.join(self.objects_dir, name)
+      try:
+        st = os.lstat(path)
+        # Linking to or from an object changes its ctime.
+        if st.st_nlink == 1 and st.st_ctime < deadline:
+          os.unlink(path)
+          pruned += 1
+      except OSError:
+        pass
+    with self._lock:
+      self._counters['pruned'] += pruned
+    return pruned
+
+  def Stats(self):
+    """Returns a dictionary of publication counters."""
+    with self._lock:
+      return dict(self._counters)
@@ -0,0 +1,130 @@
+#!/usr/bin/python
+
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unit tests for payload_store module."""
+
+import errno
+import os
+import shutil
+import tempfile
+import unittest
+
+import common_util
+import payload_store
+
+
+class PayloadStoreTest(unittest.TestCase):
+
+  def setUp(self):
+    self.static_dir = tempfile.mkdtemp('payload_store_unittest')
+    self.store = payload_store.PayloadStore(
+        os.path.join(self.static_dir, 'cache', payload_store.OBJECTS_DIR))
+    self.cache_dir = os.path.join(self.static_dir, 'cache', 'entry')
+    os.makedirs(self.cache_dir)
+    self.payload = os.path.join(self.cache_dir, 'update.gz')
+    self._Write(self.payload, 'payload')
+    self.dest = os.path.join(self.static_dir, 'update.gz')
+
+  def tearDown(self):
+    shutil.rmtree(self.static_dir)
+
+  def _Write(self, path, contents):
+    with open(path, 'w') as f:
+      f.write(contents)
+
+  def _Read(self, path):
+    with open(path) as f:
+      return f.read()
+
+  def testPublishByHardlink(self):
+    self._Write(self.dest, 'old')
+    with open(self.dest) as reader:
+      self.store.Publish(self.payload, self.dest)
+      # Readers of the old file still see it whole.
+      self.assertEqual(reader.read(), 'old')
+    self.assertEqual(self._Read(self.dest), 'payload')
+    object_path = self.store.GetObjectPath(
+        common_util.GetFileSha256(self.payload))
+    self.assertTrue(os.path.samefile(self.dest, object_path))
+    self.assertTrue(os.path.samefile(self.payload, object_path))
+
+    self.store.Publish(self.payload, self.dest)
+    self.assertEqual(self.store.Stats()['link'], 1)
+    self.assertEqual(self.store.Stats()['unchanged'], 1)
+    self.assertEqual(os.listdir(self.static_dir), ['cache', 'update.gz'])
+
+  def testPublishByCopy(self):
+    old_link = os.link
+
+    def _CrossDeviceLink(source, dest):
+      raise OSError(errno.EXDEV, os.strerror(errno.EXDEV))
+
+    os.link = _CrossDeviceLink
+    try:
+      self.store.Publish(self.payload, self.dest)
+      self.store.Publish(self.payload, self.dest)
+    finally:
+      os.link = old_link
+    self.assertEqual(self._Read(self.dest), 'payload')
+    self.assertFalse(os.path.samefile(self.dest, self.payload))
+    stats = self.store.Stats()
+    self.assertEqual(stats['reflink'] + stats['copy'], 1)
+    self.assertEqual(stats['unchanged'], 1)
+
+  def testPublishExternalFile(self):
+    external = os.path.join(self.static_dir, 'external.gz')
+    self._Write(external, 'payload')
+    self.store.Publish(external, self.dest, owned=False)
+    self.assertEqual(self._Read(self.dest), 'payload')
+    self.assertFalse(os.path.samefile(self.dest, external))
+
+    # Rebuilding the file in place changes neither the object nor dest.
+    object_path = self.store.GetObjectPath(common_util.GetFileSha256(external))
+    self._Write(external, 'rebuilt')
+    self.assertEqual(self._Read(object_path), 'payload')
+    self.assertEqual(self._Read(self.dest), 'payload')
+
+    # An object linked to a file the devserver does not own is replaced.
+    self._Write(external, 'payload')
+    os.unlink(object_path)
+    os.link(external, object_path)
+    self.assertEqual(self.store.Add(external, owned=False), object_path)
+    self.assertFalse(os.path.samefile(object_path, external))
+
+  def testPrune(self):
+    self.store.Publish(self.payload, self.dest)
+    old_grace = payload_store.PRUNE_GRACE_PERIOD
+    payload_store.PRUNE_GRACE_PERIOD = -1
+    try:
+      self.assertEqual(self.store.Prune(), 0)
+      # Once no longer published or cached, the object goes.
+      shutil.rmtree(self.cache_dir)
+      self._Write(os.path.join(self.static_dir, 'other'), 'other')
+      self.store.Publish(os.path.join(self.static_dir, 'other'), self.dest)
+      self.assertEqual(self.store.Prune(), 1)
+    finally:
+      payload_store.PRUNE_GRACE_PERIOD = old_grace
+    self.assertEqual(self._Read(self.dest), 'other')
+    self.assertEqual(len(os.listdir(self.store.objects_dir)), 1)
+
+  def testPublishObjectPrunedAfterAdd(self):
+    add = self.store.Add
+
+    def _AddAndPrune(*args):
+      # Prune removes the object right after it is added, once.
+      self.store.Add = add
+      object_path = add(*args)
+      os.unlink(object_path)
+      return object_path
+
+    self.store.Add = _AddAndPrune
+    self.store.Publish(self.payload, self.dest)
+    self.assertEqual(self._Read(self.dest), 'payload')
+    self.assertEqual(os.stat(self.dest).st_nlink, 3)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,130 @@
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Pre-forked devserver worker processes sharing a listening socket."""
+
+import errno
+import os
+import signal
+import sys
+import time
+import traceback
+
+from cherrypy import _cpwsgi_server
+
+import log_util
+
+
+# Module-local log function.
+def _Log(message, *args):
+  return log_util.LogWithTag('PREFORK', message, *args)
+
+
+# Workers exiting sooner than this many seconds after being started are
+# restarted only after this long, so that failing workers do not spin.
+RESTART_DELAY = 1
+
+
+class InheritedSocketWSGIServer(_cpwsgi_server.CPWSGIServer):
+  """CherryPy's WSGI server, accepting connections on a given socket.
+
+  The socket is typically inherited from the process that forked this one,
+  and shared with its other workers.
+  """
+
+  def __init__(self, listener, server_adapter):
+    _cpwsgi_server.CPWSGIServer.__init__(self, server_adapter)
+    self._listener = listener
+
+  def bind(self, family, type, proto=0):
+    self.socket = self._listener
+
+
+class WorkerPool(object):
+  """Runs and supervises worker processes forked from this one.
+
+  Workers that exit are restarted until the pool is stopped by SIGTERM or
+  SIGINT, which are passed on to the workers.
+  """
+
+  def __init__(self, num_workers, run_worker):
+    """Creates a pool of workers.
+
+    Args:
+      num_workers: number of worker processes.
+      run_worker: function run in each worker, given the worker's index in
+                  [0, num_workers); the worker exits when it returns.
+    """
+    self.num_workers = num_workers
+    self._run_worker = run_worker
+    self._stopping = False
+    # Worker indices and start times, keyed by process ID.
+    self._workers = {}
+
+  def Run(self):
+    """Starts the workers, and supervises them until they are all stopped."""
+    signal.signal(signal.SIGTERM, self._Stop)
+    signal.signal(signal.SIGINT, self._Stop)
+    for index in range(self.num_workers):
+      self._Spawn(index)
+
+    while self._workers:
+      try:
+        pid, status = os.wait()
+      except OSError as e:
+        if e.errno == errno.EINTR:
+          continue
+        raise
+      index, start_time = self._workers.pop(pid, (None, None))
+      if index is None or self._stopping:
+        continue
+      _Log('Worker %d (pid %d) exited with status %d, restarting', index, pid,
+           status)
+      if time.time() - start_time < RESTART_DELAY:
+        time.sleep(RESTART_DELAY)
+      if not self._stopping:
+        self._Spawn(index)
+
+  def _Spawn(self, index):
+    pid = os.fork()
+    if pid:
+      self._workers[pid] = (index, time.time())
+      # _Stop may have run between the fork and registering the worker, in
+      # which case it did not signal it.
+      if self._stopping:
+        self._Kill(pid)
+      return
+
+    exit_code = 0
+    try:
+      signal.signal(signal.SIGTERM, signal.SIG_DFL)
+      signal.signal(signal.SIGINT, signal.default_int_handler)
+      # Likewise, the worker may have been signalled before resetting the
+      # handlers, which then only recorded it.
+      if self._stopping:
+        return
+      self._run_worker(index)
+    except SystemExit as e:
+      exit_code = e.code if isinstance(e.code, int) else 1
+    except KeyboardInterrupt:
+      pass
+    except:
+      traceback.print_exc()
+      exit_code = 1
+    finally:
+      sys.stdout.flush()
+      sys.stderr.flush()
+      # Never return into, or run exit handlers of, the supervising process.
+      os._exit(exit_code)
+
+  def _Stop(self, _signum, _frame):
+    self._stopping = True
+    for pid in self._workers.keys():
+      self._Kill(pid)
+
+  def _Kill(self, pid):
+    try:
+      os.kill(pid, signal.SIGTERM)
+    except OSError:
+      pass
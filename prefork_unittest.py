@@ -0,0 +1,65 @@
+#!/usr/bin/python
+
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unit tests for prefork module."""
+
+import os
+import shutil
+import signal
+import tempfile
+import threading
+import time
+import unittest
+
+import prefork
+
+
+class WorkerPoolTest(unittest.TestCase):
+
+  def setUp(self):
+    self._dir = tempfile.mkdtemp('prefork_unittest')
+
+  def tearDown(self):
+    shutil.rmtree(self._dir)
+
+  def _Starts(self):
+    """Returns the indices of the workers started so far."""
+    return sorted(int(name.split('.')[0]) for name in os.listdir(self._dir))
+
+  def testRestartAndStop(self):
+    def _RunWorker(index):
+      path = os.path.join(self._dir, '%d.%d' % (index, os.getpid()))
+      open(path, 'w').close()
+      if index == 0 and self._Starts().count(0) == 1:
+        # The first worker fails once, and is restarted.
+        os._exit(1)
+      while True:
+        time.sleep(1)
+
+    pool = prefork.WorkerPool(2, _RunWorker)
+    old_delay = prefork.RESTART_DELAY
+    prefork.RESTART_DELAY = 0
+
+    def _StopWhenRestarted():
+      deadline = time.time() + 10
+      while len(self._Starts()) < 3 and time.time() < deadline:
+        time.sleep(0.05)
+      os.kill(os.getpid(), signal.SIGTERM)
+
+    stopper = threading.Thread(target=_StopWhenRestarted)
+    stopper.start()
+    try:
+      pool.Run()
+    finally:
+      prefork.RESTART_DELAY = old_delay
+      signal.signal(signal.SIGTERM, signal.SIG_DFL)
+      signal.signal(signal.SIGINT, signal.default_int_handler)
+      stopper.join()
+    self.assertEqual(self._Starts(), [0, 0, 1])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,270 @@
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Background generation of update payloads for newly built images."""
+
+import collections
+import os
+import Queue
+import threading
+import time
+
+import log_util
+
+
+# Module-local log function.
+def _Log(message, *args):
+  return log_util.LogWithTag('PREGEN', message, *args)
+
+
+# Number of finished jobs reported by the status.
+FINISHED_JOBS_KEPT = 50
+
+
+def _GetImageKey(image_path):
+  """Returns the identity of an image file, which changes with its content.
+
+  Returns None if there is no such file.
+  """
+  try:
+    st = os.stat(image_path)
+  except OSError:
+    return None
+  return (image_path, st.st_ino, st.st_size, st.st_mtime)
+
+
+class PregenJob(object):
+  """A payload generation job.
+
+  Members:
+    image_path:    full path to the image to update to.
+    src_image:     image to generate a delta from; empty for a full payload.
+    legacy_image:  whether the payload is a legacy update.gz rather than a
+                   kernel_update.gz.
+    state:         one of 'queued', 'running', 'done' or 'failed'.
+    queued_time:   time the job was queued.
+    start_time:    time the job started running, or None.
+    end_time:      time the job finished, or None.
+    cache_sub_dir: cache directory of the generated payload, once done.
+    error:         description of the failure, if any.
+  """
+  __slots__ = ('image_path', 'src_image', 'legacy_image', 'state',
+               'queued_time', 'start_time', 'end_time', 'cache_sub_dir',
+               'error')
+
+  def __init__(self, image_path, src_image, legacy_image=True):
+    self.image_path = image_path
+    self.src_image = src_image
+    self.legacy_image = legacy_image
+    self.state = 'queued'
+    self.queued_time = time.time()
+    self.start_time = None
+    self.end_time = None
+    self.cache_sub_dir = None
+    self.error = None
+
+  def ToDict(self):
+    """Returns a JSON-serializable dictionary describing the job."""
+    return dict((name, getattr(self, name)) for name in self.__slots__)
+
+
+class Pregenerator(object):
+  """Generates update payloads for new images before clients ask for them.
+
+  A watcher thread polls for the image updates would be generated from (the
+  forced image, or the latest image of the board) and queues a full payload
+  and deltas from the most recent previous images whenever that image
+  changes. Worker threads generate queued payloads through the updater, so
+  that update checks for a payload being pre-generated wait for it instead of
+  generating it again. Payloads that failed are not queued again until their
+  images change. The heavy lifting is done by
+  cros_generate_update_payload subprocesses, so threads are sufficient for
+  the jobs to run in parallel.
+
+  Members:
+    updater:       the autoupdate.Autoupdate object serving update checks.
+    num_workers:   number of payloads generated in parallel.
+    num_deltas:    number of previous images to generate deltas from.
+    poll_interval: seconds between checks for new images.
+  """
+
+  def __init__(self, updater, num_workers=1, num_deltas=0, poll_interval=60):
+    self.updater = updater
+    self.num_workers = num_workers
+    self.num_deltas = num_deltas
+    self.poll_interval = poll_interval
+    self._lock = threading.Lock()
+    self._queue = Queue.Queue()
+    # Queued and running jobs, keyed by (image_path, src_image,
+    # legacy_image).
+    self._pending = collections.OrderedDict()
+    # Failed jobs and the keys of their images when they ran, keyed like
+    # _pending.
+    self._failed = {}
+    self._finished = collections.deque(maxlen=FINISHED_JOBS_KEPT)
+    self._last_image_key = None
+    self._threads = []
+
+  def Start(self):
+    """Starts the watcher and worker threads."""
+    if self._threads:
+      return
+    self._threads.append(threading.Thread(target=self._WatchLoop,
+                                          name='pregen_watcher'))
+    for i in range(self.num_workers):
+      self._threads.append(threading.Thread(target=self._WorkLoop,
+                                            name='pregen_worker_%d' % i))
+    for thread in self._threads:
+      thread.daemon = True
+      thread.start()
+
+  def Enqueue(self, image_path, src_image='', legacy_image=True):
+    """Queues generation of a payload, unless it is queued already.
+
+    A payload that failed to generate is only queued again once its images
+    changed, so that e.g. update checks scheduling a delta do not retry it
+    for as long as clients ask.
+
+    Args:
+      image_path: full path to the image to update to.
+      src_image: image to generate a delta from; empty for a full payload.
+      legacy_image: whether to generate an update.gz or a kernel_update.gz.
+    Returns:
+      The PregenJob for the payload.
+    """
+    key = (image_path, src_image, legacy_image)
+    with self._lock:
+      job = self._pending.get(key)
+      if job:
+        return job
+      failed = self._failed.pop(key, None)
+      if failed:
+        job, image_keys = failed
+        if image_keys == self._GetImageKeys(image_path, src_image):
+          self._failed[key] = failed
+          return job
+      job = PregenJob(image_path, src_image, legacy_image)
+      self._pending[key] = job
+    _Log('Queued payload for %s (delta from %s)', image_path,
+         src_image or 'none')
+    self._queue.put(job)
+    return job
+
+  @staticmethod
+  def _GetImageKeys(image_path, src_image):
+    return (_GetImageKey(image_path),
+            _GetImageKey(src_image) if src_image else None)
+
+  def _GetImagePath(self):
+    """Returns the image updates are currently generated from, or None."""
+    if self.updater.forced_image:
+      return self.updater.forced_image
+    if not self.updater.board:
+      return None
+    latest_image_dir = self.updater._GetLatestImageDir(self.updater.board)
+    if not latest_image_dir:
+      return None
+    return os.path.join(latest_image_dir, self.updater._GetImageName())
+
+  def _GetDeltaSources(self, image_path):
+    """Returns up to num_deltas images to generate deltas to image_path from.
+
+    Candidates are the --src_image, if any, followed by the images of the
+    most recently modified sibling build directories of image_path.
+    """
+    if self.num_deltas <= 0:
+      return []
+
+    image_name = os.path.basename(image_path)
+    image_dir = os.path.dirname(os.path.abspath(image_path))
+    candidates = []
+    if self.updater.src_image:
+      candidates.append(self.updater.src_image)
+
+    board_dir = os.path.dirname(image_dir)
+    build_dirs = []
+    try:
+      entries = os.listdir(board_dir)
+    except OSError as e:
+      _Log('Failed to list previous images in %s: %s', board_dir, e)
+      entries = []
+    for entry in entries:
+      build_dir = os.path.join(board_dir, entry)
+      candidate = os.path.join(build_dir, image_name)
+      if build_dir != image_dir and os.path.isfile(candidate):
+        build_dirs.append((os.path.getmtime(build_dir), candidate))
+    candidates.extend(c for _, c in sorted(build_dirs, reverse=True))
+
+    return [c for c in candidates if c != image_path][:self.num_deltas]
+
+  def Poll(self):
+    """Queues payloads for the current image if it changed since last time."""
+    image_path = self._GetImagePath()
+    if not image_path or not os.path.isfile(image_path):
+      return
+
+    image_key = _GetImageKey(image_path)
+    if image_key == self._last_image_key:
+      return
+    self._last_image_key = image_key
+
+    _Log('New image %s, pre-generating payloads', image_path)
+    self.Enqueue(image_path)
+    for src_image in self._GetDeltaSources(image_path):
+      self.Enqueue(image_path, src_image)
+
+  def _WatchLoop(self):
+    while True:
+      try:
+        self.Poll()
+      except Exception as e:
+        _Log('Failed to check for new images: %s', e)
+      time.sleep(self.poll_interval)
+
+  def _WorkLoop(self):
+    while True:
+      job = self._queue.get()
+      try:
+        self.RunJob(job)
+      except Exception as e:  # pylint: disable=W0703
+        _Log('Failed to run pre-generation job for %s: %s', job.image_path, e)
+
+  def RunJob(self, job):
+    """Generates the payload of a job and records its outcome."""
+    job.state = 'running'
+    job.start_time = time.time()
+    image_keys = self._GetImageKeys(job.image_path, job.src_image)
+    try:
+      job.cache_sub_dir = self.updater.GenerateCachedUpdateImage(
+          job.src_image, job.image_path, self.updater.static_dir,
+          job.legacy_image)
+      job.state = 'done'
+    except Exception as e:  # pylint: disable=W0703
+      # Not only autoupdate.AutoupdateError, but also e.g. the
+      # common_util.CommonUtilError of payload locks used with --workers.
+      job.error = str(e)
+      job.state = 'failed'
+      _Log('Failed to pre-generate payload for %s: %s', job.image_path, e)
+    finally:
+      # Always let the job be queued again.
+      job.end_time = time.time()
+      key = (job.image_path, job.src_image, job.legacy_image)
+      with self._lock:
+        self._pending.pop(key, None)
+        if job.state == 'failed':
+          self._failed[key] = (job, image_keys)
+        self._finished.append(job)
+
+  def Status(self):
+    """Returns a JSON-serializable dictionary describing the job queue."""
+    with self._lock:
+      pending = [job.ToDict() for job in self._pending.itervalues()]
+      finished = [job.ToDict() for job in self._finished]
+    return {
+        'enabled': True,
+        'workers': self.num_workers,
+        'queued': [job for job in pending if job['state'] == 'queued'],
+        'running': [job for job in pending if job['state'] == 'running'],
+        'finished': finished,
+    }
@@ -0,0 +1,117 @@
+#!/usr/bin/python
+
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unit tests for pregenerator.py."""
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import mox
+
+import autoupdate
+import common_util
+import pregenerator
+
+
+_IMAGE_NAME = 'flatcar_developer_image.bin'
+
+
+class PregeneratorTest(mox.MoxTestBase):
+
+  def setUp(self):
+    mox.MoxTestBase.setUp(self)
+    self.board_dir = tempfile.mkdtemp('pregenerator_unittest')
+    self.images = []
+    for i, build in enumerate(['100.0.0', '101.0.0', '102.0.0']):
+      build_dir = os.path.join(self.board_dir, build)
+      os.mkdir(build_dir)
+      image = os.path.join(build_dir, _IMAGE_NAME)
+      with open(image, 'w') as f:
+        f.write(build)
+      os.utime(build_dir, (time.time() - 100 + i, time.time() - 100 + i))
+      self.images.append(image)
+
+    self.updater = autoupdate.Autoupdate(static_dir='/tmp/static-dir',
+                                         board='test-board')
+    self.mox.StubOutWithMock(self.updater, '_GetLatestImageDir')
+    self.mox.StubOutWithMock(self.updater, 'GenerateCachedUpdateImage')
+
+  def tearDown(self):
+    shutil.rmtree(self.board_dir)
+
+  def testPollQueuesFullAndDeltaPayloads(self):
+    latest_dir = os.path.dirname(self.images[2])
+    self.updater._GetLatestImageDir('test-board').MultipleTimes().AndReturn(
+        latest_dir)
+    self.mox.ReplayAll()
+
+    pregen = pregenerator.Pregenerator(self.updater, num_deltas=1)
+    pregen.Poll()
+    pregen.Poll()
+    status = pregen.Status()
+    self.assertEqual(
+        [(job['image_path'], job['src_image']) for job in status['queued']],
+        [(self.images[2], ''), (self.images[2], self.images[1])])
+    self.mox.VerifyAll()
+
+  def testRunJob(self):
+    self.updater.GenerateCachedUpdateImage(
+        '', self.images[2], '/tmp/static-dir', True).AndReturn('cache/abc')
+    self.updater.GenerateCachedUpdateImage(
+        self.images[1], self.images[2], '/tmp/static-dir', True).AndRaise(
+            autoupdate.AutoupdateError('failed'))
+    self.mox.ReplayAll()
+
+    pregen = pregenerator.Pregenerator(self.updater)
+    pregen.RunJob(pregen.Enqueue(self.images[2]))
+    pregen.RunJob(pregen.Enqueue(self.images[2], self.images[1]))
+    status = pregen.Status()
+    self.assertEqual(status['queued'], [])
+    self.assertEqual(
+        [(job['state'], job['cache_sub_dir']) for job in status['finished']],
+        [('done', 'cache/abc'), ('failed', None)])
+    self.mox.VerifyAll()
+
+  def testRunJobUnexpectedError(self):
+    self.updater.GenerateCachedUpdateImage(
+        '', self.images[2], '/tmp/static-dir', True).AndRaise(
+            common_util.CommonUtilError('lock failed'))
+    self.mox.ReplayAll()
+
+    pregen = pregenerator.Pregenerator(self.updater)
+    job = pregen.Enqueue(self.images[2])
+    pregen.RunJob(job)
+    self.assertEqual((job.state, job.error), ('failed', 'lock failed'))
+    # The failed job is no longer pending.
+    status = pregen.Status()
+    self.assertEqual((status['queued'], status['running']), ([], []))
+    self.mox.VerifyAll()
+
+  def testFailedJobNotQueuedUntilImageChanges(self):
+    self.updater.GenerateCachedUpdateImage(
+        self.images[1], self.images[2], '/tmp/static-dir', True).AndRaise(
+            autoupdate.AutoupdateError('failed'))
+    self.mox.ReplayAll()
+
+    pregen = pregenerator.Pregenerator(self.updater)
+    job = pregen.Enqueue(self.images[2], self.images[1])
+    pregen.RunJob(job)
+    self.assertTrue(pregen.Enqueue(self.images[2], self.images[1]) is job)
+    self.assertEqual(pregen.Status()['queued'], [])
+
+    with open(self.images[2], 'a') as f:
+      f.write('rebuilt')
+    new_job = pregen.Enqueue(self.images[2], self.images[1])
+    self.assertEqual(new_job.state, 'queued')
+    self.assertEqual(len(pregen.Status()['queued']), 1)
+    self.mox.VerifyAll()
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,180 @@
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Caching client for file information served by remote devservers."""
+
+import httplib
+import json
+import socket
+import threading
+import time
+import urlparse
+
+import common_util
+import log_util
+
+
+# Module-local log function.
+def _Log(message, *args):
+  return log_util.LogWithTag('REMOTE_METADATA', message, *args)
+
+
+# Maximum number of idle connections kept per remote host.
+MAX_IDLE_CONNECTIONS = 8
+
+
+class RemoteMetadataError(Exception):
+  """Raised when remote file information cannot be obtained."""
+  pass
+
+
+class _CacheEntry(object):
+  """File information fetched from a URL, along with its validators."""
+  __slots__ = ('file_info', 'etag', 'fetch_time')
+
+  def __init__(self, file_info, etag, fetch_time):
+    self.file_info = file_info
+    self.etag = etag
+    self.fetch_time = fetch_time
+
+
+class RemoteMetadataClient(object):
+  """Fetches and caches JSON file information from remote devservers.
+
+  Responses are cached per URL. Within ttl seconds of being fetched, cached
+  information is returned without contacting the remote; afterwards it is
+  revalidated with a conditional request using its ETag. Should the remote
+  be unreachable, information up to max_stale seconds old is returned
+  instead of failing. Concurrent lookups of a URL share a single request, and
+  connections to remotes are kept alive and reused.
+
+  Members:
+    ttl:           seconds for which fetched information is used as is.
+    max_stale:     seconds for which information is used if the remote fails.
+    timeout:       socket timeout for requests to remotes, in seconds.
+    hits:          number of lookups answered from the cache.
+    revalidations: number of lookups answered by a 304 from the remote.
+    fetches:       number of lookups answered by a full response.
+    stale_hits:    number of lookups answered with stale information.
+  """
+
+  def __init__(self, ttl=10, max_stale=300, timeout=10):
+    self.ttl = ttl
+    self.max_stale = max_stale
+    self.timeout = timeout
+    self._lock = threading.Lock()
+    self._flight = common_util.SingleFlight()
+    self._cache = {}
+    # Lists of idle connections keyed by (scheme, netloc).
+    self._idle_connections = {}
+    self.hits = 0
+    self.revalidations = 0
+    self.fetches = 0
+    self.stale_hits = 0
+
+  def _GetConnection(self, scheme, netloc):
+    with self._lock:
+      idle = self._idle_connections.get((scheme, netloc))
+      if idle:
+        return idle.pop()
+    if scheme == 'https':
+      return httplib.HTTPSConnection(netloc, timeout=self.timeout)
+    return httplib.HTTPConnection(netloc, timeout=self.timeout)
+
+  def _ReleaseConnection(self, scheme, netloc, conn):
+    with self._lock:
+      idle = self._idle_connections.setdefault((scheme, netloc), [])
+      if len(idle) < MAX_IDLE_CONNECTIONS:
+        idle.append(conn)
+        return
+    conn.close()
+
+  def _Request(self, url, etag):
+    """Issues a GET for url, retrying once on a stale kept-alive connection.
+
+    Returns:
+      A (status, etag, body) tuple.
+    """
+    scheme, netloc, path, query, _ = urlparse.urlsplit(url)
+    if query:
+      path += '?' + query
+    headers = {}
+    if etag:
+      headers['If-None-Match'] = etag
+
+    for attempt in range(2):
+      conn = self._GetConnection(scheme, netloc)
+      try:
+        conn.request('GET', path, headers=headers)
+        response = conn.getresponse()
+        body = response.read()
+      except (httplib.HTTPException, socket.error):
+        conn.close()
+        # The remote may have closed an idle connection; retry on a new one.
+        if attempt:
+          raise
+        continue
+
+      if response.will_close:
+        conn.close()
+      else:
+        self._ReleaseConnection(scheme, netloc, conn)
+      return response.status, response.getheader('ETag'), body
+
+  def _GetStale(self, url, entry, error):
+    """Returns stale information for url if recent enough, or raises."""
+    if entry and time.time() - entry.fetch_time <= self.max_stale:
+      _Log('Using stale information for %s: %s', url, error)
+      with self._lock:
+        self.stale_hits += 1
+      return entry.file_info
+    raise RemoteMetadataError('Failed to obtain %s: %s' % (url, error))
+
+  def _Fetch(self, url):
+    """Fetches or revalidates the information of url and caches it."""
+    entry = self._cache.get(url)
+    try:
+      status, etag, body = self._Request(url, entry and entry.etag)
+    except (httplib.HTTPException, socket.error) as e:
+      return self._GetStale(url, entry, e)
+
+    if status == httplib.NOT_MODIFIED and entry:
+      entry = _CacheEntry(entry.file_info, etag or entry.etag, time.time())
+      with self._lock:
+        self.revalidations += 1
+    elif status == httplib.OK:
+      try:
+        entry = _CacheEntry(json.loads(body), etag, time.time())
+      except ValueError as e:
+        raise RemoteMetadataError('Invalid response from %s: %s' % (url, e))
+      with self._lock:
+        self.fetches += 1
+    elif status >= httplib.INTERNAL_SERVER_ERROR:
+      return self._GetStale(url, entry, 'HTTP status %d' % status)
+    else:
+      raise RemoteMetadataError('HTTP status %d fetching %s' % (status, url))
+
+    with self._lock:
+      self._cache[url] = entry
+    return entry.file_info
+
+  def GetFileInfo(self, url):
+    """Returns the file information dictionary served at url.
+
+    Raises:
+      RemoteMetadataError: if the information cannot be obtained.
+    """
+    entry = self._cache.get(url)
+    if entry and time.time() - entry.fetch_time < self.ttl:
+      with self._lock:
+        self.hits += 1
+      return entry.file_info
+    return self._flight.Do(url, lambda: self._Fetch(url))
+
+  def Stats(self):
+    """Returns a dictionary of client counters."""
+    with self._lock:
+      return {'entries': len(self._cache), 'hits': self.hits,
+              'revalidations': self.revalidations, 'fetches': self.fetches,
+              'stale_hits': self.stale_hits}
@@ -0,0 +1,175 @@
+#!/usr/bin/python
+
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unit tests for remote_metadata module."""
+
+import BaseHTTPServer
+import json
+import socket
+import SocketServer
+import threading
+import time
+import unittest
+
+import remote_metadata
+
+
+_FILE_INFO = {'sha1': 'abc', 'sha256': 'def', 'size': 42, 'is_delta': False}
+_ETAG = '"1-2-3-4"'
+
+
+class _FileInfoHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  """Serves _FILE_INFO with an ETag over keep-alive connections."""
+  protocol_version = 'HTTP/1.1'
+
+  def setup(self):
+    BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+    with self.server.lock:
+      self.server.sockets.append(self.connection)
+
+  def do_GET(self):
+    server = self.server
+    with server.lock:
+      server.requests += 1
+      server.connections.add(self.client_address)
+    if server.delay:
+      time.sleep(server.delay)
+    if server.status != 200:
+      self.send_response(server.status)
+      self.send_header('Content-Length', '0')
+      self.end_headers()
+      return
+    if self.headers.get('If-None-Match') == _ETAG:
+      self.send_response(304)
+      self.send_header('ETag', _ETAG)
+      self.send_header('Content-Length', '0')
+      self.end_headers()
+      return
+    body = json.dumps(_FILE_INFO)
+    self.send_response(200)
+    self.send_header('ETag', _ETAG)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, *args):
+    pass
+
+
+class _StubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  daemon_threads = True
+
+  def handle_error(self, request, client_address):
+    # Connections dropped by _StopServer are expected.
+    pass
+
+
+class RemoteMetadataClientTest(unittest.TestCase):
+
+  def setUp(self):
+    self._server = _StubServer(('127.0.0.1', 0), _FileInfoHandler)
+    self._server.lock = threading.Lock()
+    self._server.sockets = []
+    self._server.requests = 0
+    self._server.connections = set()
+    self._server.delay = 0
+    self._server.status = 200
+    self._thread = threading.Thread(target=self._server.serve_forever)
+    self._thread.daemon = True
+    self._thread.start()
+    self._url = ('http://127.0.0.1:%d/api/fileinfo/update.gz' %
+                 self._server.server_port)
+
+  def tearDown(self):
+    self._StopServer()
+
+  def _StopServer(self):
+    if self._server:
+      self._server.shutdown()
+      self._server.server_close()
+      # Also drop the connections kept alive for clients.
+      for sock in self._server.sockets:
+        try:
+          sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+          pass
+      self._server = None
+
+  def _Expire(self, client):
+    for entry in client._cache.itervalues():
+      entry.fetch_time -= client.ttl + 1
+
+  def testCachedWithinTtl(self):
+    client = remote_metadata.RemoteMetadataClient(ttl=60)
+    for _ in range(3):
+      self.assertEqual(client.GetFileInfo(self._url), _FILE_INFO)
+    self.assertEqual(self._server.requests, 1)
+    self.assertEqual(client.Stats()['hits'], 2)
+
+  def testRevalidatedWithEtag(self):
+    client = remote_metadata.RemoteMetadataClient(ttl=60)
+    client.GetFileInfo(self._url)
+    self._Expire(client)
+    self.assertEqual(client.GetFileInfo(self._url), _FILE_INFO)
+    self.assertEqual(self._server.requests, 2)
+    self.assertEqual(client.fetches, 1)
+    self.assertEqual(client.revalidations, 1)
+
+  def testConnectionReused(self):
+    client = remote_metadata.RemoteMetadataClient(ttl=0)
+    for _ in range(3):
+      client.GetFileInfo(self._url)
+    self.assertEqual(self._server.requests, 3)
+    self.assertEqual(len(self._server.connections), 1)
+
+  def testConcurrentLookupsCoalesced(self):
+    self._server.delay = 0.2
+    client = remote_metadata.RemoteMetadataClient(ttl=60)
+    results = []
+    threads = [threading.Thread(
+        target=lambda: results.append(client.GetFileInfo(self._url)))
+               for _ in range(5)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    self.assertEqual(results, [_FILE_INFO] * 5)
+    self.assertEqual(self._server.requests, 1)
+
+  def testStaleOnServerError(self):
+    client = remote_metadata.RemoteMetadataClient(ttl=60)
+    client.GetFileInfo(self._url)
+    self._Expire(client)
+    self._server.status = 503
+    self.assertEqual(client.GetFileInfo(self._url), _FILE_INFO)
+    self.assertEqual(client.stale_hits, 1)
+
+  def testStaleWhenUnreachable(self):
+    client = remote_metadata.RemoteMetadataClient(ttl=60)
+    client.GetFileInfo(self._url)
+    self._Expire(client)
+    self._StopServer()
+    self.assertEqual(client.GetFileInfo(self._url), _FILE_INFO)
+    self.assertEqual(client.stale_hits, 1)
+
+  def testTooStaleWhenUnreachable(self):
+    client = remote_metadata.RemoteMetadataClient(ttl=60, max_stale=0)
+    client.GetFileInfo(self._url)
+    self._Expire(client)
+    self._StopServer()
+    self.assertRaises(remote_metadata.RemoteMetadataError,
+                      client.GetFileInfo, self._url)
+
+  def testNotFound(self):
+    self._server.status = 404
+    client = remote_metadata.RemoteMetadataClient()
+    self.assertRaises(remote_metadata.RemoteMetadataError,
+                      client.GetFileInfo, self._url)
+
+
+if __name__ == '__main__':
+  unittest.main()
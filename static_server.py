@@ -0,0 +1,387 @@
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Serving of static payloads with sendfile and HTTP range support."""
+
+import collections
+import ctypes
+import errno
+import mimetypes
+import os
+import select
+import socket
+import sys
+import threading
+
+import cherrypy
+from cherrypy.lib import cptools
+from cherrypy.lib import httputil
+try:
+  from cherrypy.wsgiserver import wsgiserver2
+except ImportError:
+  from cherrypy import wsgiserver as wsgiserver2
+
+import log_util
+
+
+# Module-local log function.
+def _Log(message, *args):
+  return log_util.LogWithTag('STATIC', message, *args)
+
+
+# Number of open files kept for serving.
+FD_CACHE_SIZE = 64
+
+# Bytes sent per sendfile call, and yielded per chunk without sendfile.
+_CHUNK_SIZE = 1024 * 1024
+
+# WSGI version selecting SendfileWSGIGateway through 'server.wsgi_version'.
+WSGI_VERSION = ('sendfile', 1, 0)
+
+
+def _GetSendfile():
+  """Returns a sendfile(out_fd, in_fd, offset, count) function, or None."""
+  if hasattr(os, 'sendfile'):
+    return os.sendfile
+  try:
+    from sendfile import sendfile
+    return sendfile
+  except ImportError:
+    pass
+
+  # Python 2 has no os.sendfile; call the C library's on 64-bit Linux, where
+  # off_t is a 64-bit integer.
+  if not (sys.platform.startswith('linux') and
+          ctypes.sizeof(ctypes.c_void_p) == 8):
+    return None
+  try:
+    libc_sendfile = ctypes.CDLL(None, use_errno=True).sendfile
+  except (AttributeError, OSError):
+    return None
+  libc_sendfile.restype = ctypes.c_ssize_t
+  libc_sendfile.argtypes = (ctypes.c_int, ctypes.c_int,
+                            ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t)
+
+  def _LibcSendfile(out_fd, in_fd, offset, count):
+    sent = libc_sendfile(out_fd, in_fd, ctypes.byref(ctypes.c_int64(offset)),
+                         count)
+    if sent < 0:
+      err = ctypes.get_errno()
+      raise OSError(err, os.strerror(err))
+    return sent
+
+  return _LibcSendfile
+
+
+sendfile = _GetSendfile()
+
+
+class _OpenFile(object):
+  """A file open for serving, shared by the requests serving it.
+
+  Members:
+    path:     path the file was opened at.
+    fd:       the open file descriptor.
+    stat_key: (device, inode, size, mtime) of the file when opened.
+    refs:     number of responses using the file.
+    evicted:  whether the file was evicted from the cache, and should be
+              closed once no longer used.
+  """
+  __slots__ = ('path', 'fd', 'stat_key', 'refs', 'evicted', '_lock')
+
+  def __init__(self, path, fd, stat_key):
+    self.path = path
+    self.fd = fd
+    self.stat_key = stat_key
+    self.refs = 0
+    self.evicted = False
+    # Serializes seeking and reading the shared file offset of fd.
+    self._lock = threading.Lock()
+
+  def Read(self, offset, length):
+    """Reads up to length bytes at offset, or '' past the end of the file.
+
+    Unlike a memory mapping, reading fails gracefully if the file is
+    truncated in place while being served.
+    """
+    with self._lock:
+      os.lseek(self.fd, offset, os.SEEK_SET)
+      return os.read(self.fd, length)
+
+  def Close(self):
+    os.close(self.fd)
+
+
+class FileCache(object):
+  """A small LRU cache of files open for serving.
+
+  Files are validated by stat on every lookup, so replaced payloads are
+  reopened. Evicted files are closed once the last response using them is
+  done.
+  """
+
+  def __init__(self, max_files=FD_CACHE_SIZE):
+    self._max_files = max_files
+    self._lock = threading.Lock()
+    self._files = collections.OrderedDict()
+    # Files being served, including evicted ones.
+    self._in_use = set()
+    self.hits = 0
+    self.misses = 0
+
+  def Acquire(self, path, st):
+    """Returns an _OpenFile for path, whose current status is st.
+
+    Raises:
+      OSError: if the file cannot be opened.
+    """
+    stat_key = (st.st_dev, st.st_ino, st.st_size, st.st_mtime)
+    with self._lock:
+      open_file = self._files.pop(path, None)
+      if open_file and open_file.stat_key != stat_key:
+        self._Evict(open_file)
+        open_file = None
+      if open_file:
+        self.hits += 1
+        self._files[path] = open_file
+        open_file.refs += 1
+        self._in_use.add(open_file)
+        return open_file
+      self.misses += 1
+
+    open_file = _OpenFile(path, os.open(path, os.O_RDONLY), stat_key)
+    open_file.refs += 1
+    with self._lock:
+      self._in_use.add(open_file)
+      if path in self._files:
+        self._Evict(self._files.pop(path))
+      self._files[path] = open_file
+      while len(self._files) > self._max_files:
+        self._Evict(self._files.popitem(last=False)[1])
+    return open_file
+
+  def Release(self, open_file):
+    with self._lock:
+      open_file.refs -= 1
+      if not open_file.refs:
+        self._in_use.discard(open_file)
+        if open_file.evicted:
+          open_file.Close()
+
+  def _Evict(self, open_file):
+    """Marks a file evicted, closing it if unused; assumes the lock is held."""
+    open_file.evicted = True
+    if not open_file.refs:
+      open_file.Close()
+
+  def InUse(self, dir_path):
+    """Returns whether files under a directory are being served."""
+    prefix = os.path.join(os.path.realpath(dir_path), '')
+    with self._lock:
+      paths = [open_file.path for open_file in self._in_use]
+    return any(os.path.realpath(path).startswith(prefix) for path in paths)
+
+  def Stats(self):
+    with self._lock:
+      return {'open_files': len(self._files), 'hits': self.hits,
+              'misses': self.misses}
+
+
+class FileBody(object):
+  """Response body serving a byte range of an open file.
+
+  Iterating yields the range in chunks. SendfileWSGIGateway and
+  async_server recognize these bodies and send them with sendfile instead.
+  """
+
+  def __init__(self, cache, open_file, start, length):
+    self._cache = cache
+    self._file = open_file
+    self._offset = start
+    self._remaining = length
+
+  def __iter__(self):
+    return self
+
+  def next(self):
+    if self._remaining <= 0:
+      self.close()
+      raise StopIteration
+    chunk = self._file.Read(self._offset, min(self._remaining, _CHUNK_SIZE))
+    if not chunk:
+      self.close()
+      raise IOError('File shrank while being served')
+    self._offset += len(chunk)
+    self._remaining -= len(chunk)
+    return chunk
+
+  @property
+  def remaining(self):
+    return self._remaining
+
+  def Send(self, out_fd):
+    """Sends part of the rest of the range with a single sendfile call.
+
+    Returns:
+      The number of bytes sent.
+    Raises:
+      OSError: if sendfile fails, e.g. with EAGAIN on a non-blocking socket.
+      IOError: if the file shrank while being served.
+    """
+    sent = sendfile(out_fd, self._file.fd, self._offset,
+                    min(self._remaining, _CHUNK_SIZE))
+    if not sent:
+      raise IOError('File shrank while being served')
+    self._offset += sent
+    self._remaining -= sent
+    return sent
+
+  def SendTo(self, sock):
+    """Sends the rest of the range to a socket with sendfile."""
+    out_fd = sock.fileno()
+    timeout = sock.gettimeout()
+    try:
+      while self._remaining > 0:
+        try:
+          self.Send(out_fd)
+        except OSError as e:
+          if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+            # Sockets with a timeout are non-blocking underneath.
+            if not select.select([], [out_fd], [], timeout)[1]:
+              raise socket.timeout('timed out')
+            continue
+          raise socket.error(e.errno, e.strerror)
+    finally:
+      self.close()
+
+  def Detach(self):
+    """Returns a FileBody taking over the rest of the range from this one.
+
+    This one is left empty, so that closing it does not release the file.
+    """
+    body = FileBody(self._cache, self._file, self._offset, self._remaining)
+    self._file = None
+    self._remaining = 0
+    return body
+
+  def close(self):
+    if self._file:
+      self._cache.Release(self._file)
+      self._file = None
+
+
+def GetFileBody(response):
+  """Returns the FileBody a WSGI response iterates over, or None.
+
+  CherryPy wraps response bodies in several layers of iterators, each
+  keeping the one it wraps as iter_response.
+  """
+  body = response
+  while not isinstance(body, FileBody):
+    inner = getattr(body, 'iter_response', None)
+    if inner is None or inner is body:
+      return None
+    body = inner
+  return body
+
+
+class SendfileWSGIGateway(wsgiserver2.WSGIGateway_10):
+  """A WSGI gateway sending FileBody responses with sendfile."""
+
+  def respond(self):
+    response = self.req.server.wsgi_app(self.env, self.start_response)
+    try:
+      body = GetFileBody(response)
+      if body and sendfile and not self.req.server.ssl_adapter:
+        if not self.req.sent_headers:
+          self.req.sent_headers = True
+          self.req.send_headers()
+        body.SendTo(self.req.conn.socket)
+        return
+
+      for chunk in response:
+        if chunk:
+          if isinstance(chunk, unicode):
+            chunk = chunk.encode('ISO-8859-1')
+          self.write(chunk)
+    finally:
+      if hasattr(response, 'close'):
+        response.close()
+
+
+wsgiserver2.wsgi_gateways[WSGI_VERSION] = SendfileWSGIGateway
+
+
+class StaticServer(object):
+  """Serves files under a root directory, like tools.staticdir.
+
+  Responses carry Content-Length, Last-Modified, ETag and Accept-Ranges
+  headers. A single byte range is served with a 206, optionally subject to
+  If-Range. Files are served from a FileCache, and sent with sendfile when
+  the server uses SendfileWSGIGateway.
+  """
+
+  def __init__(self, root):
+    self.root = os.path.normpath(root)
+    self.file_cache = FileCache()
+
+  def _GetPath(self, path_args):
+    """Returns the path of a file under the root, or raises a 404.
+
+    Symlinks under the root, like static/archive, are followed.
+    """
+    path = os.path.normpath(os.path.join(self.root, *path_args))
+    if not path.startswith(self.root + os.sep):
+      raise cherrypy.NotFound()
+    return path
+
+  @cherrypy.expose
+  def default(self, *path_args):
+    path = self._GetPath(path_args)
+    try:
+      st = os.stat(path)
+    except OSError:
+      raise cherrypy.NotFound()
+    if not os.path.isfile(path):
+      raise cherrypy.NotFound()
+
+    request = cherrypy.serving.request
+    response = cherrypy.serving.response
+    size = st.st_size
+    etag = '"%x-%x-%x"' % (st.st_ino, size, int(st.st_mtime))
+    last_modified = httputil.HTTPDate(st.st_mtime)
+    response.headers['Last-Modified'] = last_modified
+    response.headers['ETag'] = etag
+    response.headers['Accept-Ranges'] = 'bytes'
+    response.headers['Content-Type'] = (mimetypes.guess_type(path)[0] or
+                                        'application/octet-stream')
+    cptools.validate_since()
+    cptools.validate_etags()
+
+    start, length = 0, size
+    range_header = request.headers.get('Range')
+    if_range = request.headers.get('If-Range')
+    if range_header and (not if_range or if_range in (etag, last_modified)):
+      ranges = httputil.get_ranges(range_header, size)
+      if ranges == []:
+        response.headers['Content-Range'] = 'bytes */%d' % size
+        raise cherrypy.HTTPError(416, 'Invalid Range for a file of %d bytes'
+                                 % size)
+      if ranges and len(ranges) == 1:
+        start, stop = ranges[0]
+        length = min(stop, size) - start
+        response.status = 206
+        response.headers['Content-Range'] = 'bytes %d-%d/%d' % (
+            start, start + length - 1, size)
+      # Multiple ranges are not worth a multipart body for payloads; they
+      # are answered with the whole file.
+
+    response.headers['Content-Length'] = str(length)
+    if request.method == 'HEAD':
+      return ''
+    try:
+      open_file = self.file_cache.Acquire(path, st)
+    except OSError:
+      raise cherrypy.NotFound()
+    return FileBody(self.file_cache, open_file, start, length)
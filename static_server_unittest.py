@@ -0,0 +1,251 @@
+#!/usr/bin/python
+
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unit tests for static_server module."""
+
+import httplib
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import time
+import unittest
+
+import cherrypy
+
+import static_server
+
+
+# Size in MiB of the payload downloaded by the serving benchmark, which only
+# runs if this environment variable is set.
+STATIC_BENCHMARK_SIZE_ENV = 'DEVSERVER_STATIC_BENCHMARK_MB'
+
+_PAYLOAD = ''.join(chr(i % 251) for i in range(256 * 1024))
+
+
+def _GetFreePort():
+  sock = socket.socket()
+  sock.bind(('127.0.0.1', 0))
+  port = sock.getsockname()[1]
+  sock.close()
+  return port
+
+
+class StaticServerTest(unittest.TestCase):
+  """Serves a directory through StaticServer, and through tools.staticdir."""
+
+  @classmethod
+  def setUpClass(cls):
+    cls.root = tempfile.mkdtemp('static_server_unittest')
+    with open(os.path.join(cls.root, 'update.gz'), 'wb') as f:
+      f.write(_PAYLOAD)
+    cls.server = static_server.StaticServer(cls.root)
+
+    cls.port = _GetFreePort()
+    cherrypy.config.update({
+        'environment': 'embedded',
+        'log.screen': False,
+        'server.socket_host': '127.0.0.1',
+        'server.socket_port': cls.port,
+        'server.wsgi_version': static_server.WSGI_VERSION,
+    })
+    cherrypy.tree.mount(cls.server, '/static',
+                        {'/': {'response.stream': True}})
+    cherrypy.tree.mount(None, '/staticdir',
+                        {'/': {'tools.staticdir.on': True,
+                               'tools.staticdir.dir': cls.root}})
+    cherrypy.engine.start()
+    cherrypy.engine.wait(cherrypy.engine.states.STARTED)
+
+  @classmethod
+  def tearDownClass(cls):
+    cherrypy.engine.exit()
+    shutil.rmtree(cls.root)
+
+  def _Get(self, path, headers=None, method='GET'):
+    conn = httplib.HTTPConnection('127.0.0.1', self.port)
+    try:
+      conn.request(method, path, headers=headers or {})
+      response = conn.getresponse()
+      return response, response.read()
+    finally:
+      conn.close()
+
+  def testServeFile(self):
+    response, body = self._Get('/static/update.gz')
+    self.assertEqual(response.status, 200)
+    self.assertEqual(body, _PAYLOAD)
+    self.assertEqual(response.getheader('Content-Length'), str(len(_PAYLOAD)))
+    self.assertEqual(response.getheader('Accept-Ranges'), 'bytes')
+    self.assertTrue(response.getheader('ETag'))
+
+  def testServeFileWithSendfile(self):
+    if not static_server.sendfile:
+      self.skipTest('sendfile is unavailable')
+    calls = []
+    sendfile = static_server.sendfile
+
+    def _Sendfile(*args):
+      calls.append(args)
+      return sendfile(*args)
+
+    static_server.sendfile = _Sendfile
+    try:
+      response, body = self._Get('/static/update.gz')
+    finally:
+      static_server.sendfile = sendfile
+    self.assertEqual(body, _PAYLOAD)
+    self.assertTrue(calls)
+
+  def testServeFileWithoutSendfile(self):
+    sendfile = static_server.sendfile
+    static_server.sendfile = None
+    try:
+      response, body = self._Get('/static/update.gz')
+    finally:
+      static_server.sendfile = sendfile
+    self.assertEqual(response.status, 200)
+    self.assertEqual(body, _PAYLOAD)
+
+  def testHead(self):
+    response, body = self._Get('/static/update.gz', method='HEAD')
+    self.assertEqual(response.status, 200)
+    self.assertEqual(body, '')
+    self.assertEqual(response.getheader('Content-Length'), str(len(_PAYLOAD)))
+
+  def testRange(self):
+    response, body = self._Get('/static/update.gz',
+                               {'Range': 'bytes=1000-1999'})
+    self.assertEqual(response.status, 206)
+    self.assertEqual(body, _PAYLOAD[1000:2000])
+    self.assertEqual(response.getheader('Content-Range'),
+                     'bytes 1000-1999/%d' % len(_PAYLOAD))
+
+    response, body = self._Get('/static/update.gz', {'Range': 'bytes=-10'})
+    self.assertEqual(body, _PAYLOAD[-10:])
+
+  def testUnsatisfiableRange(self):
+    response, _ = self._Get('/static/update.gz',
+                            {'Range': 'bytes=%d-' % len(_PAYLOAD)})
+    self.assertEqual(response.status, 416)
+
+  def testIfRange(self):
+    response, _ = self._Get('/static/update.gz')
+    etag = response.getheader('ETag')
+    response, body = self._Get('/static/update.gz',
+                               {'Range': 'bytes=10-19', 'If-Range': etag})
+    self.assertEqual(response.status, 206)
+    self.assertEqual(body, _PAYLOAD[10:20])
+
+    # A stale validator gets the whole, current file.
+    response, body = self._Get('/static/update.gz',
+                               {'Range': 'bytes=10-19', 'If-Range': '"old"'})
+    self.assertEqual(response.status, 200)
+    self.assertEqual(body, _PAYLOAD)
+
+  def testIfNoneMatch(self):
+    response, _ = self._Get('/static/update.gz')
+    response, body = self._Get(
+        '/static/update.gz', {'If-None-Match': response.getheader('ETag')})
+    self.assertEqual(response.status, 304)
+    self.assertEqual(body, '')
+
+  def testNotFound(self):
+    self.assertEqual(self._Get('/static/missing.gz')[0].status, 404)
+    self.assertEqual(self._Get('/static/')[0].status, 404)
+    self.assertEqual(
+        self.server._GetPath(['update.gz']),
+        os.path.join(self.root, 'update.gz'))
+    self.assertRaises(cherrypy.NotFound, self.server._GetPath,
+                      ['..', 'etc', 'passwd'])
+
+  def testFileCacheReopensChangedFiles(self):
+    self._Get('/static/update.gz')
+    hits = self.server.file_cache.hits
+    self._Get('/static/update.gz')
+    self.assertEqual(self.server.file_cache.hits, hits + 1)
+
+    path = os.path.join(self.root, 'changed.gz')
+    with open(path, 'wb') as f:
+      f.write('old')
+    self.assertEqual(self._Get('/static/changed.gz')[1], 'old')
+    os.unlink(path)
+    with open(path, 'wb') as f:
+      f.write('new content')
+    self.assertEqual(self._Get('/static/changed.gz')[1], 'new content')
+
+  def testFileCacheInUse(self):
+    cache = static_server.FileCache(max_files=1)
+    sub_dir = os.path.join(self.root, 'entry')
+    os.mkdir(sub_dir)
+    path = os.path.join(sub_dir, 'update.gz')
+    with open(path, 'wb') as f:
+      f.write('payload')
+    try:
+      open_file = cache.Acquire(path, os.stat(path))
+      # Files still being served count even once evicted from the cache.
+      cache.Acquire(os.path.join(self.root, 'update.gz'),
+                    os.stat(os.path.join(self.root, 'update.gz')))
+      self.assertTrue(cache.InUse(sub_dir))
+      self.assertFalse(cache.InUse(sub_dir + '2'))
+      cache.Release(open_file)
+      self.assertFalse(cache.InUse(sub_dir))
+    finally:
+      shutil.rmtree(sub_dir)
+
+  def testFileBodyTruncatedInPlace(self):
+    cache = static_server.FileCache()
+    path = os.path.join(self.root, 'truncated.gz')
+    with open(path, 'wb') as f:
+      f.write(_PAYLOAD)
+    try:
+      open_file = cache.Acquire(path, os.stat(path))
+      body = static_server.FileBody(cache, open_file, 0, len(_PAYLOAD))
+      self.assertEqual(open_file.Read(0, 10), _PAYLOAD[:10])
+      # Files truncated in place, as common_util.CopyFile does, end the
+      # response with an error rather than crashing the server.
+      with open(path, 'r+b') as f:
+        f.truncate(1000)
+      self.assertEqual(body.next(), _PAYLOAD[:1000])
+      self.assertRaises(IOError, body.next)
+      self.assertEqual(open_file.refs, 0)
+    finally:
+      os.unlink(path)
+
+  def testBenchmark(self):
+    """Compares download throughput against tools.staticdir."""
+    size_mb = os.environ.get(STATIC_BENCHMARK_SIZE_ENV)
+    if not size_mb:
+      self.skipTest('set %s to run' % STATIC_BENCHMARK_SIZE_ENV)
+
+    path = os.path.join(self.root, 'benchmark.bin')
+    block = os.urandom(1024 * 1024)
+    with open(path, 'wb') as f:
+      for _ in range(int(size_mb)):
+        f.write(block)
+
+    def _Download(url_path):
+      conn = httplib.HTTPConnection('127.0.0.1', self.port)
+      start = time.time()
+      conn.request('GET', url_path)
+      response = conn.getresponse()
+      while response.read(1024 * 1024):
+        pass
+      conn.close()
+      return int(size_mb) / (time.time() - start)
+
+    staticdir = _Download('/staticdir/benchmark.bin')
+    sendfile = _Download('/static/benchmark.bin')
+    sys.stderr.write(
+        '\nDownloading %s MiB: tools.staticdir %.1f MiB/s, '
+        'StaticServer %.1f MiB/s (sendfile %s)\n' %
+        (size_mb, staticdir, sendfile,
+         'available' if static_server.sendfile else 'unavailable'))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -4,10 +4,40 @@
 # Use of this source code is governed by a BSD-style license that can be
 # found in the LICENSE file.
 
-from xml.dom import minidom
-import sys
+"""Smoke test and load benchmark for the devserver.
+
+  update_test.py [num_clients]
+
+pings a devserver running on localhost:8080 from num_clients concurrent
+clients, and checks the responses.
+
+  update_test.py --benchmark --archive_dir PATH [options]
+
+starts a devserver serving the update in PATH in this process, drives
+/update, /api/fileinfo, /api/hostinfo and /static with concurrent clients
+for a while, and reports latency percentiles, throughput and error rates.
+Update checks answered with noupdate count as errors; the update blobs ask
+for kernel_update.gz, which PATH must hold.
+Use --url to benchmark a devserver running elsewhere instead, and --output
+to save the results as JSON, to compare them across commits.
+"""
+
+import bisect
+import httplib
+import json
+import multiprocessing
+import optparse
+import os
+import random
+import shutil
+import socket
+import subprocess
+import tempfile
 import threading
+import time
 import urllib2
+import urlparse
+from xml.dom import minidom
 
 
 UPDATE_BLOB="""\
@@ -35,10 +65,35 @@ UPDATE_BLOB="""\
 </o:gupdate>
 """
 
+UPDATE_BLOB_V3="""\
+<?xml version="1.0" encoding="UTF-8"?>
+<request protocol="3.0" version="MementoSoftwareUpdate-0.1.0.0"
+  updaterversion="MementoSoftwareUpdate-0.1.0.0" ismachine="1">
+<os version="Memento" platform="memento" sp="ForcedUpdate_i686"></os>
+<app appid="{87efface-864d-49a5-9bb3-4b050a7c227a}"
+   version="ForcedUpdate"
+   track="developer-build"
+   board="x86-generic"
+   lang="en-us">
+<ping active="0"></ping>
+<updatecheck></updatecheck>
+</app>
+</request>
+"""
+
+UPDATE_BLOBS = {'2.0': UPDATE_BLOB, '3.0': UPDATE_BLOB_V3}
+
 UPDATE_URL = 'http://localhost:8080/update/'
 
+# Default benchmark request mix, as relative weights of the operations.
+DEFAULT_MIX = 'update=70,fileinfo=10,hostinfo=10,static=10'
+
+# Reported latency percentiles.
+PERCENTILES = (50, 95, 99)
+
+
 def do_ping():
-  update_ping = urllib2.Request(UPDATE_URL, update_blob)
+  update_ping = urllib2.Request(UPDATE_URL, UPDATE_BLOB)
   update_ping.add_header('Content-Type', 'text/xml')
   print urllib2.urlopen(update_ping).read()
   #TODO assert noupdate
@@ -81,29 +136,396 @@ def _verify_response(data):
   hash = update_info.getAttribute('hash')
   head_request = urllib2.Request(update_url)
   head_request.get_method = lambda: 'HEAD'
+  length = 0
+  fd = None
   try:
     fd = urllib2.urlopen(head_request)
   except urllib2.HTTPError, e:
     # HTTP error
     print 'FAILED: unable to retrieve %s\n\t%s' % (update_url, e)
-    length = 0
   else:
     # HTTP succeeded
     length = int(fd.headers.getheaders('Content-Length')[0])
   finally:
-    fd.close()
-    return (length > 0)
+    if fd:
+      fd.close()
+  return (length > 0)
 
 def test(num_clients):
   # Fake some concurrent requests for each autoupdate operation.
+  threads = []
   for clients in range(num_clients):
     for op in (do_version_ping, do_badversion_ping):
       t = threading.Thread(target=op)
       t.start()
+      threads.append(t)
+  for t in threads:
+    t.join()
+
+
+class _Operation(object):
+  """A kind of request made by benchmark clients.
+
+  Members:
+    name:   name of the operation in the request mix and results.
+    method: HTTP method of the requests.
+    path:   path of the requests.
+    body:   body of the requests, if any.
+    expect: string the response body must contain, if any.
+  """
+
+  def __init__(self, name, method, path, body=None, expect=None):
+    self.name = name
+    self.method = method
+    self.path = path
+    self.body = body
+    self.expect = expect
+
+  def Run(self, conn):
+    """Makes a request on conn.
+
+    Returns:
+      A (success, response size) tuple.
+    """
+    headers = {'Content-Type': 'text/xml'} if self.body else {}
+    conn.request(self.method, self.path, self.body, headers)
+    response = conn.getresponse()
+    size = 0
+    found = not self.expect
+    while True:
+      data = response.read(1024 * 1024)
+      if not data:
+        break
+      size += len(data)
+      found = found or self.expect in data
+    return response.status == 200 and found, size
+
+
+def _GetOperations(options):
+  """Returns the benchmark operations, keyed by name."""
+  base_path = urlparse.urlsplit(options.url).path.rstrip('/')
+  operations = [
+      _Operation('update', 'POST', base_path + '/update',
+                 UPDATE_BLOBS[options.protocol], expect='codebase='),
+      _Operation('fileinfo', 'GET',
+                 '%s/api/fileinfo/%s' % (base_path, options.payload),
+                 expect='sha256'),
+      _Operation('hostinfo', 'GET',
+                 base_path + '/api/hostinfo?ip=127.0.0.1'),
+      _Operation('static', 'GET',
+                 '%s/static/%s' % (base_path, options.static_path)),
+  ]
+  return dict((op.name, op) for op in operations)
+
+
+def _ParseMix(mix, operations):
+  """Returns a list of (operation name, weight) pairs from a mix string."""
+  weights = []
+  for item in mix.split(','):
+    name, _, weight = item.partition('=')
+    name = name.strip()
+    if name not in operations:
+      raise ValueError('unknown operation %r, expected one of %s' %
+                       (name, ', '.join(sorted(operations))))
+    weights.append((name, float(weight or 1)))
+  if not any(weight > 0 for _, weight in weights):
+    raise ValueError('no operation has a positive weight')
+  return weights
+
+
+def _RunClients(host, port, operations, weights, num_threads, duration, seed,
+                start, results):
+  """Makes requests from num_threads threads, each with its own connection.
+
+  Waits for the start event, then makes requests for duration seconds, and
+  puts a dictionary of latencies (in seconds), error counts and response
+  sizes, keyed by operation name, in the results queue.
+  """
+  names = [name for name, _ in weights]
+  cumulative = []
+  total = 0
+  for _, weight in weights:
+    total += weight
+    cumulative.append(total)
+
+  samples = dict((name, {'latencies': [], 'errors': 0, 'bytes': 0})
+                 for name in names)
+  lock = threading.Lock()
+
+  def _Client(index):
+    rng = random.Random(seed * 1000 + index)
+    conn = httplib.HTTPConnection(host, port, timeout=60)
+    latencies = dict((name, []) for name in names)
+    errors = dict((name, 0) for name in names)
+    sizes = dict((name, 0) for name in names)
+    deadline = time.time() + duration
+    while time.time() < deadline:
+      name = names[bisect.bisect(cumulative, rng.random() * total)]
+      begin = time.time()
+      try:
+        success, size = operations[name].Run(conn)
+      except (httplib.HTTPException, socket.error):
+        success, size = False, 0
+        conn.close()
+        conn = httplib.HTTPConnection(host, port, timeout=60)
+      if success:
+        latencies[name].append(time.time() - begin)
+        sizes[name] += size
+      else:
+        errors[name] += 1
+    conn.close()
+    with lock:
+      for name in names:
+        samples[name]['latencies'].extend(latencies[name])
+        samples[name]['errors'] += errors[name]
+        samples[name]['bytes'] += sizes[name]
+
+  start.wait()
+  threads = [threading.Thread(target=_Client, args=(i,))
+             for i in range(num_threads)]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  results.put(samples)
+
+
+def _Percentile(sorted_values, percentile):
+  """Returns a percentile of sorted values, by the nearest-rank method."""
+  if not sorted_values:
+    return None
+  rank = max(1, int(round(percentile / 100.0 * len(sorted_values))))
+  return sorted_values[rank - 1]
+
+
+def _Summarize(latencies, errors, size, duration):
+  """Returns the results of an operation, or of all of them."""
+  latencies = sorted(latencies)
+  requests = len(latencies) + errors
+  summary = {
+      'requests': requests,
+      'errors': errors,
+      'error_rate': float(errors) / requests if requests else 0.0,
+      'throughput': len(latencies) / duration,
+      'bytes_per_second': size / duration,
+  }
+  if latencies:
+    summary['latency_ms'] = dict(
+        ('p%d' % p, _Percentile(latencies, p) * 1000) for p in PERCENTILES)
+    summary['latency_ms']['mean'] = sum(latencies) / len(latencies) * 1000
+    summary['latency_ms']['max'] = latencies[-1] * 1000
+  return summary
+
+
+def _GetRevision():
+  """Returns the git revision of this checkout, or None."""
+  try:
+    return subprocess.check_output(
+        ['git', 'rev-parse', 'HEAD'], stderr=open(os.devnull, 'w'),
+        cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+
+def _GetFreePort():
+  sock = socket.socket()
+  sock.bind(('127.0.0.1', 0))
+  port = sock.getsockname()[1]
+  sock.close()
+  return port
+
+
+def _StartDevserver(options, port, static_root):
+  """Starts a devserver serving options.archive_dir in this process.
+
+  The archive is served as /static/archive from static_root, a temporary
+  directory, rather than from the static directory of the source tree.
+  """
+  import cherrypy
+
+  import autoupdate
+  import devserver
+
+  devserver_dir = os.path.dirname(os.path.abspath(__file__))
+  static_dir = os.path.realpath(options.archive_dir)
+  devserver._PrepareToServeUpdatesOnly(static_dir, static_root)
+  devserver.updater = autoupdate.Autoupdate(
+      devserver_dir=devserver_dir, static_dir=static_dir, serve_only=True,
+      copy_to_static_root=False, host_log=True)
+  devserver.updater.IndexLocalPayloads()
+
+  server_options = optparse.Values({'port': port, 'production': True,
+                                    'server': options.server})
+  config = devserver._GetConfig(server_options)
+  config['global'].update({'environment': 'production', 'log.screen': False})
+  cherrypy.config.update(config)
+  cherrypy.tree.mount(devserver.DevServerRoot(static_root=static_root), '',
+                      config)
+  devserver._SetUpServer(server_options, config)
+  cherrypy.engine.start()
+  return cherrypy.engine
+
+
+def benchmark(options):
+  """Runs a benchmark, and returns its results as a dictionary."""
+  operations = _GetOperations(options)
+  weights = _ParseMix(options.mix, operations)
+
+  port = None
+  if options.archive_dir:
+    # Fail early, rather than with every fileinfo and static request.
+    archive_path = os.path.relpath(options.static_path, 'archive')
+    for option, value, path in (
+        ('--payload', options.payload, options.payload),
+        ('--static_path', options.static_path, archive_path)):
+      if (path.startswith(os.pardir) or
+          not os.path.isfile(os.path.join(options.archive_dir, path))):
+        raise ValueError('%s %s is not served from %s' %
+                         (option, value, options.archive_dir))
+    port = _GetFreePort()
+    options.url = 'http://127.0.0.1:%d' % port
+  url = urlparse.urlsplit(options.url)
+  host, port = url.hostname, url.port or port or 80
+
+  # Clients are forked before the devserver starts any thread.
+  num_processes = max(1, min(options.processes, options.concurrency))
+  start = multiprocessing.Event()
+  results = multiprocessing.Queue()
+  clients = []
+  for i in range(num_processes):
+    num_threads = (options.concurrency // num_processes +
+                   (i < options.concurrency % num_processes))
+    clients.append(multiprocessing.Process(
+        target=_RunClients,
+        args=(host, port, operations, weights, num_threads, options.duration,
+              i, start, results)))
+  for client in clients:
+    client.daemon = True
+    client.start()
+
+  engine = None
+  static_root = None
+  try:
+    if options.archive_dir:
+      static_root = tempfile.mkdtemp(prefix='update_test_static.')
+      engine = _StartDevserver(options, port, static_root)
+    begin = time.time()
+    start.set()
+    samples = [results.get() for _ in clients]
+    duration = time.time() - begin
+  finally:
+    if engine:
+      engine.exit()
+    if static_root:
+      shutil.rmtree(static_root)
+  for client in clients:
+    client.join()
+
+  report = {
+      'revision': _GetRevision(),
+      'label': options.label,
+      'time': time.time(),
+      'config': {
+          'url': None if options.archive_dir else options.url,
+          'server': options.server if options.archive_dir else None,
+          'concurrency': options.concurrency,
+          'processes': num_processes,
+          'duration': options.duration,
+          'mix': dict(weights),
+          'protocol': options.protocol,
+      },
+      'operations': {},
+  }
+  all_latencies = []
+  all_errors = 0
+  all_bytes = 0
+  for name, _ in weights:
+    latencies = []
+    errors = 0
+    size = 0
+    for sample in samples:
+      latencies.extend(sample[name]['latencies'])
+      errors += sample[name]['errors']
+      size += sample[name]['bytes']
+    report['operations'][name] = _Summarize(latencies, errors, size, duration)
+    all_latencies.extend(latencies)
+    all_errors += errors
+    all_bytes += size
+  report['total'] = _Summarize(all_latencies, all_errors, all_bytes, duration)
+  return report
+
+
+def _PrintReport(report):
+  columns = ['requests', 'errors', 'req/s'] + ['p%d ms' % p
+                                                for p in PERCENTILES]
+  print ('%-10s' + ' %10s' * len(columns)) % tuple(['operation'] + columns)
+  rows = sorted(report['operations'].items()) + [('total', report['total'])]
+  for name, summary in rows:
+    latency = summary.get('latency_ms', {})
+    values = ['%d' % summary['requests'], '%d' % summary['errors'],
+              '%.1f' % summary['throughput']]
+    values.extend('%.2f' % latency['p%d' % p] if latency else '-'
+                  for p in PERCENTILES)
+    print ('%-10s' + ' %10s' * len(values)) % tuple([name] + values)
+
+
+def main():
+  parser = optparse.OptionParser(
+      usage='usage: %prog [num_clients] | --benchmark [options]')
+  parser.add_option('--benchmark', action='store_true', default=False,
+                    help='run a load benchmark rather than the smoke test')
+  parser.add_option('--archive_dir', metavar='PATH',
+                    help='benchmark a devserver started in this process, '
+                    'serving the update in PATH')
+  parser.add_option('--url', metavar='URL', default='http://localhost:8080',
+                    help='base URL of the devserver to benchmark, unless '
+                    '--archive_dir is given (default: http://localhost:8080)')
+  parser.add_option('--server', default='threaded', type='choice',
+                    choices=('threaded', 'async'),
+                    help='server type of the in-process devserver '
+                    '(default: threaded)')
+  parser.add_option('--concurrency', metavar='NUM', default=8, type='int',
+                    help='number of concurrent client connections '
+                    '(default: 8)')
+  parser.add_option('--processes', metavar='NUM',
+                    default=multiprocessing.cpu_count(), type='int',
+                    help='number of client processes the connections are '
+                    'spread over (default: number of cores)')
+  parser.add_option('--duration', metavar='SECS', default=10, type='float',
+                    help='how long to make requests for (default: 10)')
+  parser.add_option('--mix', default=DEFAULT_MIX,
+                    help='relative weights of the operations (default: %s)'
+                    % DEFAULT_MIX)
+  parser.add_option('--protocol', default='3.0', type='choice',
+                    choices=sorted(UPDATE_BLOBS),
+                    help='Omaha protocol of update requests (default: 3.0)')
+  parser.add_option('--payload', metavar='PATH', default='kernel_update.gz',
+                    help='payload queried by fileinfo requests, relative to '
+                    'the static dir (default: kernel_update.gz)')
+  parser.add_option('--static_path', metavar='PATH',
+                    default='archive/kernel_update.gz',
+                    help='file downloaded by static requests, relative to '
+                    '/static (default: archive/kernel_update.gz)')
+  parser.add_option('--label',
+                    help='label saved with the results, e.g. the change '
+                    'being measured')
+  parser.add_option('--output', metavar='FILE',
+                    help='save the results as JSON to this file')
+  options, args = parser.parse_args()
+
+  if not options.benchmark:
+    test(int(args[0]) if args else 1)
+    return
+
+  try:
+    report = benchmark(options)
+  except ValueError as e:
+    parser.error(str(e))
+  _PrintReport(report)
+  if options.output:
+    with open(options.output, 'w') as f:
+      json.dump(report, f, indent=2, sort_keys=True)
+
 
 if __name__ == '__main__':
-  if len(sys.argv) > 1:
-    num_clients = int(sys.argv[1])
-  else:
-    num_clients = 1
-  test(num_clients)
+  main()